@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import resource
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+import torch.multiprocessing as mp
+
+from models.albef import create_vit
+
+
+def peak_rss_MB():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run_setting(args, config, batch_size, checkpoint_every, queue):
+    """Step time and peak RSS of the online ViT, in a process of its own.
+
+    The peak RSS of a process only grows, so every setting starts from a fresh
+    one. checkpoint_every 0 trains without activation checkpointing.
+    """
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    model = create_vit(
+        dict(
+            config,
+            gradient_checkpointing=checkpoint_every > 0,
+            checkpoint_every=checkpoint_every,
+        )
+    ).to(device)
+    image_res = config["image_res"]
+    image = torch.randn(batch_size, 3, image_res, image_res, device=device)
+
+    def step():
+        model.zero_grad()
+        model(image).mean().backward()
+
+    step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(args.num_iters):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    stats = {
+        "ms_per_step": (time.time() - start_time) / args.num_iters * 1000,
+        "peak_rss_MB": peak_rss_MB(),
+    }
+    if device.type == "cuda":
+        stats["peak_memory_MB"] = torch.cuda.max_memory_allocated() / 2**20
+    queue.put(stats)
+
+
+def main(args, config):
+    ctx = mp.get_context("spawn")
+    stats = {}
+    for batch_size in args.batch_sizes:
+        for checkpoint_every in args.checkpoint_every:
+            queue = ctx.SimpleQueue()
+            process = ctx.Process(
+                target=run_setting,
+                args=(args, config, batch_size, checkpoint_every, queue),
+            )
+            process.start()
+            name = "batch_size=%d,checkpoint_every=%d" % (batch_size, checkpoint_every)
+            stats[name] = queue.get()
+            process.join()
+            print(name, json.dumps(stats[name]))
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Peak memory and step time of the ViT activation checkpointing, "
+        "over batch sizes and checkpoint_every (0 for no checkpointing)"
+    )
+    parser.add_argument("--config", default="./configs/Retrieval_coco.yaml")
+    parser.add_argument("--output_dir", default="output/Checkpoint_benchmark")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_sizes", nargs="+", default=[4, 8, 16], type=int)
+    parser.add_argument("--checkpoint_every", nargs="+", default=[0, 1, 2, 4], type=int)
+    parser.add_argument("--num_iters", default=3, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
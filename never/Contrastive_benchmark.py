@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+import torch.nn.functional as F
+
+from models.contrastive import (
+    ContrastiveLoss,
+    in_batch_g2l_loss,
+    stacked_similarities,
+)
+
+
+def reference_losses(
+    image_feat, text_feat, image_bank, text_bank, temp, pos_cols, soft
+):
+    """The ITC losses as computed before, with dense targets and four matmuls."""
+    sim_i2t = image_feat @ text_bank / temp
+    sim_t2i = text_feat @ image_bank / temp
+    sim_i2i = image_feat @ image_bank / temp
+    sim_t2t = text_feat @ text_bank / temp
+
+    alpha, sim_i2t_m, sim_t2i_m = soft
+    with torch.no_grad():
+        sim_targets = torch.zeros(sim_i2t.size()).to(sim_i2t.device)
+        sim_targets.scatter_(1, pos_cols.unsqueeze(1), 1)
+        sim_i2t_targets = (
+            alpha * F.softmax(sim_i2t_m, dim=1) + (1 - alpha) * sim_targets
+        )
+        sim_t2i_targets = (
+            alpha * F.softmax(sim_t2i_m, dim=1) + (1 - alpha) * sim_targets
+        )
+
+    loss = lambda sim, targets: -torch.sum(
+        F.log_softmax(sim, dim=1) * targets, dim=1
+    ).mean()
+    return (
+        loss(sim_i2t, sim_i2t_targets)
+        + loss(sim_t2i, sim_t2i_targets)
+        + loss(sim_i2i, sim_targets)
+        + loss(sim_t2t, sim_targets)
+    )
+
+
+def fused_losses(image_feat, text_feat, image_bank, text_bank, temp, pos_cols, soft):
+    """The ITC losses with ContrastiveLoss, as in the models."""
+    contrastive_loss = ContrastiveLoss()
+    alpha, sim_i2t_m, sim_t2i_m = soft
+    sim_i2t_soft = sim_t2i_soft = None
+    if alpha > 0:
+        with torch.no_grad():
+            sim_i2t_soft = alpha * F.softmax(sim_i2t_m, dim=1)
+            sim_t2i_soft = alpha * F.softmax(sim_t2i_m, dim=1)
+
+    sim_i2t, sim_t2i, sim_i2i, sim_t2t = stacked_similarities(
+        image_feat, text_feat, image_bank, text_bank, temp
+    )
+    return (
+        contrastive_loss(sim_i2t, pos_cols, sim_i2t_soft)
+        + contrastive_loss(sim_t2i, pos_cols, sim_t2i_soft)
+        + contrastive_loss(sim_i2i, pos_cols)
+        + contrastive_loss(sim_t2t, pos_cols)
+    )
+
+
+def reference_g2l_loss(l, m, temp, attention_mask=None):
+    """The in-batch g2l loss as computed before, on the expanded logits."""
+    m = m.unsqueeze(1)
+    N, n_locals, dim = l.size()
+    l_n = l.reshape(-1, dim)
+    m_n = m.reshape(-1, dim)
+    u_p = torch.matmul(l, m.permute(0, 2, 1)).unsqueeze(2) / temp
+    if attention_mask is not None:
+        temp_mask = attention_mask.unsqueeze(2).unsqueeze(3)
+        u_p = (temp_mask * u_p) + (10000.0 * (1 - temp_mask))
+
+    u_n = torch.mm(m_n, l_n.t()) / temp
+    u_n = u_n.reshape(N, 1, N, n_locals).permute(0, 2, 3, 1)
+    mask = torch.eye(N)[:, :, None, None].to(l.device)
+    n_mask = 1 - mask
+    u_n = (n_mask * u_n) - (10000.0 * (1 - n_mask))
+    if attention_mask is not None:
+        temp_mask = attention_mask.unsqueeze(0).unsqueeze(3).expand(N, -1, -1, -1)
+        u_n = (temp_mask * u_n) - (10000.0 * (1 - temp_mask))
+    u_n = u_n.reshape(N, N * n_locals, 1).unsqueeze(dim=1).expand(-1, n_locals, -1, -1)
+
+    pred_lgt = torch.cat([u_p, u_n], dim=2)
+    pred_log = F.log_softmax(pred_lgt, dim=2)
+    if attention_mask is not None:
+        return (
+            torch.sum(-pred_log[:, :, 0].squeeze(), dim=1)
+            / torch.sum(attention_mask, dim=1)
+        ).mean()
+    return -pred_log[:, :, 0].mean()
+
+
+def run_step(losses, inputs, wrt=(0, 1, 4)):
+    """Forward and backward of the losses, with the bytes autograd saves for backward.
+
+    The gradients are taken with respect to the inputs at the positions wrt.
+    """
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = losses(*inputs)
+    grads = torch.autograd.grad(loss, [inputs[i] for i in wrt])
+    return loss.detach(), grads, sum(saved.values())
+
+
+def benchmark(losses, inputs, num_iters, device, wrt=(0, 1, 4)):
+    run_step(losses, inputs, wrt)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    start_time = time.time()
+    for _ in range(num_iters):
+        _, _, saved_bytes = run_step(losses, inputs, wrt)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    stats = {
+        "ms_per_step": (time.time() - start_time) / num_iters * 1000,
+        "saved_for_backward_MB": saved_bytes / 2**20,
+    }
+    if device.type == "cuda":
+        stats["peak_memory_MB"] = (
+            torch.cuda.max_memory_allocated() - base_memory
+        ) / 2**20
+    return stats
+
+
+def main(args, config):
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+
+    batch_size = args.batch_size or config["batch_size"]
+    queue_size = args.queue_size or config["queue_size"]
+    embed_dim = config["embed_dim"]
+    print("batch %d, queue %d, dim %d" % (batch_size, queue_size, embed_dim))
+
+    # the current batch sits inside the banks, as after the enqueue of the models
+    image_bank = F.normalize(torch.randn(embed_dim, queue_size, device=device), dim=0)
+    text_bank = F.normalize(torch.randn(embed_dim, queue_size, device=device), dim=0)
+    pos_cols = torch.arange(batch_size, device=device) + queue_size // 3
+    image_feat = F.normalize(
+        image_bank[:, pos_cols].t()
+        + 0.5 * torch.randn(batch_size, embed_dim, device=device),
+        dim=1,
+    )
+    text_feat = F.normalize(
+        text_bank[:, pos_cols].t()
+        + 0.5 * torch.randn(batch_size, embed_dim, device=device),
+        dim=1,
+    )
+    image_feat.requires_grad_()
+    text_feat.requires_grad_()
+    temp = torch.tensor(config["temp"], device=device, requires_grad=True)
+    sim_i2t_m = image_feat.detach() @ text_bank / temp.detach()
+    sim_t2i_m = text_feat.detach() @ image_bank / temp.detach()
+
+    stats = {}
+    for alpha in args.alpha:
+        soft = (alpha, sim_i2t_m, sim_t2i_m)
+        inputs = (image_feat, text_feat, image_bank, text_bank, temp, pos_cols, soft)
+
+        #### Parity ####
+        loss, grads, _ = run_step(reference_losses, inputs)
+        fused_loss, fused_grads, _ = run_step(fused_losses, inputs)
+        max_diff = max(
+            (a - b).abs().max().item()
+            for a, b in zip((loss,) + grads, (fused_loss,) + fused_grads)
+        )
+        assert max_diff < args.atol, "fused loss diverges: %g" % max_diff
+
+        #### Time and memory ####
+        stats["alpha=%g" % alpha] = {
+            "max_abs_diff": max_diff,
+            "reference": benchmark(reference_losses, inputs, args.num_iters, device),
+            "fused": benchmark(fused_losses, inputs, args.num_iters, device),
+        }
+        print(json.dumps(stats["alpha=%g" % alpha], indent=2))
+
+    #### In-batch g2l loss, text locals with padding and image locals ####
+    temp = temp.detach().requires_grad_()
+    for name, n_locals, padded in [("g2l_text", 29, True), ("g2l_image", 16, False)]:
+        l = F.normalize(
+            torch.randn(batch_size, n_locals, embed_dim, device=device), dim=-1
+        )
+        m = F.normalize(torch.randn(batch_size, embed_dim, device=device), dim=-1)
+        m.requires_grad_()
+        attention_mask = None
+        if padded:
+            lengths = torch.randint(3, n_locals + 1, (batch_size,), device=device)
+            positions = torch.arange(n_locals, device=device)
+            attention_mask = (positions < lengths.unsqueeze(1)).long()
+        inputs = (l, m, temp, attention_mask)
+        chunked = lambda l, m, temp, mask: in_batch_g2l_loss(
+            l, m, temp, mask, chunk_size=args.g2l_chunk_size
+        )
+
+        loss, grads, _ = run_step(reference_g2l_loss, inputs, wrt=(1, 2))
+        chunked_loss, chunked_grads, _ = run_step(chunked, inputs, wrt=(1, 2))
+        max_diff = max(
+            (a - b).abs().max().item()
+            for a, b in zip((loss,) + grads, (chunked_loss,) + chunked_grads)
+        )
+        assert max_diff < args.atol, "chunked g2l loss diverges: %g" % max_diff
+
+        stats[name] = {
+            "max_abs_diff": max_diff,
+            "reference": benchmark(
+                reference_g2l_loss, inputs, args.num_iters, device, wrt=(1, 2)
+            ),
+            "chunked": benchmark(chunked, inputs, args.num_iters, device, wrt=(1, 2)),
+        }
+        print(name, json.dumps(stats[name], indent=2))
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="./configs/Pretrain.yaml")
+    parser.add_argument("--output_dir", default="output/Contrastive_benchmark")
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument(
+        "--batch_size", default=0, type=int, help="defaults to the config batch_size"
+    )
+    parser.add_argument(
+        "--queue_size", default=0, type=int, help="defaults to the config queue_size"
+    )
+    parser.add_argument("--alpha", nargs="+", default=[0.0, 0.4], type=float)
+    parser.add_argument("--g2l_chunk_size", default=4096, type=int)
+    parser.add_argument("--num_iters", default=10, type=int)
+    parser.add_argument(
+        "--atol", default=1e-4, type=float, help="max abs difference to the reference"
+    )
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+from models.export import DYNAMIC_AXES, TOWERS
+from models.model_retrieval import ALBEF
+from models.pruning import prune_model
+from models.tokenization_bert import BertTokenizer
+from models.vit import interpolate_pos_embed
+
+
+@torch.no_grad()
+def make_inputs(model, config, batch_size, text_length):
+    """Random image and text inputs, the fusion inputs are the tower outputs."""
+    image = torch.randn(batch_size, 3, config["image_res"], config["image_res"])
+    input_ids = torch.randint(
+        1000, model.text_encoder.config.vocab_size, (batch_size, text_length)
+    )
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[-1, text_length // 2 :] = 0
+
+    image_feat = TOWERS["image"][0](model)(image)[0]
+    text_feat = TOWERS["text"][0](model)(input_ids, attention_mask)[0]
+    return {
+        "image": (image,),
+        "text": (input_ids, attention_mask),
+        "fusion": (text_feat, attention_mask, image_feat),
+    }
+
+
+def export(tower, inputs, input_names, output_names, path, fmt, opset):
+    if fmt == "torchscript":
+        traced = torch.jit.trace(tower, inputs, check_trace=False)
+        torch.jit.save(traced, path)
+    else:
+        torch.onnx.export(
+            tower,
+            inputs,
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes={n: DYNAMIC_AXES[n] for n in input_names + output_names},
+            opset_version=opset,
+        )
+
+
+def load_exported(path, fmt, input_names):
+    if fmt == "torchscript":
+        traced = torch.jit.load(path)
+        return lambda *inputs: traced(*inputs)
+
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def run(*inputs):
+        feed = {n: x.numpy() for n, x in zip(input_names, inputs)}
+        return tuple(torch.from_numpy(y) for y in session.run(None, feed))
+
+    return run
+
+
+def benchmark(fn, inputs, num_iters):
+    fn(*inputs)
+    start_time = time.time()
+    for _ in range(num_iters):
+        fn(*inputs)
+    return (time.time() - start_time) / num_iters * 1000
+
+
+def main(args, config):
+    torch.manual_seed(args.seed)
+
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+
+    #### Model ####
+    print("Creating model")
+    model = ALBEF(
+        config=config, text_encoder=config["text_encoder"], tokenizer=tokenizer
+    )
+
+    if args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        state_dict = checkpoint["model"]
+        state_dict["visual_encoder.pos_embed"] = interpolate_pos_embed(
+            state_dict["visual_encoder.pos_embed"], model.visual_encoder
+        )
+        if "pruning" in checkpoint:
+            prune_model(model, checkpoint["pruning"])
+        msg = model.load_state_dict(state_dict, strict=False)
+        print("load checkpoint from %s" % args.checkpoint)
+        print(msg)
+
+    model.eval()
+
+    # trace on one shape and check parity on another, so a dimension that was
+    # baked into the graph shows up as a mismatch instead of passing silently
+    example_inputs = make_inputs(model, config, args.batch_size, args.text_length)
+    check_inputs = make_inputs(model, config, args.batch_size + 1, args.text_length + 7)
+
+    ext = ".pt" if args.format == "torchscript" else ".onnx"
+    stats = {}
+    for name in args.towers:
+        tower_cls, input_names, output_names = TOWERS[name]
+        tower = tower_cls(model).eval()
+        path = os.path.join(args.output_dir, name + ext)
+
+        print("Exporting %s tower to %s" % (name, path))
+        with torch.no_grad():
+            export(
+                tower,
+                example_inputs[name],
+                input_names,
+                output_names,
+                path,
+                args.format,
+                args.opset,
+            )
+            exported = load_exported(path, args.format, input_names)
+
+            outputs = tower(*check_inputs[name])
+            outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+            exported_outputs = exported(*check_inputs[name])
+            exported_outputs = (
+                exported_outputs
+                if isinstance(exported_outputs, tuple)
+                else (exported_outputs,)
+            )
+            max_diff = max(
+                (a - b).abs().max().item() for a, b in zip(outputs, exported_outputs)
+            )
+
+            stats[name] = {
+                "max_abs_diff": max_diff,
+                "eager_ms": benchmark(tower, check_inputs[name], args.num_iters),
+                "exported_ms": benchmark(exported, check_inputs[name], args.num_iters),
+            }
+        print(name, stats[name])
+        assert max_diff < args.atol, "%s tower diverges from eager mode: %g" % (
+            name,
+            max_diff,
+        )
+
+    print(json.dumps(stats, indent=2))
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="./configs/Retrieval_flickr.yaml")
+    parser.add_argument("--output_dir", default="output/Export")
+    parser.add_argument("--checkpoint", default="")
+    parser.add_argument(
+        "--format", default="torchscript", choices=["torchscript", "onnx"]
+    )
+    parser.add_argument(
+        "--towers", nargs="+", default=list(TOWERS), choices=list(TOWERS)
+    )
+    parser.add_argument("--opset", default=14, type=int)
+    parser.add_argument("--batch_size", default=2, type=int)
+    parser.add_argument("--text_length", default=16, type=int)
+    parser.add_argument("--num_iters", default=20, type=int)
+    parser.add_argument(
+        "--atol", default=1e-4, type=float, help="max abs difference to eager mode"
+    )
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
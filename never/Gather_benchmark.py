@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from models.gather import all_gather_with_grad
+
+
+def run_step(feat, reduce_scatter):
+    """Gather the features of all ranks and backpropagate a loss over all of them.
+
+    The loss is elementwise, the time is that of the communication. Every rank
+    has a loss on all the features, the local gradient is the sum of theirs.
+    """
+    feat_all = all_gather_with_grad(feat, reduce_scatter=reduce_scatter)
+    loss = torch.sum(feat_all * torch.arange(1.0, feat_all.size(0) + 1).unsqueeze(1))
+    (grad,) = torch.autograd.grad(loss, feat)
+    return grad
+
+
+def benchmark(feat, reduce_scatter, num_iters):
+    run_step(feat, reduce_scatter)
+    dist.barrier()
+    start_time = time.time()
+    for _ in range(num_iters):
+        run_step(feat, reduce_scatter)
+    dist.barrier()
+    return (time.time() - start_time) / num_iters * 1000
+
+
+def worker(rank, args, embed_dim):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    dist.init_process_group(args.backend, rank=rank, world_size=args.world_size)
+    torch.set_num_threads(args.threads)
+    world_size = args.world_size
+
+    stats = {}
+    for batch_size in args.batch_size:
+        torch.manual_seed(args.seed + rank)
+        feat = torch.randn(batch_size, embed_dim).requires_grad_()
+
+        #### Parity of the two backward variants ####
+        grad = run_step(feat, reduce_scatter=True)
+        ref_grad = run_step(feat, reduce_scatter=False)
+        rows = torch.arange(batch_size) + rank * batch_size + 1.0
+        expected = world_size * rows.unsqueeze(1).expand_as(feat)
+        max_diff = torch.maximum(
+            (grad - expected).abs().max(), (ref_grad - expected).abs().max()
+        )
+        dist.all_reduce(max_diff, op=dist.ReduceOp.MAX)
+
+        #### Time, and floats received per rank ####
+        # ring all-gather / reduce-scatter receive (W - 1) slices, a ring
+        # all-reduce twice that many, of the whole gathered gradient
+        slice_floats = batch_size * embed_dim
+        stats["batch=%d" % batch_size] = {
+            "max_abs_diff": max_diff.item(),
+            "reduce_scatter_ms": benchmark(feat, True, args.num_iters),
+            "all_reduce_ms": benchmark(feat, False, args.num_iters),
+            "forward_MB": (world_size - 1) * slice_floats * 4 / 2**20,
+            "backward_reduce_scatter_MB": (world_size - 1) * slice_floats * 4 / 2**20,
+            "backward_all_reduce_MB": 2 * (world_size - 1) * slice_floats * 4 / 2**20,
+        }
+        if rank == 0:
+            print(batch_size, json.dumps(stats["batch=%d" % batch_size], indent=2))
+
+    if rank == 0:
+        with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+            f.write(json.dumps({"world_size": world_size, **stats}) + "\n")
+    dist.destroy_process_group()
+
+
+def main(args, config):
+    mp.spawn(worker, args=(args, config["embed_dim"]), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="./configs/Pretrain.yaml")
+    parser.add_argument("--output_dir", default="output/Gather_benchmark")
+    parser.add_argument("--backend", default="gloo")
+    parser.add_argument("--world_size", default=2, type=int)
+    parser.add_argument("--port", default=29500, type=int)
+    parser.add_argument(
+        "--threads", default=1, type=int, help="torch threads per process"
+    )
+    parser.add_argument(
+        "--batch_size", nargs="+", default=[64, 256, 1024, 4096], type=int
+    )
+    parser.add_argument("--num_iters", default=20, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
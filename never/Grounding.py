@@ -11,7 +11,6 @@ import numpy as np
 import ruamel.yaml as yaml
 import torch
 import torch.backends.cudnn as cudnn
-import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
@@ -37,6 +36,8 @@ def train(
     device,
     scheduler,
     config,
+    precision,
+    scaler,
 ):
     # train
     model.train()
@@ -68,12 +69,16 @@ def train(
         else:
             alpha = config["alpha"] * min(1, i / len(data_loader))
 
-        loss_ita, loss_itm = model(image, image, text_input, alpha=alpha, idx=idx)
-        loss = loss_ita + loss_itm
+        with utils.get_autocast(precision, device):
+            loss_ita, loss_itm = model(
+                image, image, text_input, alpha=alpha, idx=idx
+            )
+            loss = loss_ita + loss_itm
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         metric_logger.update(loss_itm=loss_itm.item())
         metric_logger.update(loss_ita=loss_ita.item())
@@ -112,14 +117,10 @@ def val(model, data_loader, tokenizer, device, gradcam_mode, block_num):
 
         if gradcam_mode == "itm":
             image_embeds = model.visual_encoder(image)
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-                image.device
-            )
             output = model.text_encoder(
                 text_input.input_ids,
                 attention_mask=text_input.attention_mask,
                 encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
                 return_dict=True,
             )
 
@@ -267,15 +268,21 @@ def main(args, config):
 
     model = model.to(device)
 
+    if args.compile:
+        utils.compile_model(model)
+
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=utils.ddp_device_ids(args)
+        )
         model_without_ddp = model.module
 
     arg_opt = utils.AttrDict(config["optimizer"])
     optimizer = create_optimizer(arg_opt, model)
     arg_sche = utils.AttrDict(config["schedular"])
     lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
+    scaler = utils.create_grad_scaler(args.precision, device)
 
     max_epoch = config["schedular"]["epochs"]
     warmup_steps = config["schedular"]["warmup_epochs"]
@@ -297,8 +304,12 @@ def main(args, config):
                 device,
                 lr_scheduler,
                 config,
+                precision=args.precision,
+                scaler=scaler,
             )
 
+        # gradcam maps are left in fp32, the attention gradients they are built
+        # from are too small for half precision
         result = val(
             model_without_ddp,
             test_loader,
@@ -349,7 +360,7 @@ def main(args, config):
             break
 
         lr_scheduler.step(epoch + warmup_steps + 1)
-        dist.barrier()
+        utils.barrier()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -366,6 +377,17 @@ if __name__ == "__main__":
     parser.add_argument("--text_encoder", default="pretrained/bert-base-uncased")
     parser.add_argument("--evaluate", action="store_true")
     parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision for training and evaluation",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the encoders and loss blocks",
+    )
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument(
         "--world_size", default=1, type=int, help="number of distributed processes"
@@ -373,6 +395,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dist_url", default="env://", help="url used to set up distributed training"
     )
+    parser.add_argument(
+        "--dist_backend",
+        default=None,
+        choices=["nccl", "gloo"],
+        help="defaults to nccl on cuda and gloo on cpu",
+    )
     parser.add_argument("--distributed", default=True, type=bool)
     args = parser.parse_args()
 
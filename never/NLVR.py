@@ -10,7 +10,6 @@ import numpy as np
 import ruamel.yaml as yaml
 import torch
 import torch.backends.cudnn as cudnn
-import torch.distributed as dist
 
 import utils
 from dataset import create_dataset, create_loader, create_sampler
@@ -31,6 +30,8 @@ def train(
     device,
     scheduler,
     config,
+    precision,
+    scaler,
 ):
     # train
     model.train()
@@ -61,11 +62,13 @@ def train(
         else:
             alpha = config["alpha"] * min(1, i / len(data_loader))
 
-        loss = model(images, text_inputs, targets=targets, train=True, alpha=alpha)
+        with utils.get_autocast(precision, device):
+            loss = model(images, text_inputs, targets=targets, train=True, alpha=alpha)
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(loss=loss.item())
@@ -177,15 +180,21 @@ def main(args, config):
 
     model = model.to(device)
 
+    if args.compile:
+        utils.compile_model(model)
+
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=utils.ddp_device_ids(args)
+        )
         model_without_ddp = model.module
 
     arg_opt = utils.AttrDict(config["optimizer"])
     optimizer = create_optimizer(arg_opt, model)
     arg_sche = utils.AttrDict(config["schedular"])
     lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
+    scaler = utils.create_grad_scaler(args.precision, device)
 
     max_epoch = config["schedular"]["epochs"]
     warmup_steps = config["schedular"]["warmup_epochs"]
@@ -209,10 +218,13 @@ def main(args, config):
                 device,
                 lr_scheduler,
                 config,
+                precision=args.precision,
+                scaler=scaler,
             )
         
-        val_stats = evaluate(model, val_loader, tokenizer, device, config)
-        test_stats = evaluate(model, test_loader, tokenizer, device, config)
+        with utils.get_autocast(args.precision, device):
+            val_stats = evaluate(model, val_loader, tokenizer, device, config)
+            test_stats = evaluate(model, test_loader, tokenizer, device, config)
 
         if utils.is_main_process():
             if args.evaluate:
@@ -251,7 +263,7 @@ def main(args, config):
             break
         
         lr_scheduler.step(epoch + warmup_steps + 1)
-        dist.barrier()
+        utils.barrier()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -269,6 +281,17 @@ if __name__ == "__main__":
     parser.add_argument("--evaluate", action="store_true")
     parser.add_argument("--output_dir", default="output/NLVR")
     parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision for training and evaluation",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the encoders and loss blocks",
+    )
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument(
         "--world_size", default=1, type=int, help="number of distributed processes"
@@ -276,6 +299,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dist_url", default="env://", help="url used to set up distributed training"
     )
+    parser.add_argument(
+        "--dist_backend",
+        default=None,
+        choices=["nccl", "gloo"],
+        help="defaults to nccl on cuda and gloo on cpu",
+    )
     parser.add_argument("--distributed", default=True, type=bool)
     args = parser.parse_args()
 
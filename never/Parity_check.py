@@ -0,0 +1,260 @@
+import argparse
+import importlib
+import json
+import os
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+from models.tokenization_bert import BertTokenizer
+from models.vit import VisionTransformer
+from models.xbert import BertConfig, BertForMaskedLM
+
+# config and model module of every task model
+TASKS = {
+    "pretrain": ("./configs/Pretrain.yaml", "models.model_pretrain"),
+    "retrieval": ("./configs/Retrieval_coco.yaml", "models.model_retrieval"),
+    "ve": ("./configs/VE.yaml", "models.model_ve"),
+    "nlvr": ("./configs/NLVR.yaml", "models.model_nlvr"),
+    "vqa": ("./configs/VQA.yaml", "models.model_vqa"),
+    "pretrain_nlvr": ("./configs/NLVR_pretrain.yaml", "models.model_pretrain_nlvr"),
+}
+
+CAPTIONS = [
+    "a man riding a horse on the beach",
+    "two dogs playing in the snow",
+    "a plate of food with a fork and a knife next to a glass of water",
+    "a red bus",
+]
+
+# losses of the small models on CPU, from the tree before the task models
+# shared their trunks in models/albef.py
+SMALL_REFERENCE = "./configs/Parity_reference.json"
+
+# the small models: randomly initialized, without pretrained weights, with a
+# vocabulary of the captions and narrow trunks
+SMALL_CONFIG = dict(image_res=64, vision_width=64, embed_dim=32, queue_size=16)
+SMALL_BERT = dict(
+    hidden_size=64,
+    num_hidden_layers=4,
+    num_attention_heads=4,
+    intermediate_size=256,
+    max_position_embeddings=64,
+    fusion_layer=2,
+    encoder_width=64,
+)
+SMALL_VIT = dict(embed_dim=64, depth=2, num_heads=4)
+
+
+def small_vit(*args, **kwargs):
+    kwargs.update(SMALL_VIT)
+    return VisionTransformer(*args, **kwargs)
+
+
+def create_small_models(output_dir, seed):
+    """Write the vocabulary and the random BERT weights of the small models.
+
+    The ViT of the task modules is narrowed wherever they bound it. Returns the
+    config overrides pointing the models to them.
+    """
+    model_dir = os.path.join(output_dir, "small_bert")
+    Path(model_dir).mkdir(parents=True, exist_ok=True)
+    words = sorted({word for caption in CAPTIONS for word in caption.split()})
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words
+    with open(os.path.join(model_dir, "vocab.txt"), "w") as f:
+        f.write("\n".join(vocab) + "\n")
+
+    bert_config = BertConfig.from_json_file("./configs/config_bert.json")
+    for name, value in dict(SMALL_BERT, vocab_size=len(vocab)).items():
+        setattr(bert_config, name, value)
+    torch.manual_seed(seed)
+    BertForMaskedLM(bert_config).save_pretrained(model_dir)
+
+    for task_module in [module for _, module in TASKS.values()] + ["models.albef"]:
+        try:
+            module = importlib.import_module(task_module)
+        except ImportError:
+            continue
+        if getattr(module, "VisionTransformer", None) is VisionTransformer:
+            module.VisionTransformer = small_vit
+    return dict(
+        SMALL_CONFIG,
+        bert_config=os.path.join(model_dir, "config.json"),
+        text_encoder=model_dir,
+        text_decoder=model_dir,
+    )
+
+
+def build_model(task, config, tokenizer):
+    module = importlib.import_module(TASKS[task][1])
+    kwargs = dict(
+        config=config, text_encoder=config["text_encoder"], tokenizer=tokenizer
+    )
+    if task == "pretrain":
+        kwargs["init_deit"] = False
+    if task == "vqa":
+        kwargs["text_decoder"] = config["text_decoder"]
+    return module.ALBEF(**kwargs)
+
+
+def task_losses(task, model, config, tokenizer, batch_size, device):
+    """Training losses of a random batch, as a list of tensors."""
+
+    def tokenize(texts):
+        return tokenizer(texts, padding="longest", return_tensors="pt").to(device)
+
+    res = config["image_res"]
+    image = torch.randn(batch_size, 3, res, res, device=device)
+    text = tokenize([CAPTIONS[i % len(CAPTIONS)] for i in range(batch_size)])
+    alpha = config.get("alpha", 0.4)
+
+    if task == "pretrain":
+        image_aug = torch.randn_like(image)
+        return list(
+            model(
+                image,
+                image_aug,
+                text,
+                alpha=alpha,
+                neg_thresh=config.get("neg_thresh", 0),
+            )
+        )
+    if task == "retrieval":
+        image_aug = torch.randn_like(image)
+        # pairs of captions of the same image
+        idx = torch.arange(batch_size, device=device) // 2
+        return list(model(image, image_aug, text, alpha, idx))
+    if task == "ve":
+        targets = torch.randint(3, (batch_size,), device=device)
+        return [model(image, text, targets=targets, train=True, alpha=alpha)]
+    if task == "nlvr":
+        images = torch.cat([image, torch.randn_like(image)])
+        targets = torch.randint(2, (batch_size,), device=device)
+        return [model(images, text, targets=targets, train=True, alpha=alpha)]
+    if task == "vqa":
+        k = [2] * batch_size
+        answer = tokenize([CAPTIONS[i % len(CAPTIONS)][:9] for i in range(sum(k))])
+        weights = torch.full((sum(k),), 0.5, device=device)
+        return [
+            model(image, text, answer, alpha=alpha, k=k, weights=weights, train=True)
+        ]
+    if task == "pretrain_nlvr":
+        return [model(image, text)]
+    raise ValueError(task)
+
+
+def run_task(task, args, device, overrides):
+    """Losses of num_steps training steps from a fixed seed, and the checkpoint keys."""
+    config = yaml.load(open(TASKS[task][0], "r"), Loader=yaml.Loader)
+    config.update(overrides)
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+    torch.manual_seed(args.seed)
+    # from_pretrained leaves the text encoders in eval mode
+    model = build_model(task, config, tokenizer).to(device).train()
+    if args.no_dropout:
+        # changes that reorder the random draws of dropout, one fused pass
+        # instead of two for instance, only keep the losses without it
+        for module in model.modules():
+            if isinstance(module, torch.nn.Dropout):
+                module.p = 0.0
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad], lr=args.lr
+    )
+
+    losses = []
+    for _ in range(args.num_steps):
+        step_losses = task_losses(
+            task, model, config, tokenizer, args.batch_size, device
+        )
+        optimizer.zero_grad()
+        sum(step_losses).backward()
+        optimizer.step()
+        losses.append([loss.item() for loss in step_losses])
+    return {"losses": losses, "state_dict_keys": list(model.state_dict())}
+
+
+def compare(stats, reference, atol):
+    """Max abs loss difference per task, and whether all tasks match."""
+    ok = True
+    diffs = {}
+    for task, task_stats in stats.items():
+        if task not in reference:
+            continue
+        ref_stats = reference[task]
+        same_keys = task_stats["state_dict_keys"] == ref_stats["state_dict_keys"]
+        diffs[task] = max(
+            abs(a - b)
+            for step, ref_step in zip(task_stats["losses"], ref_stats["losses"])
+            for a, b in zip(step, ref_step)
+        )
+        print(
+            "%s: max_abs_diff %.3g, same state_dict keys %s"
+            % (task, diffs[task], same_keys)
+        )
+        ok = ok and same_keys and diffs[task] <= atol
+    return diffs, ok
+
+
+def main(args):
+    device = torch.device(args.device)
+    overrides = {}
+    if not args.full:
+        overrides = create_small_models(args.output_dir, args.seed)
+    stats = {}
+    for task in args.tasks:
+        stats[task] = run_task(task, args, device, overrides)
+        print(task, stats[task]["losses"])
+
+    with open(os.path.join(args.output_dir, "losses.json"), "w") as f:
+        json.dump(stats, f)
+
+    reference = args.reference
+    if reference is None:
+        reference = "" if args.full or args.no_dropout else SMALL_REFERENCE
+    if reference:
+        reference = json.load(open(reference, "r"))
+        diffs, ok = compare(stats, reference, args.atol)
+        with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+            f.write(json.dumps({"max_abs_diff": diffs, "parity": ok}) + "\n")
+        if not ok:
+            raise SystemExit("losses differ from the reference")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Losses of every task model on a fixed seed, compared against "
+        "the losses.json of a reference run. The small models are checked against "
+        "the committed reference by default"
+    )
+    parser.add_argument("--output_dir", default="output/Parity_check")
+    parser.add_argument("--tasks", nargs="+", default=list(TASKS), choices=TASKS)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="the models of the configs, from their pretrained text encoder",
+    )
+    parser.add_argument(
+        "--reference",
+        default=None,
+        help="losses.json to compare with, '' to skip. Defaults to %s for the "
+        "small models, to none with --full or --no_dropout" % SMALL_REFERENCE,
+    )
+    parser.add_argument(
+        "--no_dropout",
+        action="store_true",
+        help="train with the dropout probabilities set to 0",
+    )
+    parser.add_argument(
+        "--device", default="cpu", help="the committed reference is a CPU run"
+    )
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--num_steps", default=3, type=int)
+    parser.add_argument("--lr", default=1e-4, type=float)
+    parser.add_argument("--atol", default=1e-4, type=float)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    main(args)
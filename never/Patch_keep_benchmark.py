@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+import utils
+from models.albef import create_vit
+from models.model_pretrain import ALBEF
+from models.tokenization_bert import BertTokenizer
+
+
+def images_per_second(step, batch_size, num_iters, device):
+    step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_iters):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return num_iters * batch_size / (time.time() - start_time)
+
+
+def online_throughput(args, config, image, keep_ratio, device):
+    """Images per second of the online ViT, forward and backward."""
+    torch.manual_seed(args.seed)
+    model = create_vit(config, patch_keep_ratio=keep_ratio).to(device).train()
+
+    def step():
+        model.zero_grad()
+        with utils.get_autocast(args.precision, device):
+            loss = model(image).mean()
+        loss.backward()
+
+    return images_per_second(step, image.size(0), args.num_iters, device)
+
+
+def momentum_throughput(args, config, image, keep_ratio, device):
+    """Images per second of the momentum ViT, forward only."""
+    torch.manual_seed(args.seed)
+    model = create_vit(config, momentum=True, patch_keep_ratio=keep_ratio)
+    model = model.to(device).train()
+
+    @torch.no_grad()
+    def step():
+        with utils.get_autocast(args.precision, device):
+            model(image)
+
+    return images_per_second(step, image.size(0), args.num_iters, device)
+
+
+def encoder_throughput(args, config, image, device):
+    """Images per second of the online and momentum ViT at every keep ratio.
+
+    The online ViT runs forward and backward, the momentum one forward only.
+    """
+    stats = {}
+    for keep_ratio in args.keep_ratios:
+        stats["online_keep=%g" % keep_ratio] = online_throughput(
+            args, config, image, keep_ratio, device
+        )
+    for keep_ratio in args.keep_ratios_m:
+        stats["momentum_keep=%g" % keep_ratio] = momentum_throughput(
+            args, config, image, keep_ratio, device
+        )
+    return stats
+
+
+def pretrain_step_throughput(args, config, tokenizer, image, text, device):
+    """Images per second of whole pretraining steps under config."""
+    torch.manual_seed(args.seed)
+    model = ALBEF(
+        config=config,
+        text_encoder=config["text_encoder"],
+        tokenizer=tokenizer,
+        init_deit=False,
+    ).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+    def step():
+        with utils.get_autocast(args.precision, device):
+            loss_mlm, loss_ita, loss_itm = model(
+                image, image, text, alpha=0.4, neg_thresh=0
+            )
+        optimizer.zero_grad()
+        (loss_mlm + loss_ita + loss_itm).backward()
+        optimizer.step()
+
+    return images_per_second(step, image.size(0), args.num_iters, device)
+
+
+def pretrain_throughput(args, config, tokenizer, image, text, device):
+    """Images per second of whole pretraining steps, over the pairs of keep ratios."""
+    stats = {}
+    for keep_ratio in args.keep_ratios:
+        for keep_ratio_m in args.keep_ratios_m:
+            name = "keep=%g,keep_m=%g" % (keep_ratio, keep_ratio_m)
+            stats[name] = pretrain_step_throughput(
+                args,
+                dict(
+                    config, patch_keep_ratio=keep_ratio, patch_keep_ratio_m=keep_ratio_m
+                ),
+                tokenizer,
+                image,
+                text,
+                device,
+            )
+    return stats
+
+
+def main(args, config):
+    device = torch.device(args.device)
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+    batch_size = args.batch_size or config["batch_size"]
+    image_res = config["image_res"]
+
+    torch.manual_seed(args.seed)
+    image = torch.randn(batch_size, 3, image_res, image_res, device=device)
+    text = tokenizer(
+        ["a picture of something on a table"] * batch_size,
+        padding="longest",
+        return_tensors="pt",
+    ).to(device)
+
+    stats = {"encoders": encoder_throughput(args, config, image, device)}
+    print("images per second", json.dumps(stats["encoders"], indent=2))
+    stats["pretrain"] = pretrain_throughput(
+        args, config, tokenizer, image, text, device
+    )
+    print("images per second", json.dumps(stats["pretrain"], indent=2))
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Training throughput of the online and momentum ViT, and of "
+        "whole pretraining steps, over patch_keep_ratio / patch_keep_ratio_m"
+    )
+    parser.add_argument("--config", default="./configs/Pretrain.yaml")
+    parser.add_argument("--output_dir", default="output/Patch_keep_benchmark")
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision of the training steps",
+    )
+    parser.add_argument(
+        "--batch_size", default=0, type=int, help="defaults to the config batch_size"
+    )
+    parser.add_argument(
+        "--keep_ratios",
+        nargs="+",
+        default=[1.0, 0.75, 0.5],
+        type=float,
+        help="patch_keep_ratio of the online ViT",
+    )
+    parser.add_argument(
+        "--keep_ratios_m",
+        nargs="+",
+        default=[1.0, 0.5],
+        type=float,
+        help="patch_keep_ratio_m of the momentum ViT",
+    )
+    parser.add_argument("--num_iters", default=10, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
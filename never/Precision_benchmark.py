@@ -0,0 +1,123 @@
+import argparse
+import json
+import math
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+import utils
+from models.model_pretrain import ALBEF
+from models.tokenization_bert import BertTokenizer
+
+
+def train_steps(model, optimizer, scaler, batches, precision, device):
+    """Losses of one training step per batch, and the steps per second."""
+    losses = []
+    start_time = time.time()
+    for image, image_aug, text in batches:
+        with utils.get_autocast(precision, device):
+            loss_mlm, loss_ita, loss_itm = model(
+                image, image_aug, text, alpha=0.4, neg_thresh=0
+            )
+        optimizer.zero_grad()
+        scaler.scale(loss_mlm + loss_ita + loss_itm).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        losses.append([loss_mlm.item(), loss_ita.item(), loss_itm.item()])
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return losses, len(batches) / (time.time() - start_time)
+
+
+def main(args, config):
+    device = torch.device(args.device)
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+    batch_size = args.batch_size or config["batch_size"]
+    image_res = config["image_res"]
+
+    torch.manual_seed(args.seed)
+    text = tokenizer(
+        ["a picture of something on a table"] * batch_size,
+        padding="longest",
+        return_tensors="pt",
+    ).to(device)
+    batches = [
+        (
+            torch.randn(batch_size, 3, image_res, image_res, device=device),
+            torch.randn(batch_size, 3, image_res, image_res, device=device),
+            text,
+        )
+        for _ in range(args.num_iters)
+    ]
+
+    # the same model, batches and seed in fp32 and in the precision under test
+    stats = {}
+    for precision in ("fp32", args.precision):
+        torch.manual_seed(args.seed)
+        model = ALBEF(
+            config=config,
+            text_encoder=config["text_encoder"],
+            tokenizer=tokenizer,
+            init_deit=False,
+        ).to(device)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+        scaler = utils.create_grad_scaler(precision, device)
+        losses, steps_per_second = train_steps(
+            model, optimizer, scaler, batches, precision, device
+        )
+        stats[precision] = {"losses": losses, "steps_per_second": steps_per_second}
+        del model, optimizer
+
+    losses = stats[args.precision]["losses"]
+    finite = all(math.isfinite(loss) for step in losses for loss in step)
+    max_rel_diff = max(
+        abs(loss - ref) / max(abs(ref), 1e-6)
+        for step, ref_step in zip(losses, stats["fp32"]["losses"])
+        for loss, ref in zip(step, ref_step)
+    )
+    stats["finite"] = finite
+    stats["max_rel_diff"] = max_rel_diff
+    print(json.dumps(stats, indent=2))
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+    if not finite or max_rel_diff > args.rtol:
+        raise SystemExit(
+            "%s losses are not finite or differ from fp32 by %.3g (rtol %.3g)"
+            % (args.precision, max_rel_diff, args.rtol)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pretraining steps under --precision against fp32, failing on "
+        "non-finite losses or losses off by more than --rtol"
+    )
+    parser.add_argument("--config", default="./configs/Pretrain.yaml")
+    parser.add_argument("--output_dir", default="output/Precision_benchmark")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument(
+        "--precision",
+        default="bf16",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision compared against fp32",
+    )
+    parser.add_argument(
+        "--batch_size", default=4, type=int, help="the config batch_size if 0"
+    )
+    parser.add_argument("--num_iters", default=3, type=int)
+    parser.add_argument("--rtol", default=0.05, type=float)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
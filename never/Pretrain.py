@@ -11,13 +11,19 @@ from os.path import join
 from pathlib import Path
 
 import torch
-import torch.distributed as dist
 
 import utils
-from dataset import create_dataset, create_loader, create_sampler
+from dataset import (
+    create_dataset,
+    create_loader,
+    create_sampler,
+    pretrain_collate_fn,
+)
+from models.accumulation import grad_sync, micro_batches
 from models.model_pretrain import ALBEF
 from models.tokenization_bert import BertTokenizer
 from models.vit import interpolate_pos_embed
+from models.xbert import BertConfig
 from optim import create_optimizer
 from scheduler import create_scheduler
 
@@ -37,6 +43,9 @@ def get_metric_logger():
     metric_logger.add_meter(
         "loss_itm", utils.SmoothedValue(window_size=50, fmt="{value:.4f}")
     )
+    metric_logger.add_meter(
+        "selected_ratio", utils.SmoothedValue(window_size=50, fmt="{value:.3f}")
+    )
     return metric_logger
 
 
@@ -51,6 +60,8 @@ def train(
     scheduler,
     config,
     max_epoch,
+    precision,
+    scaler,
 ):
     # train
     model.train()
@@ -65,18 +76,21 @@ def train(
     if args.distributed:
         data_loader.sampler.set_epoch(epoch)
 
-    for i, (image, image_aug, text) in enumerate(
-        metric_logger.log_every(data_loader, print_freq, header)
-    ):
-
-        optimizer.zero_grad()
+    for i, (
+        image,
+        image_aug,
+        text_input,
+        mlm_input_ids,
+        mlm_labels,
+    ) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
 
         image = image.to(device, non_blocking=True)
         image_aug = image_aug.to(device, non_blocking=True)
-
-        text_input = tokenizer(
-            text, padding="longest", truncation=True, max_length=25, return_tensors="pt"
-        ).to(device)
+        text_input = text_input.to(device)
+        # masked by the collate in the workers, or by the model if None
+        if mlm_input_ids is not None:
+            mlm_input_ids = mlm_input_ids.to(device, non_blocking=True)
+            mlm_labels = mlm_labels.to(device, non_blocking=True)
 
         if epoch > 0:
             alpha = config["alpha"]
@@ -86,23 +100,55 @@ def train(
         # compute the negative percentage
         neg_thresh = epoch * config["neg_thresh"] / (max_epoch - 1)
 
-        loss_mlm, loss_ita, loss_itm = model(
-            image,
-            image_aug,
-            text_input,
-            alpha=alpha,
-            neg_thresh=neg_thresh,
-            epoch=epoch,
-        )
+        # the momentum update and the enqueue run once per batch, the losses
+        # and their backward per micro-batch, with the gradients reduced by
+        # the last
+        micro_batch_size = config.get("micro_batch_size")
+        chunks = micro_batches(image.size(0), micro_batch_size)
+        with utils.get_autocast(precision, device):
+            teacher = getattr(model, "module", model).teacher_step(
+                image_aug, text_input, micro_batch_size
+            )
 
-        loss = loss_mlm + loss_ita + loss_itm
+        optimizer.zero_grad()
+        losses = torch.zeros(4, device=device)
+        for j, chunk in enumerate(chunks):
+            # weighted so that the gradients add up to those of the batch mean
+            weight = image[chunk].size(0) / image.size(0)
+            with grad_sync(model, j == len(chunks) - 1):
+                with utils.get_autocast(precision, device):
+                    loss_mlm, loss_ita, loss_itm = model(
+                        image,
+                        image_aug,
+                        text_input,
+                        alpha=alpha,
+                        neg_thresh=neg_thresh,
+                        epoch=epoch,
+                        mlm_input_ids=mlm_input_ids,
+                        mlm_labels=mlm_labels,
+                        teacher=teacher,
+                        rows=chunk,
+                    )
+
+                    loss = (loss_mlm + loss_ita + loss_itm) * weight
+
+                scaler.scale(loss).backward()
+            # fraction of the pairs selected for positive learning, the others
+            # are learned as negatives
+            selected_ratio = getattr(model, "module", model).selected_ratio
+            losses += (
+                torch.stack([loss_mlm, loss_ita, loss_itm, selected_ratio]).detach()
+                * weight
+            )
 
-        loss.backward()
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
 
-        metric_logger.update(loss_mlm=loss_mlm.item())
-        metric_logger.update(loss_ita=loss_ita.item())
-        metric_logger.update(loss_itm=loss_itm.item())
+        loss_mlm, loss_ita, loss_itm, selected_ratio = losses.tolist()
+        metric_logger.update(loss_mlm=loss_mlm)
+        metric_logger.update(loss_ita=loss_ita)
+        metric_logger.update(loss_itm=loss_itm)
+        metric_logger.update(selected_ratio=selected_ratio)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
         if epoch == 0 and i % step_size == 0 and i <= warmup_iterations:
@@ -142,17 +188,26 @@ def main(args, config):
     else:
         samplers = [None]
 
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+
+    # tokenize, and unless disabled mask for MLM, in the loader workers
+    collate_fn = pretrain_collate_fn(
+        tokenizer,
+        max_length=25,
+        mlm_probability=(
+            config["mlm_probability"] if config.get("mlm_in_collate", True) else None
+        ),
+        vocab_size=BertConfig.from_json_file(config["bert_config"]).vocab_size,
+    )
     data_loader = create_loader(
         datasets,
         samplers,
         batch_size=[config["batch_size"]],
         num_workers=[4],
         is_trains=[True],
-        collate_fns=[None],
+        collate_fns=[collate_fn],
     )[0]
 
-    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
-
     #### Model ####
     print("Creating model")
     model = ALBEF(
@@ -168,6 +223,7 @@ def main(args, config):
     optimizer = create_optimizer(arg_opt, model)
     arg_sche = utils.AttrDict(config["schedular"])
     lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
+    scaler = utils.create_grad_scaler(args.precision, device)
 
     if args.checkpoint:
         checkpoint = torch.load(args.checkpoint, map_location="cpu")
@@ -175,6 +231,10 @@ def main(args, config):
         if args.resume:
             optimizer.load_state_dict(checkpoint["optimizer"])
             lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+            if "scaler" in checkpoint:
+                scaler.load_state_dict(checkpoint["scaler"])
+            if "momentum_updater" in checkpoint:
+                model.momentum_updater.load_state_dict(checkpoint["momentum_updater"])
             start_epoch = checkpoint["epoch"] + 1
         else:
             pos_embed_reshaped = interpolate_pos_embed(
@@ -188,9 +248,14 @@ def main(args, config):
         model.load_state_dict(state_dict)
         print("load checkpoint from %s" % args.checkpoint)
 
+    if args.compile:
+        utils.compile_model(model)
+
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=utils.ddp_device_ids(args)
+        )
         model_without_ddp = model.module
 
     print("Start training")
@@ -213,6 +278,8 @@ def main(args, config):
             lr_scheduler,
             config,
             max_epoch,
+            precision=args.precision,
+            scaler=scaler,
         )
         if utils.is_main_process():
             log_stats = {
@@ -223,6 +290,8 @@ def main(args, config):
                 "model": model_without_ddp.state_dict(),
                 "optimizer": optimizer.state_dict(),
                 "lr_scheduler": lr_scheduler.state_dict(),
+                "scaler": scaler.state_dict(),
+                "momentum_updater": model_without_ddp.momentum_updater.state_dict(),
                 "config": config,
                 "epoch": epoch,
             }
@@ -232,7 +301,7 @@ def main(args, config):
             with open(join(args.output_dir, "log.txt"), "a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
-        dist.barrier()
+        utils.barrier()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -278,12 +347,29 @@ if __name__ == "__main__":
 
     # env setting
     parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision for training and evaluation",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the encoders and loss blocks",
+    )
     parser.add_argument(
         "--world_size", default=1, type=int, help="number of distributed processes"
     )
     parser.add_argument(
         "--dist_url", default="env://", help="url used to set up distributed training"
     )
+    parser.add_argument(
+        "--dist_backend",
+        default=None,
+        choices=["nccl", "gloo"],
+        help="defaults to nccl on cuda and gloo on cpu",
+    )
     parser.add_argument("--distributed", default=True, type=bool)
 
     args = parser.parse_args()
@@ -10,7 +10,6 @@ import numpy as np
 import ruamel.yaml as yaml
 import torch
 import torch.backends.cudnn as cudnn
-import torch.distributed as dist
 
 import utils
 from dataset import create_dataset, create_loader, create_sampler
@@ -22,7 +21,17 @@ from scheduler import create_scheduler
 
 
 def train(
-    model, data_loader, optimizer, tokenizer, epoch, warmup_steps, device, scheduler,
+    model,
+    data_loader,
+    optimizer,
+    tokenizer,
+    epoch,
+    warmup_steps,
+    device,
+    scheduler,
+    config,
+    precision,
+    scaler,
 ):
     # train
     model.train()
@@ -54,10 +63,12 @@ def train(
             text, padding="longest", truncation=True, max_length=25, return_tensors="pt"
         ).to(device)
 
-        loss = model(image, text_input)
-        loss.backward()
+        with utils.get_autocast(precision, device):
+            loss = model(image, text_input)
+        scaler.scale(loss).backward()
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
 
         metric_logger.update(loss=loss.item())
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
@@ -138,6 +149,7 @@ def main(args, config):
     optimizer = create_optimizer(arg_opt, model)
     arg_sche = utils.AttrDict(config["schedular"])
     lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
+    scaler = utils.create_grad_scaler(args.precision, device)
 
     if args.checkpoint:
         checkpoint = torch.load(args.checkpoint, map_location="cpu")
@@ -173,10 +185,13 @@ def main(args, config):
         print("load checkpoint from %s" % args.checkpoint)
         print(msg)
 
+    if args.compile:
+        utils.compile_model(model)
+
     model_without_ddp = model
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[args.gpu], find_unused_parameters=True
+            model, device_ids=utils.ddp_device_ids(args), find_unused_parameters=True
         )
         model_without_ddp = model.module
 
@@ -198,6 +213,8 @@ def main(args, config):
             device,
             lr_scheduler,
             config,
+            precision=args.precision,
+            scaler=scaler,
         )
 
         if utils.is_main_process():
@@ -219,7 +236,7 @@ def main(args, config):
             with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
-        dist.barrier()
+        utils.barrier()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -232,6 +249,17 @@ if __name__ == "__main__":
     parser.add_argument("--checkpoint", default="")
     parser.add_argument("--output_dir", default="output/NLVR_pretrain")
     parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision for training and evaluation",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the encoders and loss blocks",
+    )
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument(
         "--world_size", default=1, type=int, help="number of distributed processes"
@@ -239,6 +267,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dist_url", default="env://", help="url used to set up distributed training"
     )
+    parser.add_argument(
+        "--dist_backend",
+        default=None,
+        choices=["nccl", "gloo"],
+        help="defaults to nccl on cuda and gloo on cpu",
+    )
     parser.add_argument("--distributed", default=True, type=bool)
     args = parser.parse_args()
 
@@ -0,0 +1,252 @@
+import argparse
+import copy
+import itertools
+import json
+import os
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+import utils
+from dataset import create_dataset, create_loader, vqa_collate_fn
+from models.pruning import (
+    accumulate_importance,
+    compute_pruning,
+    prunable_modules,
+    prune_model,
+)
+from models.tokenization_bert import BertTokenizer
+from models.vit import interpolate_pos_embed
+from Quantize import evaluate_retrieval, evaluate_vqa
+
+
+def calibration_loss(model, batch, tokenizer, device, config, task):
+    if task == "retrieval":
+        image, image_aug, text, idx = batch
+        text_input = tokenizer(
+            text, padding="longest", max_length=30, return_tensors="pt"
+        ).to(device)
+        loss_ita, loss_itm = model(
+            image.to(device),
+            image_aug.to(device),
+            text_input,
+            alpha=config["alpha"],
+            idx=idx.to(device),
+        )
+        return loss_ita + loss_itm
+
+    image, question, answer, weights, n = batch
+    question_input = tokenizer(
+        question,
+        padding="longest",
+        truncation=True,
+        max_length=25,
+        return_tensors="pt",
+    ).to(device)
+    answer_input = tokenizer(answer, padding="longest", return_tensors="pt").to(device)
+    return model(
+        image.to(device),
+        question_input,
+        answer_input,
+        train=True,
+        alpha=config["alpha"],
+        k=n,
+        weights=weights.to(device),
+    )
+
+
+def count_parameters(model):
+    heads, mlps = prunable_modules(model)
+    return sum(
+        p.numel()
+        for m in list(heads.values()) + list(mlps.values())
+        for p in m.parameters()
+    )
+
+
+def tradeoff_curve(results, metric):
+    """Accuracy / latency points of the pruning ratios, relative to the unpruned model.
+
+    Every point gives the fraction of the prunable parameters kept, the speedup
+    of the evaluation and the change of metric. The metric is None if the
+    test split has no ground truth (VQA test-dev).
+    """
+    base = results[0]
+    curve = []
+    for stats in results:
+        value = stats.get(metric)
+        delta = None
+        if value is not None and base.get(metric) is not None:
+            delta = value - base[metric]
+        curve.append(
+            {
+                "ratio": stats["ratio"],
+                "params_kept": stats["params"] / base["params"],
+                "latency_per_batch_ms": stats["latency_per_batch_ms"],
+                "speedup": base["latency"] / stats["latency"],
+                metric: value,
+                "delta": delta,
+            }
+        )
+    return curve
+
+
+def main(args, config):
+    device = torch.device(args.device)
+    utils.set_seed(args.seed)
+
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+
+    print("Creating %s datasets and model" % args.task)
+    if args.task == "retrieval":
+        from models.model_retrieval import ALBEF
+
+        datasets = create_dataset("re", config)
+        collate_fn = None
+        model = ALBEF(
+            config=config, text_encoder=config["text_encoder"], tokenizer=tokenizer
+        )
+        evaluate = evaluate_retrieval
+    else:
+        from models.model_vqa import ALBEF
+
+        datasets = create_dataset("vqa", config)
+        collate_fn = vqa_collate_fn
+        model = ALBEF(
+            config=config,
+            text_encoder=config["text_encoder"],
+            text_decoder=config["text_decoder"],
+            tokenizer=tokenizer,
+        )
+        evaluate = evaluate_vqa
+
+    calib_loader, test_loader = create_loader(
+        [datasets[0], datasets[-1]],
+        [None, None],
+        batch_size=[config["batch_size_train"], config["batch_size_test"]],
+        num_workers=[4, 4],
+        is_trains=[True, False],
+        collate_fns=[collate_fn, None],
+    )
+
+    if args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        state_dict = checkpoint["model"]
+        state_dict["visual_encoder.pos_embed"] = interpolate_pos_embed(
+            state_dict["visual_encoder.pos_embed"], model.visual_encoder
+        )
+        if "pruning" in checkpoint:
+            prune_model(model, checkpoint["pruning"])
+        msg = model.load_state_dict(state_dict, strict=False)
+        print("load checkpoint from %s" % args.checkpoint)
+        print(msg)
+
+    model = model.to(device)
+
+    #### Head and channel importance ####
+    # the training forward also updates the momentum encoders and the queues,
+    # so the calibration runs on a copy and the model itself is left untouched
+    print("Scoring heads and MLP channels on %d batches" % args.calib_batches)
+    calib_model = copy.deepcopy(model).eval()
+    importance = {}
+    for batch in itertools.islice(calib_loader, args.calib_batches):
+        loss = calibration_loss(
+            calib_model, batch, tokenizer, device, config, args.task
+        )
+        loss.backward()
+        accumulate_importance(calib_model, importance)
+
+    prunings = {}
+    for ratio in args.ratios:
+        prunings[ratio] = compute_pruning(
+            calib_model,
+            importance,
+            head_ratio=ratio if "heads" in args.targets else 0,
+            mlp_ratio=ratio if "mlp" in args.targets else 0,
+        )
+    del calib_model, importance
+
+    #### Accuracy / latency trade-off ####
+    results = []
+    for ratio in [0.0] + args.ratios:
+        if ratio > 0:
+            pruned = prune_model(copy.deepcopy(model), prunings[ratio])
+        else:
+            pruned = model
+
+        with torch.no_grad():
+            result, eval_time = evaluate(pruned, test_loader, tokenizer, device, config)
+        stats = {
+            "ratio": ratio,
+            "params": count_parameters(pruned),
+            **{k: v for k, v in result.items() if v is not None},
+            "latency": eval_time,
+            "latency_per_batch_ms": eval_time / len(test_loader) * 1000,
+        }
+        results.append(stats)
+        print(json.dumps(stats))
+
+        if ratio > 0:
+            save_obj = {
+                "model": pruned.state_dict(),
+                "pruning": prunings[ratio],
+                "config": config,
+            }
+            torch.save(
+                save_obj,
+                os.path.join(args.output_dir, "checkpoint_pruned_%g.pth" % ratio),
+            )
+            del pruned
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        for stats in results:
+            f.write(json.dumps(stats) + "\n")
+
+    metric = args.metric or ("r_mean" if args.task == "retrieval" else "vqa_acc")
+    curve = tradeoff_curve(results, metric)
+    print("Accuracy / latency trade-off (%s)" % metric)
+    for point in curve:
+        print(json.dumps(point))
+    with open(os.path.join(args.output_dir, "tradeoff.json"), "w") as f:
+        json.dump({"metric": metric, "curve": curve}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", default="retrieval", choices=["retrieval", "vqa"])
+    parser.add_argument("--config", default="./configs/Retrieval_flickr.yaml")
+    parser.add_argument("--output_dir", default="output/Prune")
+    parser.add_argument("--checkpoint", default="")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--ratios",
+        nargs="+",
+        type=float,
+        default=[0.1, 0.2, 0.3, 0.5],
+        help="fraction of heads / MLP channels removed in every block, one checkpoint each",
+    )
+    parser.add_argument(
+        "--targets", nargs="+", default=["heads", "mlp"], choices=["heads", "mlp"]
+    )
+    parser.add_argument(
+        "--metric",
+        default="",
+        help="accuracy of the trade-off curve, r_mean or vqa_acc by default",
+    )
+    parser.add_argument(
+        "--calib_batches",
+        default=50,
+        type=int,
+        help="training batches used to score the heads and channels",
+    )
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
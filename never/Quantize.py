@@ -0,0 +1,183 @@
+import argparse
+import io
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+from dataset import create_dataset, create_loader
+from models.quantization import (
+    DEFAULT_SKIP,
+    quantizable_linears,
+    quantize_dynamic,
+    strip_momentum,
+)
+from models.pruning import prune_model
+from models.tokenization_bert import BertTokenizer
+from models.vit import interpolate_pos_embed
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024**2
+
+
+def vqa_accuracy(result, anns):
+    """Standard VQA accuracy, min(#humans that gave the answer / 3, 1)."""
+    answers = {ann["question_id"]: ann["answer"] for ann in anns if "answer" in ann}
+    if not answers:
+        return None
+    acc = [
+        min(answers[res["question_id"]].count(res["answer"]) / 3, 1.0)
+        for res in result
+        if res["question_id"] in answers
+    ]
+    return 100.0 * sum(acc) / len(acc)
+
+
+def evaluate_retrieval(model, data_loader, tokenizer, device, config):
+    from Retrieval import evaluation, itm_eval
+
+    start_time = time.time()
+    score_i2t, score_t2i = evaluation(model, data_loader, tokenizer, device, config)
+    eval_time = time.time() - start_time
+    result = itm_eval(
+        score_i2t,
+        score_t2i,
+        data_loader.dataset.txt2img,
+        data_loader.dataset.img2txt,
+    )
+    return result, eval_time
+
+
+def evaluate_vqa(model, data_loader, tokenizer, device, config):
+    from VQA import evaluation
+
+    start_time = time.time()
+    vqa_result = evaluation(model, data_loader, tokenizer, device, config)
+    eval_time = time.time() - start_time
+    result = {"vqa_acc": vqa_accuracy(vqa_result, data_loader.dataset.ann)}
+    return result, eval_time
+
+
+def main(args, config):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+
+    print("Creating %s dataset and model" % args.task)
+    if args.task == "retrieval":
+        from models.model_retrieval import ALBEF
+
+        test_dataset = create_dataset("re", config)[-1]
+        model = ALBEF(
+            config=config, text_encoder=config["text_encoder"], tokenizer=tokenizer
+        )
+        evaluate = evaluate_retrieval
+    else:
+        from models.model_vqa import ALBEF
+
+        test_dataset = create_dataset("vqa", config)[-1]
+        model = ALBEF(
+            config=config,
+            text_encoder=config["text_encoder"],
+            text_decoder=config["text_decoder"],
+            tokenizer=tokenizer,
+        )
+        evaluate = evaluate_vqa
+
+    test_loader = create_loader(
+        [test_dataset],
+        [None],
+        batch_size=[config["batch_size_test"]],
+        num_workers=[4],
+        is_trains=[False],
+        collate_fns=[None],
+    )[0]
+
+    if args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        state_dict = checkpoint["model"]
+        state_dict["visual_encoder.pos_embed"] = interpolate_pos_embed(
+            state_dict["visual_encoder.pos_embed"], model.visual_encoder
+        )
+        if "pruning" in checkpoint:
+            prune_model(model, checkpoint["pruning"])
+        msg = model.load_state_dict(state_dict, strict=False)
+        print("load checkpoint from %s" % args.checkpoint)
+        print(msg)
+
+    model = strip_momentum(model).eval()
+
+    print(
+        "Quantizing %d Linear layers, kept in fp32: %s"
+        % (len(quantizable_linears(model, args.skip)), ", ".join(args.skip))
+    )
+    model_q = quantize_dynamic(model, skip=args.skip)
+
+    save_obj = {
+        "model": model_q.state_dict(),
+        "config": config,
+        "skip": args.skip,
+        "pruning": checkpoint.get("pruning") if args.checkpoint else None,
+    }
+    torch.save(save_obj, os.path.join(args.output_dir, "checkpoint_int8.pth"))
+
+    stats = {"size_fp32": model_size(model), "size_int8": model_size(model_q)}
+    if not args.skip_eval:
+        with torch.no_grad():
+            result_fp32, time_fp32 = evaluate(
+                model.to(device), test_loader, tokenizer, device, config
+            )
+            result_int8, time_int8 = evaluate(
+                model_q.to(device), test_loader, tokenizer, device, config
+            )
+        for k in result_fp32:
+            if result_fp32[k] is None:
+                continue
+            stats[k + "_fp32"] = result_fp32[k]
+            stats[k + "_int8"] = result_int8[k]
+            stats[k + "_delta"] = round(result_int8[k] - result_fp32[k], 4)
+        stats["latency_fp32"] = time_fp32
+        stats["latency_int8"] = time_int8
+        stats["speedup"] = time_fp32 / time_int8
+
+    print(json.dumps(stats, indent=2))
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", default="retrieval", choices=["retrieval", "vqa"])
+    parser.add_argument("--config", default="./configs/Retrieval_flickr.yaml")
+    parser.add_argument("--output_dir", default="output/Quantize")
+    parser.add_argument("--checkpoint", default="")
+    # dynamic int8 kernels only exist for the cpu backends
+    parser.add_argument("--device", default="cpu", choices=["cpu"])
+    parser.add_argument(
+        "--skip",
+        nargs="*",
+        default=DEFAULT_SKIP,
+        help="module name patterns whose Linear layers stay in fp32",
+    )
+    parser.add_argument(
+        "--skip_eval",
+        action="store_true",
+        help="only save the quantized checkpoint, do not compare with fp32",
+    )
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
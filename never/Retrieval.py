@@ -15,7 +15,9 @@ import torch.nn.functional as F
 
 import utils
 from dataset import create_dataset, create_loader, create_sampler
+from models.accumulation import grad_sync, micro_batches
 from models.model_retrieval import ALBEF
+from models.pruning import prune_model
 from models.tokenization_bert import BertTokenizer
 from models.vit import interpolate_pos_embed
 from optim import create_optimizer
@@ -32,6 +34,8 @@ def train(
     device,
     scheduler,
     config,
+    precision,
+    scaler,
 ):
     # train
     model.train()
@@ -64,16 +68,45 @@ def train(
         else:
             alpha = config["alpha"] * min(1, i / len(data_loader))
 
-        loss_ita, loss_itm = model(image, image_aug, text_input, alpha=alpha, idx=idx)
-        loss = loss_ita + loss_itm
+        # the momentum update and the enqueue run once per batch, the losses
+        # and their backward per micro-batch, with the gradients reduced by
+        # the last
+        micro_batch_size = config.get("micro_batch_size")
+        chunks = micro_batches(image.size(0), micro_batch_size)
+        with utils.get_autocast(precision, device):
+            teacher = getattr(model, "module", model).teacher_step(
+                image_aug, text_input, idx, micro_batch_size
+            )
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        losses = torch.zeros(2, device=device)
+        for j, chunk in enumerate(chunks):
+            # weighted so that the gradients add up to those of the batch mean
+            weight = image[chunk].size(0) / image.size(0)
+            with grad_sync(model, j == len(chunks) - 1):
+                with utils.get_autocast(precision, device):
+                    loss_ita, loss_itm = model(
+                        image,
+                        image_aug,
+                        text_input,
+                        alpha=alpha,
+                        idx=idx,
+                        teacher=teacher,
+                        rows=chunk,
+                    )
+                    loss = (loss_ita + loss_itm) * weight
+
+                scaler.scale(loss).backward()
+            losses += torch.stack([loss_ita, loss_itm]).detach() * weight
 
-        metric_logger.update(loss_itm=loss_itm.item())
-        metric_logger.update(loss_ita=loss_ita.item())
+        scaler.step(optimizer)
+        scaler.update()
+
+        loss_ita, loss_itm = losses.tolist()
+        metric_logger.update(loss_itm=loss_itm)
+        metric_logger.update(loss_ita=loss_ita)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+
         if epoch == 0 and i % step_size == 0 and i <= warmup_iterations:
             scheduler.step(i // step_size)
 
@@ -143,31 +176,28 @@ def evaluation(model, data_loader, tokenizer, device, config):
         (len(data_loader.dataset.image), len(texts)), -100.0
     ).to(device)
 
+    # (query, candidate) pairs of all the queries are re-ranked in fusion
+    # batches of rerank_batch_size pairs, k_test (one query) by default
+    k_test = config["k_test"]
+    rerank_batch_size = config.get("rerank_batch_size") or k_test
+
     num_tasks = utils.get_world_size()
     rank = utils.get_rank()
     step = sims_matrix.size(0) // num_tasks + 1
     start = rank * step
     end = min(sims_matrix.size(0), start + step)
 
-    for i, sims in enumerate(
-        metric_logger.log_every(sims_matrix[start:end], 50, header)
-    ):
-        topk_sim, topk_idx = sims.topk(k=config["k_test"], dim=0)
-
-        encoder_output = image_feats[start + i].repeat(config["k_test"], 1, 1)
-        encoder_att = torch.ones(encoder_output.size()[:-1], dtype=torch.long).to(
-            device
-        )
-        output = model.text_encoder(
-            encoder_embeds=text_feats[topk_idx],
-            attention_mask=text_atts[topk_idx],
-            encoder_hidden_states=encoder_output,
-            encoder_attention_mask=encoder_att,
-            return_dict=True,
-            mode="fusion",
-        )
-        score = model.itm_head(output.last_hidden_state[:, 0, :])[:, 1]
-        score_matrix_i2t[start + i, topk_idx] = score
+    rerank(
+        model,
+        score_matrix_i2t,
+        sims_matrix[start:end],
+        start,
+        k_test,
+        rerank_batch_size,
+        lambda rows, cols: (text_feats[cols], text_atts[cols], image_feats[rows]),
+        metric_logger,
+        header,
+    )
 
     sims_matrix = sims_matrix.t()
     score_matrix_t2i = torch.full(
@@ -178,27 +208,19 @@ def evaluation(model, data_loader, tokenizer, device, config):
     start = rank * step
     end = min(sims_matrix.size(0), start + step)
 
-    for i, sims in enumerate(
-        metric_logger.log_every(sims_matrix[start:end], 50, header)
-    ):
-
-        topk_sim, topk_idx = sims.topk(k=config["k_test"], dim=0)
-        encoder_output = image_feats[topk_idx]
-        encoder_att = torch.ones(encoder_output.size()[:-1], dtype=torch.long).to(
-            device
-        )
-        output = model.text_encoder(
-            encoder_embeds=text_feats[start + i].repeat(config["k_test"], 1, 1),
-            attention_mask=text_atts[start + i].repeat(config["k_test"], 1),
-            encoder_hidden_states=encoder_output,
-            encoder_attention_mask=encoder_att,
-            return_dict=True,
-            mode="fusion",
-        )
-        score = model.itm_head(output.last_hidden_state[:, 0, :])[:, 1]
-        score_matrix_t2i[start + i, topk_idx] = score
+    rerank(
+        model,
+        score_matrix_t2i,
+        sims_matrix[start:end],
+        start,
+        k_test,
+        rerank_batch_size,
+        lambda rows, cols: (text_feats[rows], text_atts[rows], image_feats[cols]),
+        metric_logger,
+        header,
+    )
 
-    if args.distributed:
+    if utils.is_dist_avail_and_initialized():
         dist.barrier()
         torch.distributed.all_reduce(
             score_matrix_i2t, op=torch.distributed.ReduceOp.SUM
@@ -214,6 +236,52 @@ def evaluation(model, data_loader, tokenizer, device, config):
     return score_matrix_i2t.cpu().numpy(), score_matrix_t2i.cpu().numpy()
 
 
+@torch.no_grad()
+def rerank(
+    model,
+    score_matrix,
+    sims,
+    row_start,
+    k_test,
+    batch_size,
+    fusion_inputs,
+    metric_logger,
+    header,
+):
+    """Write the ITM scores of the k_test most similar candidates of every query.
+
+    The (query, candidate) pairs of all the queries are packed into fusion
+    batches of batch_size pairs, whatever query they belong to, and the scores
+    of a batch are written back with one indexed write.
+
+    Args:
+        score_matrix (tensor): (num_queries, num_candidates) scores, filled in place
+        sims (tensor): (num_rows, num_candidates) similarities of the queries
+            from row_start on
+        fusion_inputs (callable): text embeds, text attention mask and image
+            embeds of the pairs, given their rows and columns in score_matrix
+    """
+    topk_idx = sims.topk(k=k_test, dim=1).indices
+    rows = torch.arange(row_start, row_start + sims.size(0), device=sims.device)
+    rows = rows.repeat_interleave(topk_idx.size(1))
+    cols = topk_idx.flatten()
+
+    batches = range(0, rows.size(0), batch_size)
+    for start in metric_logger.log_every(batches, 50, header):
+        batch_rows = rows[start : start + batch_size]
+        batch_cols = cols[start : start + batch_size]
+        text_embeds, text_atts, image_embeds = fusion_inputs(batch_rows, batch_cols)
+        output = model.text_encoder(
+            encoder_embeds=text_embeds,
+            attention_mask=text_atts,
+            encoder_hidden_states=image_embeds,
+            return_dict=True,
+            mode="fusion",
+        )
+        score = model.itm_head(output.last_hidden_state[:, 0, :])[:, 1]
+        score_matrix[batch_rows, batch_cols] = score
+
+
 @torch.no_grad()
 def itm_eval(scores_i2t, scores_t2i, txt2img, img2txt):
 
@@ -326,22 +394,32 @@ def main(args, config):
                 encoder_key = key.replace("bert.", "")
                 state_dict[encoder_key] = state_dict[key]
                 del state_dict[key]
+        if "pruning" in checkpoint:
+            prune_model(model, checkpoint["pruning"])
         msg = model.load_state_dict(state_dict, strict=False)
+        if "momentum_updater" in checkpoint:
+            model.momentum_updater.load_state_dict(checkpoint["momentum_updater"])
 
         print("load checkpoint from %s" % args.checkpoint)
         print(msg)
 
     model = model.to(device)
 
+    if args.compile:
+        utils.compile_model(model)
+
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=utils.ddp_device_ids(args)
+        )
         model_without_ddp = model.module
 
     arg_opt = utils.AttrDict(config["optimizer"])
     optimizer = create_optimizer(arg_opt, model)
     arg_sche = utils.AttrDict(config["schedular"])
     lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
+    scaler = utils.create_grad_scaler(args.precision, device)
 
     max_epoch = config["schedular"]["epochs"]
     warmup_steps = config["schedular"]["warmup_epochs"]
@@ -364,14 +442,17 @@ def main(args, config):
                 device,
                 lr_scheduler,
                 config,
+                precision=args.precision,
+                scaler=scaler,
             )
 
-        score_val_i2t, score_val_t2i, = evaluation(
-            model_without_ddp, val_loader, tokenizer, device, config
-        )
-        score_test_i2t, score_test_t2i = evaluation(
-            model_without_ddp, test_loader, tokenizer, device, config
-        )
+        with utils.get_autocast(args.precision, device):
+            score_val_i2t, score_val_t2i, = evaluation(
+                model_without_ddp, val_loader, tokenizer, device, config
+            )
+            score_test_i2t, score_test_t2i = evaluation(
+                model_without_ddp, test_loader, tokenizer, device, config
+            )
 
         if utils.is_main_process():
 
@@ -413,6 +494,7 @@ def main(args, config):
                         "model": model_without_ddp.state_dict(),
                         "optimizer": optimizer.state_dict(),
                         "lr_scheduler": lr_scheduler.state_dict(),
+                        "momentum_updater": model_without_ddp.momentum_updater.state_dict(),
                         "config": config,
                         "epoch": epoch,
                     }
@@ -426,7 +508,7 @@ def main(args, config):
             break
 
         lr_scheduler.step(epoch + warmup_steps + 1)
-        dist.barrier()
+        utils.barrier()
         torch.cuda.empty_cache()
 
     total_time = time.time() - start_time
@@ -445,6 +527,17 @@ if __name__ == "__main__":
     parser.add_argument("--checkpoint", default="")
     parser.add_argument("--evaluate", action="store_true")
     parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision for training and evaluation",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the encoders and loss blocks",
+    )
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument(
         "--world_size", default=1, type=int, help="number of distributed processes"
@@ -452,6 +545,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dist_url", default="env://", help="url used to set up distributed training"
     )
+    parser.add_argument(
+        "--dist_backend",
+        default=None,
+        choices=["nccl", "gloo"],
+        help="defaults to nccl on cuda and gloo on cpu",
+    )
     parser.add_argument("--distributed", default=True, type=bool)
     args = parser.parse_args()
 
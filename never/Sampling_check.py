@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from statistics import NormalDist
+
+import torch
+import torch.nn.functional as F
+
+from models.albef import sample_negatives
+
+
+def loop_negatives(weights):
+    """The sampling of the models before sample_negatives: a multinomial per row."""
+    neg_idx = []
+    for b in range(weights.size(0)):
+        neg_idx.append(torch.multinomial(weights[b], 1).item())
+    return torch.tensor(neg_idx, device=weights.device)
+
+
+def draw_counts(sample, weights, num_draws):
+    """(bs, bs) number of times each column is drawn as the negative of each row."""
+    bs = weights.size(0)
+    counts = torch.zeros(bs, bs, dtype=torch.long, device=weights.device)
+    rows = torch.arange(bs, device=weights.device)
+    for _ in range(num_draws):
+        counts[rows, sample(weights)] += 1
+    return counts.cpu()
+
+
+def chi2_critical(dof, alpha):
+    """Wilson-Hilferty approximation of the 1 - alpha quantile of chi2(dof)."""
+    z = NormalDist().inv_cdf(1 - alpha)
+    return dof * (1 - 2 / (9 * dof) + z * (2 / (9 * dof)) ** 0.5) ** 3
+
+
+def two_sample_chi2(counts, ref_counts):
+    """Chi-square statistic and degrees of freedom of two equal-size count rows."""
+    seen = (counts + ref_counts) > 0
+    a, b = counts[seen].double(), ref_counts[seen].double()
+    return ((a - b) ** 2 / (a + b)).sum().item(), int(seen.sum()) - 1
+
+
+def one_sample_chi2(counts, probs):
+    """Chi-square statistic and degrees of freedom of a count row against probs."""
+    support = probs > 0
+    expected = probs[support].double() * counts.sum()
+    observed = counts[support].double()
+    stat = ((observed - expected) ** 2 / expected).sum().item()
+    if (counts[~support] > 0).any():
+        stat = float("inf")
+    return stat, int(support.sum()) - 1
+
+
+def hard_negative_weights(bs, positives, device):
+    """Softmax of random similarities with the positives zeroed, as in the models."""
+    weights = F.softmax(torch.randn(bs, bs, device=device) / 0.2, dim=1)
+    return weights.masked_fill(positives, 0)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    bs = args.batch_size
+    eye = torch.eye(bs, dtype=torch.bool, device=device)
+    # retrieval: two captions per image, the same-idx pairs are positives
+    idx = torch.arange(bs, device=device).view(-1, 1) // 2
+    same_idx = torch.eq(idx, idx.T)
+
+    # the batched sampler against the loop, on rows the loop can draw from
+    cases = {
+        "pretrain": (hard_negative_weights(bs, eye, device), None),
+        "retrieval": (hard_negative_weights(bs, same_idx, device), same_idx),
+    }
+    tests = []
+    positives_drawn = 0
+    for name, (weights, positives) in cases.items():
+        counts = draw_counts(
+            lambda w: sample_negatives(w, positives), weights, args.num_draws
+        )
+        ref_counts = draw_counts(loop_negatives, weights, args.num_draws)
+        mask = eye if positives is None else positives
+        positives_drawn += int(counts[mask.cpu()].sum())
+        for row in range(bs):
+            tests.append((name, row) + two_sample_chi2(counts[row], ref_counts[row]))
+
+    # rows without weights, which the loop cannot draw from, against the
+    # uniform distribution over their negatives
+    weights = hard_negative_weights(bs, same_idx, device)
+    weights[0] = 0
+    weights[1] = float("nan")
+    counts = draw_counts(
+        lambda w: sample_negatives(w, same_idx), weights, args.num_draws
+    )
+    negatives = (~same_idx).double().cpu()
+    for row in (0, 1):
+        probs = negatives[row] / negatives[row].sum()
+        tests.append(("fallback", row) + one_sample_chi2(counts[row], probs))
+
+    # a batch of a single image id has no negatives, the other samples are drawn
+    weights = torch.zeros(bs, bs, device=device)
+    positives = torch.ones(bs, bs, dtype=torch.bool, device=device)
+    counts = draw_counts(
+        lambda w: sample_negatives(w, positives), weights, args.num_draws
+    )
+    others = (~eye).double().cpu()
+    for row in range(bs):
+        probs = others[row] / others[row].sum()
+        tests.append(("single_id", row) + one_sample_chi2(counts[row], probs))
+
+    # one level for all the tests (Bonferroni)
+    alpha = args.alpha / len(tests)
+    stats = {"positives_drawn": positives_drawn}
+    ok = positives_drawn == 0
+    for name, row, stat, dof in tests:
+        ratio = stat / chi2_critical(dof, alpha)
+        stats[name] = max(stats.get(name, 0.0), ratio)
+        ok = ok and ratio <= 1
+    print("max chi2 / critical value", json.dumps(stats, indent=2))
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(dict(stats, ok=ok)) + "\n")
+    if not ok:
+        raise SystemExit("sample_negatives differs from the expected distribution")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Chi-square tests of the batched ITM negative sampler against "
+        "the per-row multinomial loop, and of its fallback for rows without weights"
+    )
+    parser.add_argument("--output_dir", default="output/Sampling_check")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--num_draws", default=20000, type=int)
+    parser.add_argument(
+        "--alpha", default=0.01, type=float, help="level of the tests as a whole"
+    )
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    main(args)
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+
+import utils
+from models.model_pretrain import ALBEF
+from models.tokenization_bert import BertTokenizer
+
+
+def teacher_modes(args):
+    """Momentum teacher settings compared, as config overrides."""
+    return {
+        "full": {},
+        "bf16": {"momentum_dtype": "bf16"},
+        "reduced_res": {"teacher_image_res": args.teacher_image_res},
+        "bf16+reduced_res": {
+            "momentum_dtype": "bf16",
+            "teacher_image_res": args.teacher_image_res,
+        },
+    }
+
+
+def momentum_nbytes(model):
+    return sum(
+        param.numel() * param.element_size()
+        for model_m in model.model_pairs
+        for param in model_m[1].parameters()
+    )
+
+
+def benchmark(model, optimizer, scaler, batches, num_iters, precision, device):
+    """Training steps per second, one step per batch as in Pretrain.py.
+
+    The batches are taken in turn, after a first step that is not timed.
+    """
+
+    def step(i):
+        image, image_aug, text = batches[i % len(batches)]
+        with utils.get_autocast(precision, device):
+            loss_mlm, loss_ita, loss_itm = model(
+                image, image_aug, text, alpha=0.4, neg_thresh=0
+            )
+        optimizer.zero_grad()
+        scaler.scale(loss_mlm + loss_ita + loss_itm).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    step(0)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for i in range(1, num_iters + 1):
+        step(i)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    stats = {"steps_per_second": num_iters / (time.time() - start_time)}
+    if device.type == "cuda":
+        stats["peak_memory_MB"] = torch.cuda.max_memory_allocated() / 2**20
+    return stats
+
+
+def main(args, config):
+    device = torch.device(args.device)
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+    batch_size = args.batch_size or config["batch_size"]
+    image_res = config["image_res"]
+
+    torch.manual_seed(args.seed)
+    text = tokenizer(
+        ["a picture of something on a table"] * batch_size,
+        padding="longest",
+        return_tensors="pt",
+    ).to(device)
+    batches = [
+        (
+            torch.randn(batch_size, 3, image_res, image_res, device=device),
+            torch.randn(batch_size, 3, image_res, image_res, device=device),
+            text,
+        )
+        for _ in range(args.num_batches)
+    ]
+
+    stats = {}
+    for name, overrides in teacher_modes(args).items():
+        mode_config = dict(config, **overrides)
+        torch.manual_seed(args.seed)
+        model = ALBEF(
+            config=mode_config,
+            text_encoder=config["text_encoder"],
+            tokenizer=tokenizer,
+            init_deit=False,
+        ).to(device)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+        scaler = utils.create_grad_scaler(args.precision, device)
+        stats[name] = benchmark(
+            model, optimizer, scaler, batches, args.num_iters, args.precision, device
+        )
+        stats[name]["momentum_params_MB"] = momentum_nbytes(model) / 2**20
+        print(name, json.dumps(stats[name], indent=2))
+        del model, optimizer
+
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Training throughput and memory of the full, bf16 and reduced "
+        "resolution momentum teachers"
+    )
+    parser.add_argument("--config", default="./configs/Pretrain.yaml")
+    parser.add_argument("--output_dir", default="output/Teacher_benchmark")
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision of the training steps",
+    )
+    parser.add_argument(
+        "--batch_size", default=0, type=int, help="defaults to the config batch_size"
+    )
+    parser.add_argument("--teacher_image_res", default=160, type=int)
+    parser.add_argument("--num_batches", default=4, type=int)
+    parser.add_argument("--num_iters", default=20, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
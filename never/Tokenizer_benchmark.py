@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import ruamel.yaml as yaml
+import torch
+from transformers.tokenization_utils import PreTrainedTokenizer
+
+from dataset.utils import pre_caption
+from models.tokenization_bert import BertTokenizer
+
+
+def load_captions(ann_files, max_words, raw):
+    """Captions of json annotation files, whose items hold a caption or a list of captions."""
+    captions = []
+    for ann_file in ann_files:
+        for ann in json.load(open(ann_file, "r")):
+            texts = (
+                ann["caption"] if isinstance(ann["caption"], list) else [ann["caption"]]
+            )
+            captions += [t if raw else pre_caption(t, max_words) for t in texts]
+    return captions
+
+
+def throughput(tokenize, batches, **kwargs):
+    start_time = time.time()
+    for batch in batches:
+        tokenize(batch, **kwargs)
+    return sum(len(batch) for batch in batches) / (time.time() - start_time)
+
+
+def main(args, config):
+    tokenizer = BertTokenizer.from_pretrained(config["text_encoder"])
+
+    ann_files = args.ann_file or config["test_file"]
+    ann_files = ann_files if isinstance(ann_files, list) else [ann_files]
+    captions = load_captions(ann_files, config.get("max_words", 30), args.raw)
+    batches = [
+        captions[i : i + args.batch_size]
+        for i in range(0, len(captions), args.batch_size)
+    ]
+    print("%d captions from %s" % (len(captions), ", ".join(ann_files)))
+
+    # the batched fast path of BertTokenizer against the generic implementation
+    generic = lambda text, **kwargs: PreTrainedTokenizer.__call__(
+        tokenizer, text, **kwargs
+    )
+    calls = [
+        dict(padding="longest", truncation=True, max_length=args.max_length),
+        dict(padding="max_length", truncation=True, max_length=args.max_length),
+        dict(padding="longest"),
+    ]
+
+    #### Golden outputs ####
+    for kwargs in calls:
+        for batch in batches:
+            fast = tokenizer(batch, return_tensors="pt", **kwargs)
+            reference = generic(batch, return_tensors="pt", **kwargs)
+            assert list(fast.keys()) == list(reference.keys())
+            for key in reference:
+                assert torch.equal(
+                    fast[key], reference[key]
+                ), "%s differs for %s on %s" % (key, kwargs, batch)
+    print("fast path matches the generic tokenizer on every batch")
+
+    #### Throughput ####
+    kwargs = dict(calls[0], return_tensors="pt")
+    tokenizer.word_cache.clear()
+    stats = {
+        "generic": throughput(generic, batches, **kwargs),
+        "fast_cold": throughput(tokenizer, batches, **kwargs),
+        "fast_warm": throughput(tokenizer, batches, **kwargs),
+        "cached_words": len(tokenizer.word_cache),
+    }
+    print(json.dumps(stats, indent=2))
+    with open(os.path.join(args.output_dir, "log.txt"), "a") as f:
+        f.write(json.dumps(stats) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="./configs/Retrieval_flickr.yaml")
+    parser.add_argument("--output_dir", default="output/Tokenizer_benchmark")
+    parser.add_argument(
+        "--ann_file",
+        nargs="+",
+        default=None,
+        help="defaults to the test_file of the config",
+    )
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--max_length", default=30, type=int)
+    parser.add_argument(
+        "--raw", action="store_true", help="tokenize the captions without pre_caption"
+    )
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    yaml.dump(config, open(os.path.join(args.output_dir, "config.yaml"), "w"))
+
+    main(args, config)
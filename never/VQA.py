@@ -10,12 +10,12 @@ import numpy as np
 import ruamel.yaml as yaml
 import torch
 import torch.backends.cudnn as cudnn
-import torch.distributed as dist
 
 import utils
 from dataset import create_dataset, create_loader, create_sampler, vqa_collate_fn
 from dataset.utils import save_result
 from models.model_vqa import ALBEF
+from models.pruning import prune_model
 from models.tokenization_bert import BertTokenizer
 from models.vit import interpolate_pos_embed
 from optim import create_optimizer
@@ -32,6 +32,8 @@ def train(
     device,
     scheduler,
     config,
+    precision,
+    scaler,
 ):
     # train
     model.train()
@@ -70,19 +72,21 @@ def train(
         else:
             alpha = config["alpha"] * min(1, i / len(data_loader))
 
-        loss = model(
-            image,
-            question_input,
-            answer_input,
-            train=True,
-            alpha=alpha,
-            k=n,
-            weights=weights,
-        )
+        with utils.get_autocast(precision, device):
+            loss = model(
+                image,
+                question_input,
+                answer_input,
+                train=True,
+                alpha=alpha,
+                k=n,
+                weights=weights,
+            )
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         metric_logger.update(loss=loss.item())
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
@@ -188,11 +192,6 @@ def main(args, config):
     )
     model = model.to(device)
 
-    arg_opt = utils.AttrDict(config["optimizer"])
-    optimizer = create_optimizer(arg_opt, model)
-    arg_sche = utils.AttrDict(config["schedular"])
-    lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
-
     if args.checkpoint:
         checkpoint = torch.load(args.checkpoint, map_location="cpu")
         state_dict = checkpoint["model"]
@@ -233,13 +232,27 @@ def main(args, config):
 
                     del state_dict[key]
 
+        if "pruning" in checkpoint:
+            prune_model(model, checkpoint["pruning"])
         msg = model.load_state_dict(state_dict, strict=False)
         print("load checkpoint from %s" % args.checkpoint)
         print(msg)
 
+    # pruned checkpoints change the parameter shapes, create the optimizer afterwards
+    arg_opt = utils.AttrDict(config["optimizer"])
+    optimizer = create_optimizer(arg_opt, model)
+    arg_sche = utils.AttrDict(config["schedular"])
+    lr_scheduler, _ = create_scheduler(arg_sche, optimizer)
+    scaler = utils.create_grad_scaler(args.precision, device)
+
+    if args.compile:
+        utils.compile_model(model)
+
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=utils.ddp_device_ids(args)
+        )
         model_without_ddp = model.module
 
     print("Start training")
@@ -263,6 +276,8 @@ def main(args, config):
                 device,
                 lr_scheduler,
                 config,
+                precision=args.precision,
+                scaler=scaler,
             )
 
         if args.evaluate:
@@ -287,9 +302,10 @@ def main(args, config):
                 save_obj, os.path.join(args.output_dir, "checkpoint_%02d.pth" % epoch)
             )
 
-        dist.barrier()
+        utils.barrier()
 
-    vqa_result = evaluation(model, test_loader, tokenizer, device, config)
+    with utils.get_autocast(args.precision, device):
+        vqa_result = evaluation(model, test_loader, tokenizer, device, config)
     result_file = save_result(vqa_result, args.result_dir, "vqa_result_epoch%d" % epoch)
 
     total_time = time.time() - start_time
@@ -304,6 +320,17 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", default="output/vqa")
     parser.add_argument("--evaluate", action="store_true")
     parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=list(utils.PRECISIONS),
+        help="autocast precision for training and evaluation",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the encoders and loss blocks",
+    )
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument(
         "--world_size", default=1, type=int, help="number of distributed processes"
@@ -311,6 +338,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dist_url", default="env://", help="url used to set up distributed training"
     )
+    parser.add_argument(
+        "--dist_backend",
+        default=None,
+        choices=["nccl", "gloo"],
+        help="defaults to nccl on cuda and gloo on cpu",
+    )
     parser.add_argument("--distributed", default=True, type=bool)
     args = parser.parse_args()
 
@@ -15,6 +15,7 @@ from dataset.randaugment import RandomAugment
 from dataset.utils import GaussianBlur
 from dataset.ve_dataset import ve_dataset
 from dataset.vqa_dataset import vqa_dataset
+from models.mlm import mask_tokens
 
 
 def create_dataset(dataset, config):
@@ -212,6 +213,51 @@ def vqa_collate_fn(batch):
     )
 
 
+class pretrain_collate_fn:
+    """Tokenize the captions of a pretraining batch in the loader workers.
+
+    If mlm_probability is given, the captions are also masked for MLM here,
+    otherwise the model masks them on the device.
+
+    Returns:
+        tuple: image, image_aug, the tokenized captions, and the MLM input_ids and
+            labels (None when not masked)
+    """
+
+    def __init__(self, tokenizer, max_length=25, mlm_probability=None, vocab_size=None):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.mlm_probability = mlm_probability
+        self.vocab_size = vocab_size or tokenizer.vocab_size
+        self.special_ids = torch.tensor(tokenizer.all_special_ids, dtype=torch.long)
+
+    def __call__(self, batch):
+        image_list, image_aug_list, caption_list = zip(*batch)
+        text = self.tokenizer(
+            list(caption_list),
+            padding="longest",
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="pt",
+        )
+        mlm_input_ids = mlm_labels = None
+        if self.mlm_probability is not None:
+            mlm_input_ids, mlm_labels = mask_tokens(
+                text.input_ids,
+                self.special_ids,
+                self.tokenizer.mask_token_id,
+                self.vocab_size,
+                self.mlm_probability,
+            )
+        return (
+            torch.stack(image_list, dim=0),
+            torch.stack(image_aug_list, dim=0),
+            text,
+            mlm_input_ids,
+            mlm_labels,
+        )
+
+
 def create_sampler(datasets, shuffles, num_tasks, global_rank):
     samplers = []
     for dataset, shuffle in zip(datasets, shuffles):
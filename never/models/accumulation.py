@@ -0,0 +1,43 @@
+import contextlib
+
+import torch
+
+
+def micro_batches(batch_size, micro_batch_size=None):
+    """Slices that split a batch into micro-batches of at most micro_batch_size.
+
+    A single slice over the whole batch if micro_batch_size is None.
+    """
+    micro_batch_size = micro_batch_size or batch_size
+    return [
+        slice(start, start + micro_batch_size)
+        for start in range(0, batch_size, micro_batch_size)
+    ]
+
+
+def slice_batch(batch, index):
+    """Rows at index of every tensor in batch, a tensor, a dict (or BatchEncoding) or None."""
+    if batch is None:
+        return None
+    if isinstance(batch, torch.Tensor):
+        return batch[index]
+    return type(batch)({key: slice_batch(value, index) for key, value in batch.items()})
+
+
+def concat_outputs(outputs):
+    """Concatenate the dicts of (batch_size, ...) tensors or None of the micro-batches."""
+    return {
+        key: None if outputs[0][key] is None else torch.cat([o[key] for o in outputs])
+        for key in outputs[0]
+    }
+
+
+def grad_sync(model, sync):
+    """Context of a backward, without the DDP gradient all-reduce unless sync.
+
+    The gradients of the micro-batches then add up locally and are reduced once,
+    by the backward of the last micro-batch.
+    """
+    if sync or not hasattr(model, "no_sync"):
+        return contextlib.nullcontext()
+    return model.no_sync()
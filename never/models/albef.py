@@ -0,0 +1,344 @@
+"""
+Trunks and training machinery shared by the task models.
+"""
+
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from models.contrastive import in_batch_g2l_loss, rescore_columns
+from models.ema import MomentumUpdater
+from models.gather import all_gather_padded, all_gather_with_grad, rank_offset
+from models.queue import enqueue
+from models.vit import VisionTransformer
+from models.xbert import BertConfig
+
+
+def create_vit(config, momentum=False, **kwargs):
+    """ViT-B/16 image encoder of the models.
+
+    Gradient checkpointing only applies to the online encoder, the momentum copy
+    runs without gradient. Extra arguments go to the VisionTransformer.
+    """
+    if not momentum:
+        kwargs.setdefault(
+            "gradient_checkpointing", config.get("gradient_checkpointing", False)
+        )
+        kwargs.setdefault("checkpoint_every", config.get("checkpoint_every", 1))
+    return VisionTransformer(
+        img_size=config["image_res"],
+        patch_size=16,
+        embed_dim=768,
+        depth=12,
+        num_heads=12,
+        mlp_ratio=4,
+        qkv_bias=True,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6),
+        **kwargs,
+    )
+
+
+def create_bert_config(config, **overrides):
+    """BertConfig of config["bert_config"], with the attributes in overrides set."""
+    bert_config = BertConfig.from_json_file(config["bert_config"])
+    bert_config.gradient_checkpointing = config.get("gradient_checkpointing", False)
+    for name, value in overrides.items():
+        setattr(bert_config, name, value)
+    return bert_config
+
+
+class ALBEFBase(nn.Module):
+    """Base of the task models: momentum copies, queues and the shared losses.
+
+    A task model builds its trunks (create_vit, create_bert_config) and heads in
+    __init__, then plugs them in:
+
+    - init_momentum(config, model_pairs) with the (online, momentum) pairs, for
+      copy_params and the foreach EMA of _momentum_update;
+    - init_queue(embed_dim, queue_size) for the contrastive models, whose
+      teacher_step updates the momentum copies, runs the teacher and enqueues
+      its keys into the ring-buffer queues.
+
+    The contrastive models also share the negatives rescored across ranks
+    (rescore_negatives), the g2l losses (g2l_losses) and the hard negative
+    pairs of ITM (sample_itm_pairs).
+    """
+
+    # local patch features are pooled onto a grid of this many cells, or of
+    # sqrt(patches per side) cells per side if None
+    pooled_patch_length = None
+
+    def init_momentum(self, config, model_pairs, momentum=None):
+        """Momentum updater of the model pairs.
+
+        momentum defaults to config["momentum"] if set, else 0.995. The models
+        that require the key pass config["momentum"] themselves.
+        """
+        self.model_pairs = model_pairs
+        if momentum is None:
+            momentum = config.get("momentum", 0.995)
+        self.momentum_updater = MomentumUpdater(
+            momentum,
+            every=config.get("momentum_every", 1),
+            dtype=config.get("momentum_dtype"),
+        )
+        self.copy_params()
+
+    def copy_params(self):
+        self.momentum_updater.copy_params(self.model_pairs)
+
+    def _momentum_update(self):
+        self.momentum_updater.update(self.model_pairs)
+
+    def init_queue(self, embed_dim, queue_size, idx_queue=False):
+        """Register the normalized feature queues, and an index queue if idx_queue."""
+        self.queue_size = queue_size
+        self.queue_names = ["image_queue", "text_queue"]
+        self.register_buffer("image_queue", torch.randn(embed_dim, queue_size))
+        self.register_buffer("text_queue", torch.randn(embed_dim, queue_size))
+        if idx_queue:
+            self.queue_names.append("idx_queue")
+            self.register_buffer("idx_queue", torch.full((1, queue_size), -100))
+        self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
+
+        self.image_queue = nn.functional.normalize(self.image_queue, dim=0)
+        self.text_queue = nn.functional.normalize(self.text_queue, dim=0)
+
+    @torch.no_grad()
+    def _dequeue_and_enqueue(self, *keys):
+        # gather keys before updating queue
+        return enqueue(
+            [getattr(self, name) for name in self.queue_names],
+            self.queue_ptr,
+            [concat_all_gather(key) for key in keys],
+        )
+
+    @torch.no_grad()
+    def teacher_step(self, image_aug, text, micro_batch_size=None, extra_keys=()):
+        """Momentum update, teacher outputs and enqueue of a batch.
+
+        Runs once per optimizer step. Under gradient accumulation the logical
+        batch is given here, the teacher runs over its micro-batches, and the
+        queues take the keys of the whole batch at once. The outputs, batch_cols
+        included, are then passed to the forward of every micro-batch, with its
+        rows. extra_keys are enqueued after the image and text features.
+        """
+        with self.momentum_updater.autocast(image_aug.device):
+            self._momentum_update()
+            teacher = self.teacher_forward(image_aug, text, micro_batch_size)
+            # enqueue first, the queues then hold the keys of the batch too and
+            # serve as key banks as they are, without a [batch, queue] copy
+            teacher["batch_cols"] = self._dequeue_and_enqueue(
+                teacher["image_feat_m"], teacher["text_feat_m"], *extra_keys
+            )
+        return teacher
+
+    def rescore_negatives(self, sims, image_feat, text_feat, batch_cols, positives):
+        """Score the batch columns of the banks against the features of all ranks.
+
+        The negatives of all ranks then carry their gradient, for the terms
+        enabled in gather_negatives. Only the negatives are rescored: the
+        columns of the positives, given as positives (columns or a target
+        mask), keep their momentum keys in every term.
+
+        Args:
+            sims (tuple): sim_i2t, sim_t2i, sim_i2i, sim_t2t against the banks
+            image_feat, text_feat (tensor): (batch_size, embed_dim) online features
+            batch_cols (tensor): (batch_size,) bank columns of the local batch
+
+        Returns:
+            tuple: the four similarities
+        """
+        sim_i2t, sim_t2i, sim_i2i, sim_t2t = sims
+        if self.gather_negatives.get("itc") or self.gather_negatives.get("g2g"):
+            cols_all = concat_all_gather(batch_cols)
+            reduce_scatter = self.gather_negatives.get("reduce_scatter")
+            image_feat_ranks = all_gather_with_grad(image_feat, reduce_scatter)
+            text_feat_ranks = all_gather_with_grad(text_feat, reduce_scatter)
+        if self.gather_negatives.get("itc"):
+            sim_i2t = rescore_columns(
+                sim_i2t, image_feat, text_feat_ranks, cols_all, self.temp, positives
+            )
+            sim_t2i = rescore_columns(
+                sim_t2i, text_feat, image_feat_ranks, cols_all, self.temp, positives
+            )
+        if self.gather_negatives.get("g2g"):
+            sim_i2i = rescore_columns(
+                sim_i2i, image_feat, image_feat_ranks, cols_all, self.temp, positives
+            )
+            sim_t2t = rescore_columns(
+                sim_t2t, text_feat, text_feat_ranks, cols_all, self.temp, positives
+            )
+        return sim_i2t, sim_t2i, sim_i2i, sim_t2t
+
+    def g2l_losses(self, teacher, image_feat, text_feat, offset=0):
+        """Text and image g2l losses, against the local features of all ranks if gathered.
+
+        teacher holds the local features of the logical batch, the global
+        features are those of its micro-batch starting at row offset.
+        """
+        text_l, text_atts_l = teacher["text_feat_m_l"], teacher["text_atts_m_l"]
+        image_l, image_atts_l = teacher["image_feat_m_l"], teacher.get("image_atts_m_l")
+        if self.gather_negatives.get("g2l"):
+            offset += rank_offset(text_l.size(0))
+            text_l, text_atts_l, image_l, image_atts_l = map(
+                all_gather_padded, (text_l, text_atts_l, image_l, image_atts_l)
+            )
+        loss_t2t_l = self.in_batch_g2l_loss(
+            text_l, text_feat, self.temp, text_atts_l, offset
+        )
+        loss_i2i_l = self.in_batch_g2l_loss(
+            image_l, image_feat, self.temp, image_atts_l, offset
+        )
+        return loss_t2t_l, loss_i2i_l
+
+    @torch.no_grad()
+    def sample_itm_pairs(self, weights_i2t, weights_t2i, positives=None, offset=0):
+        """Text and image rows of the 3B ITM pairs of a batch.
+
+        The positive pairs, the texts with a negative image and the images with
+        a negative text go through the fusion encoder as one batch, gathered
+        with one indexing per modality instead of per-part copies. positives
+        masks the pairs never drawn as negatives, see sample_negatives.
+
+        Under gradient accumulation the weights are those of a micro-batch, its
+        rows starting at row offset of the logical batch, over the columns of
+        the whole logical batch. The negatives are then drawn from the logical
+        batch, and the rows returned index it.
+        """
+        bs = weights_i2t.size(0)
+        image_neg_idx = sample_negatives(weights_t2i, positives, offset)
+        text_neg_idx = sample_negatives(weights_i2t, positives, offset)
+        batch_idx = torch.arange(offset, offset + bs, device=weights_i2t.device)
+        text_idx = torch.cat([batch_idx, batch_idx, text_neg_idx])
+        image_idx = torch.cat([batch_idx, image_neg_idx, batch_idx])
+        return text_idx, image_idx
+
+    def batch_embeddings(self, embeds, offset, idx, batch_size, encode):
+        """Embeddings of the samples at rows idx of the logical batch.
+
+        embeds are those of the micro-batch starting at row offset. The hard
+        negatives drawn from the other micro-batches are encoded by
+        encode(rows), with their gradient, as in a forward of the whole logical
+        batch.
+        """
+        size = embeds.size(0)
+        if size == batch_size:
+            return embeds[idx]
+        local = (idx >= offset) & (idx < offset + size)
+        others = torch.unique(idx[~local])
+        if others.numel() == 0:
+            return embeds[idx - offset]
+        rows = torch.where(local, idx - offset, size + torch.searchsorted(others, idx))
+        return torch.cat([embeds, encode(others)])[rows]
+
+    # IMC: patch pooling of image patches to reduce computation and enlarge receptive field
+    def patch_pooling(self, x, keep_ids=None, num_patches=None):
+        """Pool the local patch features onto a coarse grid.
+
+        If ``keep_ids`` is given, ``x`` only holds the patches kept by the random
+        patch dropping of the ViT: they are scattered back onto the full grid of
+        ``num_patches`` (that of the configured resolution by default) and each
+        cell is averaged over its kept patches. The second output then masks out
+        the cells left empty, otherwise it is None.
+        """
+        batch_size, seq_length, dim = x.size()
+        if keep_ids is not None:
+            seq_length = num_patches or self.visual_encoder_m.patch_embed.num_patches
+            keep_ids = keep_ids.unsqueeze(-1)
+            x = x.new_zeros(batch_size, seq_length, dim).scatter_(
+                1, keep_ids.expand(-1, -1, dim), x
+            )
+            counts = x.new_zeros(batch_size, seq_length, 1).scatter_(1, keep_ids, 1.0)
+            x = torch.cat([x, counts], dim=-1)
+
+        b1 = int(np.sqrt(seq_length))
+        x = x.reshape(batch_size, b1, b1, -1)
+        x = x.permute(0, 3, 1, 2)
+        if self.pooled_patch_length is None:
+            c1 = int(np.sqrt(b1))
+        else:
+            c1 = b1 // int(np.sqrt(self.pooled_patch_length))
+        x = F.avg_pool2d(x, c1, stride=c1)
+        x = x.permute(0, 2, 3, 1).flatten(1, 2)
+
+        if keep_ids is None:
+            return x, None
+        x, counts = x[:, :, :dim], x[:, :, dim:]
+        x = x / counts.clamp(min=1e-6)
+        return x, (counts.squeeze(-1) > 0).float()
+
+    # IMC: g2l loss
+    def in_batch_g2l_loss(self, l, m, temp, attention_mask=None, offset=0):
+        return in_batch_g2l_loss(
+            l, m, temp, attention_mask, chunk_size=self.g2l_chunk_size, offset=offset
+        )
+
+    def share_cross_attention(self, model):
+        """Tie the key and value projections of the cross-attention layer pairs.
+
+        The two images of NLVR go through the two layers of a pair.
+        """
+        for i in range(6):
+            layer_num = 6 + i * 2
+            modules_0 = model.layer[layer_num].crossattention.self._modules
+            modules_1 = model.layer[layer_num + 1].crossattention.self._modules
+
+            for name in modules_0.keys():
+                if "key" in name or "value" in name:
+                    module_0 = modules_0[name]
+                    module_1 = modules_1[name]
+                    if hasattr(module_0, "weight"):
+                        module_0.weight = module_1.weight
+                        if hasattr(module_0, "bias"):
+                            module_0.bias = module_1.bias
+
+
+@torch.no_grad()
+def sample_negatives(weights, positives=None, offset=0):
+    """Draw one hard negative per row of weights, in a single multinomial call.
+
+    Args:
+        weights (tensor): (bs, batch_size) sampling weights, zero for the
+            positives. bs < batch_size for a micro-batch of the batch.
+        positives (tensor, optional): (bs, batch_size) bool mask of the positive
+            pairs, the diagonal by default
+        offset (int): column of the first row, the row of its sample in the batch
+
+    Returns:
+        tensor: (bs,) index of the negative of every row. Rows without any weight
+            (all zero or NaN) are drawn uniformly among their negatives instead,
+            without a sync with the host. A row without negatives, the whole
+            batch sharing one image id, is drawn among the other samples.
+    """
+    rows = torch.arange(weights.size(0), device=weights.device) + offset
+    eye = rows.view(-1, 1) == torch.arange(weights.size(1), device=weights.device)
+    if positives is None:
+        positives = eye
+    uniform = (~positives).to(weights.dtype)
+    has_negatives = uniform.sum(dim=1, keepdim=True) > 0
+    uniform = torch.where(has_negatives, uniform, (~eye).to(weights.dtype))
+    valid = weights.sum(dim=1, keepdim=True) > 0
+    weights = torch.where(valid, weights, uniform)
+    return torch.multinomial(weights, 1).squeeze(1)
+
+
+@torch.no_grad()
+def concat_all_gather(tensor):
+    """
+    Performs all_gather operation on the provided tensors.
+    *** Warning ***: torch.distributed.all_gather has no gradient.
+    The tensor itself in single-process runs.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return tensor
+    tensors_gather = [
+        torch.ones_like(tensor) for _ in range(torch.distributed.get_world_size())
+    ]
+    torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
+
+    output = torch.cat(tensors_gather, dim=0)
+    return output
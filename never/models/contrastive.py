@@ -0,0 +1,246 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def stacked_similarities(image_feat, text_feat, image_bank, text_bank, temp):
+    """Similarities of the image and text features to both key banks.
+
+    The queries that share a key bank are stacked, so the four (batch, keys)
+    matrices take two matmuls. They are returned as views of the two products.
+
+    Returns:
+        tuple: sim_i2t, sim_t2i, sim_i2i, sim_t2t
+    """
+    batch_size = image_feat.size(0)
+    # scale the (2B, D) queries rather than the (2B, K) products, autograd then
+    # does not keep the products for the gradient of temp
+    sim_text = (torch.cat([image_feat, text_feat]) / temp) @ text_bank
+    sim_image = (torch.cat([text_feat, image_feat]) / temp) @ image_bank
+    return (
+        sim_text[:batch_size],
+        sim_image[:batch_size],
+        sim_image[batch_size:],
+        sim_text[batch_size:],
+    )
+
+
+def rescore_columns(sim, query, keys, cols, temp, keep=None):
+    """sim with the columns cols scored against keys instead of the key bank.
+
+    Puts the online features of the batch, gathered from all ranks with their
+    gradient, in place of their momentum copies in the bank.
+
+    Args:
+        sim (tensor): (batch_size, num_keys) logits against the bank
+        query (tensor): (batch_size, dim) features the logits were computed from
+        keys (tensor): (num_cols, dim) features of the columns
+        cols (tensor): (num_cols,) columns of the keys in the bank
+        temp (tensor): temperature
+        keep (tensor, optional): logits left as they are, given like the
+            positives of ContrastiveLoss, (batch_size,) columns or a
+            (batch_size, num_keys) mask. The positives keep their momentum
+            keys: the online key of an in-modality positive would be the query
+            itself, and ITC pairs the online query with the momentum positive.
+    """
+    rescored = sim.index_copy(1, cols, ((query / temp) @ keys.t()).to(sim.dtype))
+    if keep is None:
+        return rescored
+    if keep.dim() == 1:
+        keep = keep.unsqueeze(1)
+        return rescored.scatter(1, keep, sim.gather(1, keep))
+    return torch.where(keep.bool(), sim, rescored)
+
+
+class SoftTargetCrossEntropy(torch.autograd.Function):
+    """Row-averaged cross entropy against soft + hard targets, with a fused backward.
+
+    Only the logits and the (B,) logsumexp are kept for backward, whose gradient
+    softmax(sim) - targets is built in place in a single (B, K) buffer. The soft
+    targets and a dense hard target matrix are saved by reference, they are
+    alive anyway.
+    """
+
+    @staticmethod
+    def forward(ctx, sim, positives, soft_targets):
+        lse = torch.logsumexp(sim, dim=1)
+        hard_weight = torch.ones_like(lse)
+        loss = lse
+        if soft_targets is not None:
+            loss = loss - torch.sum(soft_targets * sim, dim=1)
+            hard_weight = hard_weight - soft_targets.sum(dim=1)
+        if positives.dim() == 1:
+            pos_sim = sim.gather(1, positives.unsqueeze(1)).squeeze(1)
+        else:
+            pos_sim = torch.sum(positives * sim, dim=1)
+        ctx.save_for_backward(sim, positives, soft_targets, lse, hard_weight)
+        return (loss - hard_weight * pos_sim).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        sim, positives, soft_targets, lse, hard_weight = ctx.saved_tensors
+        grad_sim = torch.exp(sim - lse.unsqueeze(1))
+        if soft_targets is not None:
+            grad_sim.sub_(soft_targets)
+        if positives.dim() == 1:
+            grad_sim.scatter_add_(1, positives.unsqueeze(1), -hard_weight.unsqueeze(1))
+        else:
+            grad_sim.sub_(positives * hard_weight.unsqueeze(1))
+        grad_sim.mul_(grad_output / sim.size(0))
+        return grad_sim, None, None
+
+
+class ContrastiveLoss(nn.Module):
+    """Cross entropy of similarities against (distilled) contrastive targets.
+
+    The targets are alpha * softmax(sim_m) + (1 - alpha) * hard and are never
+    built as a matrix. Their rows sum to one, so the loss of a row is
+
+        logsumexp(sim) - <alpha * softmax(sim_m), sim> - (1 - alpha) * <hard, sim>
+
+    and <hard, sim> is a gather when the positives are given as column indices,
+    the sparse path taken by pretraining whenever alpha == 0 and by the IMC g2g
+    losses. The weight of the hard targets is read off the soft ones, there is
+    no float argument for torch.compile to specialize on.
+    """
+
+    def forward(self, sim, positives, soft_targets=None):
+        """
+        Args:
+            sim (tensor): (batch_size, num_keys) logits
+            positives (tensor): (batch_size,) column of the positive key of each
+                row, or (batch_size, num_keys) hard targets with rows summing to one
+            soft_targets (tensor, optional): (batch_size, num_keys) the distilled
+                targets alpha * softmax(sim_m), None for alpha == 0
+
+        Returns:
+            tensor: the loss averaged over the rows
+        """
+        return SoftTargetCrossEntropy.apply(sim.float(), positives, soft_targets)
+
+
+def _g2l_negatives(m, l_n, temp, owner, key_mask, start, end, offset=0):
+    """(N, end - start) logits of the global features against a chunk of local keys.
+
+    The keys of the sample itself and the padding tokens are masked with -inf.
+    """
+    u_n = m @ l_n[start:end].t() / temp
+    rows = torch.arange(m.size(0), device=m.device).unsqueeze(1) + offset
+    valid = owner[start:end].unsqueeze(0) != rows
+    if key_mask is not None:
+        valid = valid & key_mask[start:end].unsqueeze(0)
+    return u_n.masked_fill(~valid, float("-inf")), valid
+
+
+class InBatchG2LLoss(torch.autograd.Function):
+    """Global-to-local InfoNCE, streamed over chunks of the negative keys.
+
+    Every local feature l[a, i] is scored against its global feature m[a], with
+    the pairs of m[a] and the local features of all other samples as negatives.
+    The negatives do not depend on i, so the loss of (a, i) is
+
+        softplus(logsumexp_{b != a, j} <m[a], l[b, j]> / temp - <m[a], l[a, i]> / temp)
+
+    The logsumexp is accumulated over chunks of chunk_size keys, and backward
+    recomputes the chunks. Memory is O(N * chunk_size) instead of the
+    N x n_locals x (N * n_locals + 1) logits of the expanded formulation.
+
+    The local features may hold more samples than the global ones, the local
+    features gathered from all ranks for instance. The global features are then
+    those of the samples offset, offset + 1, ... of l.
+    """
+
+    @staticmethod
+    def forward(ctx, l, m, temp, attention_mask, chunk_size, offset):
+        num_keys, n_locals, dim = l.size()
+        N = m.size(0)
+        l_n = l.reshape(-1, dim)
+        owner = torch.arange(num_keys, device=l.device).repeat_interleave(n_locals)
+        key_mask = None
+        if attention_mask is not None:
+            key_mask = attention_mask.reshape(-1).bool()
+            attention_mask = attention_mask[offset : offset + N]
+
+        lse = torch.full((N,), float("-inf"), device=l.device)
+        for start in range(0, num_keys * n_locals, chunk_size):
+            u_n, _ = _g2l_negatives(
+                m, l_n, temp, owner, key_mask, start, start + chunk_size, offset
+            )
+            lse = torch.logaddexp(lse, torch.logsumexp(u_n, dim=1))
+
+        u_p = torch.einsum("nld,nd->nl", l[offset : offset + N], m) / temp
+        # weights of the (a, i) terms: a mean over the tokens of each text, or
+        # over all the patches
+        if attention_mask is not None:
+            weights = attention_mask / attention_mask.sum(dim=1, keepdim=True) / N
+        else:
+            weights = torch.full_like(u_p, 1.0 / u_p.numel())
+        margin = lse.unsqueeze(1) - u_p
+        loss = torch.sum(F.softplus(margin) * weights)
+
+        ctx.chunk_size = chunk_size
+        ctx.offset = offset
+        ctx.save_for_backward(
+            l, m, temp, key_mask, owner, lse, u_p, torch.sigmoid(margin) * weights
+        )
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        l, m, temp, key_mask, owner, lse, u_p, grad_margin = ctx.saved_tensors
+        num_keys, n_locals, dim = l.size()
+        l_n = l.reshape(-1, dim)
+        positives = slice(ctx.offset * n_locals, (ctx.offset + m.size(0)) * n_locals)
+
+        # positives, d(loss)/d(u_p) = -grad_margin
+        l_pos = l_n[positives].view(-1, n_locals, dim)
+        grad_m = -torch.einsum("nl,nld->nd", grad_margin, l_pos) / temp
+        grad_l = torch.zeros_like(l_n)
+        grad_l[positives] = -(grad_margin.unsqueeze(2) * m.unsqueeze(1)).flatten(0, 1)
+        grad_l[positives] /= temp
+        grad_temp = torch.sum(grad_margin * u_p) / temp
+
+        # negatives, d(loss)/d(lse) is spread by the softmax over the keys
+        grad_lse = grad_margin.sum(dim=1, keepdim=True)
+        for start in range(0, num_keys * n_locals, ctx.chunk_size):
+            end = start + ctx.chunk_size
+            u_n, valid = _g2l_negatives(
+                m, l_n, temp, owner, key_mask, start, end, ctx.offset
+            )
+            grad_u = (grad_lse * torch.exp(u_n - lse.unsqueeze(1))).masked_fill(
+                ~valid, 0
+            )
+            grad_m += grad_u @ l_n[start:end] / temp
+            grad_l[start:end] += grad_u.t() @ m / temp
+            grad_temp -= torch.sum(grad_u * u_n.masked_fill(~valid, 0)) / temp
+
+        return (
+            grad_l.view_as(l) * grad_output if ctx.needs_input_grad[0] else None,
+            grad_m * grad_output if ctx.needs_input_grad[1] else None,
+            grad_temp * grad_output if ctx.needs_input_grad[2] else None,
+            None,
+            None,
+            None,
+        )
+
+
+def in_batch_g2l_loss(l, m, temp, attention_mask=None, chunk_size=4096, offset=0):
+    """In-batch global-to-local loss of the IMC, see InBatchG2LLoss.
+
+    Args:
+        l (tensor): (num_keys, n_locals, dim) local features, num_keys >= N
+        m (tensor): (N, dim) global features
+        temp (tensor): temperature
+        attention_mask (tensor, optional): (num_keys, n_locals) 0 for the padding
+            tokens
+        chunk_size (int): negative keys per chunk, out of num_keys * n_locals
+        offset (int): sample of l the first global feature belongs to
+
+    Returns:
+        tensor: the loss
+    """
+    # computed in fp32, outside of any autocast
+    with torch.autocast(device_type=l.device.type, enabled=False):
+        return InBatchG2LLoss.apply(
+            l.float(), m.float(), temp.float(), attention_mask, chunk_size, offset
+        )
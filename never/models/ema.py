@@ -0,0 +1,103 @@
+import contextlib
+from collections import defaultdict
+
+import torch
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+class MomentumUpdater:
+    """Exponential moving average of the online encoders into their momentum copies.
+
+    The momentum parameters of all the model pairs are grouped by device and
+    dtype and updated in place with one foreach lerp_ per group, instead of two
+    new tensors per parameter and step.
+
+    Args:
+        momentum (float): EMA momentum m, momentum = m * momentum + (1 - m) * online
+        every (int): update the momentum copies once every N calls only, with the
+            momentum corrected to m ** N, so that they follow the same average.
+            The skipped calls do nothing.
+        dtype (str, optional): "bf16" or "fp16" to keep the momentum copies in lower
+            precision, halving their memory. Their forward then has to run under
+            the autocast() of this updater. Combine it with every > 1, a lerp
+            weight of 1 - m is below the resolution of bf16. The online
+            parameters are cast for the lerp into one buffer per group,
+            allocated once and reused by every update.
+
+    num_updates, the position in the every-N cadence, is saved with state_dict so
+    that a resumed run keeps it.
+    """
+
+    def __init__(self, momentum, every=1, dtype=None):
+        self.momentum = momentum
+        self.every = every
+        self.dtype = DTYPES[dtype] if dtype else None
+        self.num_updates = 0
+        # (device, dtype): the online parameters cast to the momentum dtype
+        self.cast_buffers = {}
+
+    @torch.no_grad()
+    def copy_params(self, model_pairs):
+        """Initialize the momentum copies from the online encoders and freeze them."""
+        for model, model_m in model_pairs:
+            if self.dtype is not None:
+                model_m.to(self.dtype)
+            for param, param_m in zip(model.parameters(), model_m.parameters()):
+                param_m.copy_(param)
+                param_m.requires_grad = False
+
+    @torch.no_grad()
+    def update(self, model_pairs):
+        self.num_updates += 1
+        if self.num_updates % self.every:
+            return
+
+        # parameters are gathered on every update rather than flattened into
+        # one buffer once: .to(device), the dtype cast and pruning replace them
+        groups = defaultdict(lambda: ([], []))
+        for model, model_m in model_pairs:
+            for param, param_m in zip(model.parameters(), model_m.parameters()):
+                params_m, params = groups[param_m.device, param_m.dtype]
+                params_m.append(param_m)
+                params.append(param)
+        weight = 1.0 - self.momentum**self.every
+        for key, (params_m, params) in groups.items():
+            if any(param.dtype != key[1] for param in params):
+                params = self.cast(key, params)
+            torch._foreach_lerp_(params_m, params, weight)
+
+    def cast(self, key, params):
+        """params cast into the buffer of group key, with a foreach copy.
+
+        The buffer is one flat tensor, viewed per parameter, and is only
+        reallocated when the parameter shapes change.
+        """
+        shapes = [param.shape for param in params]
+        views = self.cast_buffers.get(key)
+        if views is None or [view.shape for view in views] != shapes:
+            device, dtype = key
+            buffer = torch.empty(
+                sum(param.numel() for param in params), dtype=dtype, device=device
+            )
+            views = [
+                chunk.view(shape)
+                for chunk, shape in zip(
+                    buffer.split([param.numel() for param in params]), shapes
+                )
+            ]
+            self.cast_buffers[key] = views
+        torch._foreach_copy_(views, params)
+        return views
+
+    def state_dict(self):
+        return {"num_updates": self.num_updates}
+
+    def load_state_dict(self, state_dict):
+        self.num_updates = state_dict["num_updates"]
+
+    def autocast(self, device):
+        """Context for the forward of the momentum copies, a no-op at full precision."""
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device.type, dtype=self.dtype)
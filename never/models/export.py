@@ -0,0 +1,71 @@
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ImageTower(nn.Module):
+    """visual_encoder + vision_proj, as used by Retrieval.evaluation."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.visual_encoder = model.visual_encoder
+        self.vision_proj = model.vision_proj
+
+    def forward(self, image):
+        image_feat = self.visual_encoder(image)
+        image_embed = F.normalize(self.vision_proj(image_feat[:, 0, :]), dim=-1)
+        return image_feat, image_embed
+
+
+class TextTower(nn.Module):
+    """Unimodal layers of the text_encoder + text_proj."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.text_encoder = model.text_encoder
+        self.text_proj = model.text_proj
+
+    def forward(self, input_ids, attention_mask):
+        text_feat = self.text_encoder(
+            input_ids, attention_mask=attention_mask, return_dict=True, mode="text"
+        ).last_hidden_state
+        text_embed = F.normalize(self.text_proj(text_feat[:, 0, :]), dim=-1)
+        return text_feat, text_embed
+
+
+class FusionScorer(nn.Module):
+    """Fusion layers of the text_encoder + itm_head, returns the matching score."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.text_encoder = model.text_encoder
+        self.itm_head = model.itm_head
+
+    def forward(self, text_feat, text_atts, image_feat):
+        output = self.text_encoder(
+            encoder_embeds=text_feat,
+            attention_mask=text_atts,
+            encoder_hidden_states=image_feat,
+            return_dict=True,
+            mode="fusion",
+        )
+        return self.itm_head(output.last_hidden_state[:, 0, :])[:, 1]
+
+
+# input and output names, with their dynamic axes, of every exported tower
+TOWERS = {
+    "image": (ImageTower, ["image"], ["image_feat", "image_embed"]),
+    "text": (TextTower, ["input_ids", "attention_mask"], ["text_feat", "text_embed"]),
+    "fusion": (FusionScorer, ["text_feat", "text_atts", "image_feat"], ["score"]),
+}
+
+DYNAMIC_AXES = {
+    "image": {0: "batch"},
+    "image_feat": {0: "batch"},
+    "image_embed": {0: "batch"},
+    "input_ids": {0: "batch", 1: "length"},
+    "attention_mask": {0: "batch", 1: "length"},
+    "text_feat": {0: "batch", 1: "length"},
+    "text_atts": {0: "batch", 1: "length"},
+    "text_embed": {0: "batch"},
+    "score": {0: "batch"},
+}
@@ -0,0 +1,92 @@
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+def _is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+class AllGatherWithGrad(torch.autograd.Function):
+    """all_gather whose backward returns the gradient of the local slice.
+
+    The gathered (world_size * batch_size, ...) tensor is used by the losses of
+    every rank, so the gradient of the local rows is the sum over the ranks of
+    the gradients of their slice. A reduce-scatter delivers exactly that sum to
+    each rank: only the local (batch_size, ...) slice is received and returned,
+    the full gathered gradient is never reduced onto every rank. Backends
+    without reduce-scatter (gloo before it implemented reduce_scatter_tensor)
+    fall back to an all-reduce of the full gradient.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor, reduce_scatter):
+        ctx.reduce_scatter = reduce_scatter
+        output = tensor.new_empty(
+            (dist.get_world_size() * tensor.size(0),) + tensor.shape[1:]
+        )
+        dist.all_gather_into_tensor(output, tensor.contiguous())
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        world_size = dist.get_world_size()
+        if ctx.reduce_scatter:
+            grad = grad_output.new_empty(
+                (grad_output.size(0) // world_size,) + grad_output.shape[1:]
+            )
+            dist.reduce_scatter_tensor(grad, grad_output)
+        else:
+            grad_output = grad_output.clone()
+            dist.all_reduce(grad_output)
+            grad = grad_output.chunk(world_size)[dist.get_rank()]
+        return grad, None
+
+
+def all_gather_with_grad(tensor, reduce_scatter=None):
+    """Concatenate the tensor of all ranks along dim 0, with gradient.
+
+    The tensor itself in single-process runs.
+
+    Args:
+        tensor (tensor): (batch_size, ...) local rows, same shape on every rank
+        reduce_scatter (bool, optional): reduce-scatter the gradient, all-reduce
+            it otherwise. By default only the NCCL backend reduce-scatters.
+
+    Returns:
+        tensor: (world_size * batch_size, ...) rows of all ranks in rank order
+    """
+    if not _is_distributed():
+        return tensor
+    if reduce_scatter is None:
+        reduce_scatter = dist.get_backend() == "nccl"
+    return AllGatherWithGrad.apply(tensor, reduce_scatter)
+
+
+@torch.no_grad()
+def all_gather_padded(tensor):
+    """Concatenate the tensor of all ranks along dim 0, without gradient.
+
+    The tensors may differ in length (dim 1) across ranks, the texts padded to
+    the longest of each batch for instance. They are zero padded to the longest.
+    None and the tensor itself in single-process runs are passed through.
+    """
+    if tensor is None or not _is_distributed():
+        return tensor
+    length = torch.tensor([tensor.size(1)], device=tensor.device)
+    dist.all_reduce(length, op=dist.ReduceOp.MAX)
+    pad = [0, 0] * (tensor.dim() - 2) + [0, int(length) - tensor.size(1)]
+    tensor = F.pad(tensor, pad).contiguous()
+    output = tensor.new_empty(
+        (dist.get_world_size() * tensor.size(0),) + tensor.shape[1:]
+    )
+    dist.all_gather_into_tensor(output, tensor)
+    return output
+
+
+def rank_offset(batch_size):
+    """Row of the first local sample in tensors gathered from all ranks."""
+    if not _is_distributed():
+        return 0
+    return dist.get_rank() * batch_size
@@ -0,0 +1,34 @@
+import torch
+
+
+def mask_tokens(input_ids, special_ids, mask_token_id, vocab_size, mlm_probability):
+    """BERT masking of a batch of token ids, vectorized on their device.
+
+    Every token that is not special is selected with probability mlm_probability.
+    A selected token is replaced by [MASK] 80% of the time, by a random word 10%
+    of the time and kept otherwise. All the random draws are made on the device
+    of input_ids, so this runs as well in the loader workers as on the GPU.
+
+    Args:
+        input_ids (tensor): (batch_size, seq_len) token ids, left unchanged
+        special_ids (tensor or list): ids never selected, tokenizer.all_special_ids
+        mask_token_id (int): id of [MASK]
+        vocab_size (int): random words are drawn from [0, vocab_size)
+        mlm_probability (float): selection probability
+
+    Returns:
+        tuple: the masked input_ids, and the labels, -100 except at the selected tokens
+    """
+    device = input_ids.device
+    special = torch.isin(input_ids, torch.as_tensor(special_ids, device=device))
+    draws = torch.rand((3,) + input_ids.shape, device=device)
+
+    masked = (draws[0] < mlm_probability) & ~special
+    replaced = masked & (draws[1] < 0.8)
+    randomized = masked & ~replaced & (draws[2] < 0.5)
+    random_words = torch.randint(vocab_size, input_ids.shape, device=device)
+
+    labels = input_ids.masked_fill(~masked, -100)
+    input_ids = input_ids.masked_fill(replaced, mask_token_id)
+    input_ids = torch.where(randomized, random_words, input_ids)
+    return input_ids, labels
@@ -2,18 +2,19 @@
 Model & Loss functions.
 """
 
-from functools import partial
-
-import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
 
-from models.vit import VisionTransformer, interpolate_pos_embed
-from models.xbert import BertConfig, BertForMaskedLM
+from models.accumulation import concat_outputs, micro_batches, slice_batch
+from models.albef import ALBEFBase, create_bert_config, create_vit
+from models.contrastive import ContrastiveLoss, stacked_similarities
+from models.mlm import mask_tokens
+from models.vit import interpolate_pos_embed
+from models.xbert import BertForMaskedLM
 
 
-class ALBEF(nn.Module):
+class ALBEF(ALBEFBase):
     def __init__(self, text_encoder=None, tokenizer=None, config=None, init_deit=True):
         super().__init__()
         self.global_step = 0
@@ -21,15 +22,8 @@ class ALBEF(nn.Module):
         self.mlm_probability = config["mlm_probability"]
         embed_dim = config["embed_dim"]
 
-        self.visual_encoder = VisionTransformer(
-            img_size=config["image_res"],
-            patch_size=16,
-            embed_dim=768,
-            depth=12,
-            num_heads=12,
-            mlp_ratio=4,
-            qkv_bias=True,
-            norm_layer=partial(nn.LayerNorm, eps=1e-6),
+        self.visual_encoder = create_vit(
+            config, patch_keep_ratio=config.get("patch_keep_ratio", 1.0)
         )
 
         if init_deit:
@@ -52,7 +46,7 @@ class ALBEF(nn.Module):
             print(msg)
 
         vision_width = config["vision_width"]
-        bert_config = BertConfig.from_json_file(config["bert_config"])
+        bert_config = create_bert_config(config)
 
         self.text_encoder = BertForMaskedLM.from_pretrained(
             text_encoder, config=bert_config
@@ -63,20 +57,19 @@ class ALBEF(nn.Module):
         self.text_proj = nn.Linear(text_width, embed_dim)
 
         self.temp = nn.Parameter(torch.ones([]) * config["temp"])
-        self.queue_size = config["queue_size"]
-        self.momentum = config["momentum"]
         self.itm_head = nn.Linear(text_width, 2)
+        # shared by the CMA and IMC g2g losses, --compile fuses it into one graph
+        self.contrastive_loss = ContrastiveLoss()
+        # negative keys per chunk of the streamed g2l loss
+        self.g2l_chunk_size = config.get("g2l_chunk_size", 4096)
+        # loss terms ("itc", "g2g", "g2l") taking their negatives from all ranks
+        self.gather_negatives = config.get("gather_negatives") or {}
 
         # create momentum models
-        self.visual_encoder_m = VisionTransformer(
-            img_size=config["image_res"],
-            patch_size=16,
-            embed_dim=768,
-            depth=12,
-            num_heads=12,
-            mlp_ratio=4,
-            qkv_bias=True,
-            norm_layer=partial(nn.LayerNorm, eps=1e-6),
+        self.visual_encoder_m = create_vit(
+            config,
+            momentum=True,
+            patch_keep_ratio=config.get("patch_keep_ratio_m", 1.0),
         )
 
         self.vision_proj_m = nn.Linear(vision_width, embed_dim)
@@ -86,31 +79,57 @@ class ALBEF(nn.Module):
         )
         self.text_proj_m = nn.Linear(text_width, embed_dim)
 
-        self.model_pairs = [
-            [self.visual_encoder, self.visual_encoder_m],
-            [self.vision_proj, self.vision_proj_m],
-            [self.text_encoder, self.text_encoder_m],
-            [self.text_proj, self.text_proj_m],
-        ]
-
-        self.copy_params()
+        self.init_momentum(
+            config,
+            [
+                [self.visual_encoder, self.visual_encoder_m],
+                [self.vision_proj, self.vision_proj_m],
+                [self.text_encoder, self.text_encoder_m],
+                [self.text_proj, self.text_proj_m],
+            ],
+            momentum=config["momentum"],
+        )
 
         # create the queue
-        self.register_buffer("image_queue", torch.randn(embed_dim, self.queue_size))
-        self.register_buffer("text_queue", torch.randn(embed_dim, self.queue_size))
-        self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
+        self.init_queue(embed_dim, config["queue_size"])
+
+        # lightweight teacher: resolution of the momentum ViT
+        self.teacher_image_res = config.get("teacher_image_res")
 
-        self.image_queue = nn.functional.normalize(self.image_queue, dim=0)
-        self.text_queue = nn.functional.normalize(self.text_queue, dim=0)
+        # never selected by the MLM masking
+        self.register_buffer(
+            "mlm_special_ids",
+            torch.tensor(tokenizer.all_special_ids, dtype=torch.long),
+            persistent=False,
+        )
 
-    def forward(self, image, image_aug, text, alpha=0, neg_thresh=0, epoch=None):
+    def forward(
+        self,
+        image,
+        image_aug,
+        text,
+        alpha=0,
+        neg_thresh=0,
+        epoch=None,
+        mlm_input_ids=None,
+        mlm_labels=None,
+        teacher=None,
+        rows=None,
+    ):
         with torch.no_grad():
             self.temp.clamp_(0.001, 0.5)
 
+        # the inputs are those of the logical batch, trained on at rows (a
+        # micro-batch) if given
+        batch_image, batch_text = image, text
+        if rows is None:
+            rows = slice(0, image.size(0))
+        else:
+            image, text = image[rows], slice_batch(text, rows)
+            mlm_input_ids = slice_batch(mlm_input_ids, rows)
+            mlm_labels = slice_batch(mlm_labels, rows)
+
         image_embeds = self.visual_encoder(image)
-        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-            image.device
-        )
 
         image_feat = F.normalize(self.vision_proj(image_embeds[:, 0, :]), dim=-1)
 
@@ -125,123 +144,84 @@ class ALBEF(nn.Module):
 
         ###================ get it sim =================###
 
-        # get momentum features
-        with torch.no_grad():
-            self._momentum_update()
-            image_embeds_m = self.visual_encoder_m(image_aug)
-            image_feat_m = F.normalize(
-                self.vision_proj_m(image_embeds_m[:, 0, :]), dim=-1
-            )
-            # local visual features
-            image_feat_m_l = F.normalize(
-                self.vision_proj_m(image_embeds_m[:, 1:, :]), dim=-1
-            )
-            image_feat_m_l = self.patch_pooling(
-                image_feat_m_l
-            )  # pooling for image patches
-            image_feat_all = torch.cat(
-                [image_feat_m.t(), self.image_queue.clone().detach()], dim=1
-            )
-            text_output_m = self.text_encoder_m.bert(
-                text.input_ids,
-                attention_mask=text.attention_mask,
-                return_dict=True,
-                mode="text",
-            )
-            text_feat_m = F.normalize(
-                self.text_proj_m(text_output_m.last_hidden_state[:, 0, :]), dim=-1
-            )
-            # local textual features
-            text_feat_m_l = F.normalize(
-                self.text_proj_m(text_output_m.last_hidden_state[:, 1:, :]), dim=-1
-            )
-            text_feat_all = torch.cat(
-                [text_feat_m.t(), self.text_queue.clone().detach()], dim=1
-            )
-
-            sim_i2t_m = image_feat_m @ text_feat_all / self.temp
-            sim_t2i_m = text_feat_m @ image_feat_all / self.temp
-
-            sim_targets = torch.zeros(sim_i2t_m.size()).to(image.device)
-            sim_targets.fill_diagonal_(1)
-
-            sim_i2t_targets = (
-                alpha * F.softmax(sim_i2t_m, dim=1) + (1 - alpha) * sim_targets
-            )
-            sim_t2i_targets = (
-                alpha * F.softmax(sim_t2i_m, dim=1) + (1 - alpha) * sim_targets
-            )
+        # get momentum features of the logical batch, unless given by its
+        # teacher_step
+        if teacher is None:
+            teacher = self.teacher_step(image_aug, batch_text)
+        batch_teacher, teacher = teacher, slice_batch(teacher, rows)
+        image_feat_m = teacher["image_feat_m"]
+        text_feat_m = teacher["text_feat_m"]
+        batch_cols = teacher["batch_cols"]
+
+        with torch.no_grad(), self.momentum_updater.autocast(image.device):
+            image_feat_all = self.image_queue
+            text_feat_all = self.text_queue
+
+            # distilled part of the targets, the one-hot part is batch_cols
+            sim_i2t_soft = sim_t2i_soft = None
+            if alpha > 0:
+                sim_i2t_m = image_feat_m @ text_feat_all / self.temp
+                sim_t2i_m = text_feat_m @ image_feat_all / self.temp
+                sim_i2t_soft = alpha * F.softmax(sim_i2t_m.float(), dim=1)
+                sim_t2i_soft = alpha * F.softmax(sim_t2i_m.float(), dim=1)
+
+        sim_i2t, sim_t2i, sim_i2i, sim_t2t = stacked_similarities(
+            image_feat, text_feat, image_feat_all, text_feat_all, self.temp
+        )
 
-        sim_i2t = image_feat @ text_feat_all / self.temp
-        sim_t2i = text_feat @ image_feat_all / self.temp
+        # negatives of all ranks with their gradient
+        sim_i2t, sim_t2i, sim_i2i, sim_t2t = self.rescore_negatives(
+            (sim_i2t, sim_t2i, sim_i2i, sim_t2t),
+            image_feat,
+            text_feat,
+            batch_cols,
+            batch_cols,
+        )
 
         ###============= ITM ====================###
-        # forward the positve image-text pair
-        output_pos = self.text_encoder.bert(
-            encoder_embeds=text_embeds,
-            attention_mask=text.attention_mask,
-            encoder_hidden_states=image_embeds,
-            encoder_attention_mask=image_atts,
-            return_dict=True,
-            mode="fusion",
-        )
         with torch.no_grad():
             bs = image.size(0)
-            weights_i2t = F.softmax(sim_i2t[:, :bs], dim=1)
-            weights_t2i = F.softmax(sim_t2i[:, :bs], dim=1)
-
-            weights_i2t.fill_diagonal_(0)
-            weights_t2i.fill_diagonal_(0)
-
-        # select a negative image for each text
-        image_embeds_neg = []
-        for b in range(bs):
-            try:
-                neg_idx = torch.multinomial(weights_t2i[b], 1).item()
-            except:
-                neg_idx = torch.randint(0, bs, (1,)).item()
-                while neg_idx == b:
-                    neg_idx = torch.randint(0, bs, (1,)).item()
-            image_embeds_neg.append(image_embeds[neg_idx])
-        image_embeds_neg = torch.stack(image_embeds_neg, dim=0)
-
-        # select a negative text for each image
-        text_embeds_neg = []
-        text_atts_neg = []
-        for b in range(bs):
-            try:
-                neg_idx = torch.multinomial(weights_i2t[b], 1).item()
-            except:
-                neg_idx = torch.randint(0, bs, (1,)).item()
-                while neg_idx == b:
-                    neg_idx = torch.randint(0, bs, (1,)).item()
-            text_embeds_neg.append(text_embeds[neg_idx])
-            text_atts_neg.append(text.attention_mask[neg_idx])
-        text_embeds_neg = torch.stack(text_embeds_neg, dim=0)
-        text_atts_neg = torch.stack(text_atts_neg, dim=0)
-
-        text_embeds_all = torch.cat([text_embeds, text_embeds_neg], dim=0)
-        text_atts_all = torch.cat([text.attention_mask, text_atts_neg], dim=0)
-
-        image_embeds_all = torch.cat([image_embeds_neg, image_embeds], dim=0)
-        image_atts_all = torch.cat([image_atts, image_atts], dim=0)
-
-        output_neg = self.text_encoder.bert(
-            encoder_embeds=text_embeds_all,
-            attention_mask=text_atts_all,
-            encoder_hidden_states=image_embeds_all,
-            encoder_attention_mask=image_atts_all,
+            # hard negatives from the whole logical batch, at its bank columns
+            batch_size = batch_image.size(0)
+            cols = batch_teacher["batch_cols"]
+            weights_i2t = F.softmax(sim_i2t[:, cols].float(), dim=1)
+            weights_t2i = F.softmax(sim_t2i[:, cols].float(), dim=1)
+
+            weights_i2t[:, rows].fill_diagonal_(0)
+            weights_t2i[:, rows].fill_diagonal_(0)
+
+        # the 3B pairs go through the fusion encoder as one batch, the negatives
+        # of the other micro-batches through the online encoders first
+        text_idx, image_idx = self.sample_itm_pairs(
+            weights_i2t, weights_t2i, offset=rows.start
+        )
+        itm_text_embeds = self.batch_embeddings(
+            text_embeds,
+            rows.start,
+            text_idx,
+            batch_size,
+            lambda others: self.text_encoder.bert(
+                batch_text.input_ids[others],
+                attention_mask=batch_text.attention_mask[others],
+                return_dict=True,
+                mode="text",
+            ).last_hidden_state,
+        )
+        itm_image_embeds = self.batch_embeddings(
+            image_embeds,
+            rows.start,
+            image_idx,
+            batch_size,
+            lambda others: self.visual_encoder(batch_image[others]),
+        )
+        output_itm = self.text_encoder.bert(
+            encoder_embeds=itm_text_embeds,
+            attention_mask=batch_text.attention_mask[text_idx],
+            encoder_hidden_states=itm_image_embeds,
             return_dict=True,
             mode="fusion",
         )
-
-        vl_embeddings = torch.cat(
-            [
-                output_pos.last_hidden_state[:, 0, :],
-                output_neg.last_hidden_state[:, 0, :],
-            ],
-            dim=0,
-        )
+        vl_embeddings = output_itm.last_hidden_state[:, 0, :]
         vl_output = self.itm_head(vl_embeddings)
 
         itm_labels = torch.cat(
@@ -252,44 +232,54 @@ class ALBEF(nn.Module):
 
         ###============= ITC ====================###
 
-        # select the negative learning samples with given neg_thresh
+        # select the negative learning samples with given neg_thresh, the
+        # fraction of pairs kept for positive learning is logged
+        self.selected_ratio = torch.ones((), device=image.device)
         if neg_thresh > 0:
             # IT Pair confidence
             with torch.no_grad():
-                confidence = F.softmax(vl_output[:bs], dim=1)
+                confidence = F.softmax(vl_output[:bs].float(), dim=1)
                 confidence = confidence[:, 1].view(-1)
 
             sp = get_select_index(confidence, neg_thresh)
+            self.selected_ratio = sp.float().mean()
+
+            with torch.no_grad():
+                sim_targets = torch.zeros(sim_i2t.size()).to(image.device)
+                sim_targets.scatter_(1, batch_cols.unsqueeze(1), 1 - alpha)
+                sim_i2t_targets = sim_targets
+                sim_t2i_targets = sim_targets
+                if alpha > 0:
+                    sim_i2t_targets = sim_targets + sim_i2t_soft
+                    sim_t2i_targets = sim_targets + sim_t2i_soft
 
             # CMA NL+PL with smoothen and sharpen
             loss_i2t = negative_cross_entropy(
-                F.softmax(sim_i2t, dim=1), sp, targets=sim_i2t_targets
+                F.softmax(sim_i2t.float(), dim=1),
+                sp,
+                targets=sim_i2t_targets,
+                pos_cols=batch_cols,
             )
             loss_t2i = negative_cross_entropy(
-                F.softmax(sim_t2i, dim=1), sp, targets=sim_t2i_targets
+                F.softmax(sim_t2i.float(), dim=1),
+                sp,
+                targets=sim_t2i_targets,
+                pos_cols=batch_cols,
             )
 
         else:
             # CMA PL with smoothen
-            loss_i2t = -torch.sum(
-                F.log_softmax(sim_i2t, dim=1) * sim_i2t_targets, dim=1
-            ).mean()
-            loss_t2i = -torch.sum(
-                F.log_softmax(sim_t2i, dim=1) * sim_t2i_targets, dim=1
-            ).mean()
-
-        # IMC: g2l loss
-        loss_t2t_inMod_l = self.in_batch_g2l_loss(
-            text_feat_m_l, text_feat, self.temp, text.attention_mask[:, 1:]
+            loss_i2t = self.contrastive_loss(sim_i2t, batch_cols, sim_i2t_soft)
+            loss_t2i = self.contrastive_loss(sim_t2i, batch_cols, sim_t2i_soft)
+
+        # IMC: g2l loss, against the local features of all ranks if gathered
+        loss_t2t_inMod_l, loss_i2i_inMod_l = self.g2l_losses(
+            batch_teacher, image_feat, text_feat, rows.start
         )
-        loss_i2i_inMod_l = self.in_batch_g2l_loss(image_feat_m_l, image_feat, self.temp)
 
         # IMC: g2g loss
-        sim_i2i = image_feat @ image_feat_all / self.temp
-        sim_t2t = text_feat @ text_feat_all / self.temp
-
-        loss_i2i = -torch.sum(F.log_softmax(sim_i2i, dim=1) * sim_targets, dim=1).mean()
-        loss_t2t = -torch.sum(F.log_softmax(sim_t2t, dim=1) * sim_targets, dim=1).mean()
+        loss_i2i = self.contrastive_loss(sim_i2i, batch_cols)
+        loss_t2t = self.contrastive_loss(sim_t2t, batch_cols)
 
         loss_ita = (
             loss_t2t_inMod_l
@@ -300,27 +290,23 @@ class ALBEF(nn.Module):
             + loss_t2t
         ) / 6
 
-        self._dequeue_and_enqueue(image_feat_m, text_feat_m)
-
         ##================= MLM ========================##
-        input_ids = text.input_ids.clone()
-        labels = input_ids.clone()
-
-        probability_matrix = torch.full(labels.shape, self.mlm_probability)
-        input_ids, labels = self.mask(
-            input_ids,
-            self.text_encoder.config.vocab_size,
-            image.device,
-            targets=labels,
-            probability_matrix=probability_matrix,
-        )
+        # masked in the loader workers by pretrain_collate_fn, or here on the device
+        if mlm_input_ids is None:
+            mlm_input_ids, mlm_labels = mask_tokens(
+                text.input_ids,
+                self.mlm_special_ids,
+                self.tokenizer.mask_token_id,
+                self.text_encoder.config.vocab_size,
+                self.mlm_probability,
+            )
+        input_ids, labels = mlm_input_ids, mlm_labels
 
-        with torch.no_grad():
+        with torch.no_grad(), self.momentum_updater.autocast(image.device):
             logits_m = self.text_encoder_m(
                 input_ids,
                 attention_mask=text.attention_mask,
-                encoder_hidden_states=image_embeds_m,
-                encoder_attention_mask=image_atts,
+                encoder_hidden_states=teacher["image_embeds_m"],
                 return_dict=True,
                 return_logits=True,
             )
@@ -328,10 +314,9 @@ class ALBEF(nn.Module):
             input_ids,
             attention_mask=text.attention_mask,
             encoder_hidden_states=image_embeds,
-            encoder_attention_mask=image_atts,
             return_dict=True,
             labels=labels,
-            soft_labels=F.softmax(logits_m, dim=-1),
+            soft_labels=F.softmax(logits_m.float(), dim=-1),
             alpha=alpha,
         )
         loss_mlm = mlm_output.loss
@@ -341,179 +326,100 @@ class ALBEF(nn.Module):
         return loss_mlm, loss_ita, loss_itm
 
     @torch.no_grad()
-    def copy_params(self):
-        for model_pair in self.model_pairs:
-            for param, param_m in zip(
-                model_pair[0].parameters(), model_pair[1].parameters()
-            ):
-                param_m.data.copy_(param.data)  # initialize
-                param_m.requires_grad = False  # not update by gradient
-
-    @torch.no_grad()
-    def _momentum_update(self):
-        for model_pair in self.model_pairs:
-            for param, param_m in zip(
-                model_pair[0].parameters(), model_pair[1].parameters()
-            ):
-                param_m.data = param_m.data * self.momentum + param.data * (
-                    1.0 - self.momentum
-                )
-
-    @torch.no_grad()
-    def _dequeue_and_enqueue(self, image_feat, text_feat):
-        # gather keys before updating queue
-        image_feats = concat_all_gather(image_feat)
-        text_feats = concat_all_gather(text_feat)
-
-        batch_size = image_feats.shape[0]
-
-        ptr = int(self.queue_ptr)
-        assert self.queue_size % batch_size == 0  # for simplicity
-
-        # replace the keys at ptr (dequeue and enqueue)
-        self.image_queue[:, ptr : ptr + batch_size] = image_feats.T
-        self.text_queue[:, ptr : ptr + batch_size] = text_feats.T
-        ptr = (ptr + batch_size) % self.queue_size  # move pointer
-
-        self.queue_ptr[0] = ptr
-
-    def mask(
-        self,
-        input_ids,
-        vocab_size,
-        device,
-        targets=None,
-        masked_indices=None,
-        probability_matrix=None,
-    ):
-        if masked_indices is None:
-            masked_indices = torch.bernoulli(probability_matrix).bool()
-
-        masked_indices[input_ids == self.tokenizer.pad_token_id] = False
-        masked_indices[input_ids == self.tokenizer.cls_token_id] = False
-
-        if targets is not None:
-            targets[~masked_indices] = -100  # We only compute loss on masked tokens
-
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = (
-            torch.bernoulli(torch.full(input_ids.shape, 0.8)).bool() & masked_indices
+    def teacher_forward(self, image_aug, text, micro_batch_size=None):
+        """Outputs of the momentum encoders used by the losses."""
+        if micro_batch_size is not None:
+            return concat_outputs(
+                [
+                    self.teacher_forward(image_aug[chunk], slice_batch(text, chunk))
+                    for chunk in micro_batches(image_aug.size(0), micro_batch_size)
+                ]
+            )
+        if self.teacher_image_res:
+            image_aug = F.interpolate(
+                image_aug,
+                size=self.teacher_image_res,
+                mode="bilinear",
+                align_corners=False,
+                antialias=True,
+            )
+        image_embeds_m, keep_ids_m = self.visual_encoder_m(
+            image_aug, return_keep_ids=True
         )
-        input_ids[indices_replaced] = self.tokenizer.mask_token_id
-
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = (
-            torch.bernoulli(torch.full(input_ids.shape, 0.5)).bool()
-            & masked_indices
-            & ~indices_replaced
+        image_feat_m = F.normalize(self.vision_proj_m(image_embeds_m[:, 0, :]), dim=-1)
+        # local visual features
+        # (in fp32, the momentum copies may run in low precision)
+        image_feat_m_l = F.normalize(
+            self.vision_proj_m(image_embeds_m[:, 1:, :]).float(), dim=-1
+        )
+        patch_size = self.visual_encoder_m.patch_embed.patch_size[0]
+        image_feat_m_l, image_atts_m_l = self.patch_pooling(
+            image_feat_m_l,
+            keep_ids_m,
+            num_patches=(image_aug.size(-1) // patch_size) ** 2,
+        )  # pooling for image patches
+        text_output_m = self.text_encoder_m.bert(
+            text.input_ids,
+            attention_mask=text.attention_mask,
+            return_dict=True,
+            mode="text",
         )
-        random_words = torch.randint(vocab_size, input_ids.shape, dtype=torch.long).to(
-            device
+        text_feat_m = F.normalize(
+            self.text_proj_m(text_output_m.last_hidden_state[:, 0, :]), dim=-1
         )
-        input_ids[indices_random] = random_words[indices_random]
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-
-        if targets is not None:
-            return input_ids, targets
-        else:
-            return input_ids
-
-    # IMC: patch pooling of image patches to reduce computation and enlarge receptive field
-    def patch_pooling(self, x):
-        batch_size, seq_length, dim = x.size()
-        b1 = int(np.sqrt(seq_length))
-        x = x.reshape(batch_size, b1, b1, dim)
-        x = x.permute(0, 3, 1, 2)
-        c1 = int(np.sqrt(b1))
-        x = F.avg_pool2d(x, c1, stride=c1)
-        x = x.permute(0, 2, 3, 1).reshape(batch_size, c1 * c1, dim)
-        return x
-
-    # IMC: g2l loss
-    def in_batch_g2l_loss(self, l, m, temp, attention_mask=None):
-        m = m.unsqueeze(1)
-        N, n_locals, dim = l.size()
-        l_n = l.reshape(-1, dim)  # (N * n_locals) * d
-        m_n = m.reshape(-1, dim)  # N * d
-
-        # Inner product for positive samples. Outer product for negative. We need to do it this way
-        # for the multiclass loss. For the outer product, we want a N x N x n_locals x 1 tensor.
-        u_p = (
-            torch.matmul(l, m.permute(0, 2, 1)).unsqueeze(2) / temp
-        )  # N * n_locals * 1 * 1
-
-        # if l comes from text, then attention_mask is not None
-        if attention_mask is not None:
-            temp_mask = attention_mask.unsqueeze(2).unsqueeze(3)
-            u_p = (temp_mask * u_p) + (10000.0 * (1 - temp_mask))
-
-        u_n = torch.mm(m_n, l_n.t()) / temp
-        u_n = u_n.reshape(N, 1, N, n_locals).permute(0, 2, 3, 1)  # N x N x n_locals x 1
-
-        # We need to mask the diagonal part of the negative tensor.
-        mask = torch.eye(N)[:, :, None, None].to(l.device)  # N*N*1*1
-        n_mask = 1 - mask
-
-        # Masking is done by shifting the diagonal before exp.
-        u_n = (n_mask * u_n) - (10000.0 * (1 - n_mask))  # mask out "self" examples
-        # if l comes from test, we mask out the padding tokens
-        if attention_mask is not None:
-            temp_mask = attention_mask.unsqueeze(0).unsqueeze(3).expand(N, -1, -1, -1)
-            u_n = (temp_mask * u_n) - (10000.0 * (1 - temp_mask))
-
-        u_n = (
-            u_n.reshape(N, N * n_locals, 1)
-            .unsqueeze(dim=1)
-            .expand(-1, n_locals, -1, -1)
+        # local textual features
+        text_feat_m_l = F.normalize(
+            self.text_proj_m(text_output_m.last_hidden_state[:, 1:, :]).float(),
+            dim=-1,
         )
-
-        # Since this is multiclass, we concat the positive along the class dimension before performing log softmax.
-        pred_lgt = torch.cat([u_p, u_n], dim=2)
-        pred_log = F.log_softmax(pred_lgt, dim=2)
-
-        # The positive score is the first element of the log softmax.
-        if attention_mask is not None:
-            loss = (
-                torch.sum(-pred_log[:, :, 0].squeeze(), dim=1)
-                / torch.sum(attention_mask, dim=1)
-            ).mean()
-        else:
-            loss = -pred_log[:, :, 0].mean()
-
-        return loss
-
-
-def negative_cross_entropy(logits, sp, targets=None):
+        return {
+            "image_embeds_m": image_embeds_m,
+            "image_feat_m": image_feat_m,
+            "image_feat_m_l": image_feat_m_l,
+            "image_atts_m_l": image_atts_m_l,
+            "text_feat_m": text_feat_m,
+            "text_feat_m_l": text_feat_m_l,
+            "text_atts_m_l": text.attention_mask[:, 1:],
+        }
+
+
+def negative_cross_entropy(logits, sp, targets=None, pos_cols=None):
     """Compute the both negative and positive cross entropy loss.
 
     Args:
         logits (tensor): (batch_size, xxx) the image-text logits after softmax
         sp (tensor): (batch_size, ) selection indicator, true for positive, false for negative
+        pos_cols (tensor, optional): (batch_size, ) column of the positive of each row, the diagonal by default
 
     Returns:
         loss: positive loss + negative loss
     """
+    if pos_cols is None:
+        pos_cols = torch.arange(logits.size(0), device=logits.device)
+    pos_cols = pos_cols.unsqueeze(1)
+
     if targets is None:
         targets = torch.zeros(logits.size()).to(logits.device)
-        targets.fill_diagonal_(1)
-
-    # positive
-    if sp.any():
-        p_loss = -torch.sum(torch.log(logits[sp]) * targets[sp], dim=1).mean()
-    else:
-        p_loss = 0
-
-    # negative
-    if not sp.all():
-        targets = sharpen(targets)
-        targets.fill_diagonal_(1)
-
-        n_loss = -torch.sum(
-            torch.log(1 - logits[~sp]) * (1 - targets[~sp]), dim=1,
-        ).mean()
-    else:
-        n_loss = 0
-
+        targets.scatter_(1, pos_cols, 1)
+
+    # the positive rows take -log(p) * targets, the negative ones -log(1 - p) *
+    # (1 - sharpened targets), chosen per row with a mask: the rows of the
+    # (batch_size, num_keys) matrices are never copied out, and there is no
+    # host sync on the number of selected rows
+    with torch.no_grad():
+        neg_targets = sharpen(targets)
+        neg_targets.scatter_(1, pos_cols, 1)
+        neg_targets.neg_().add_(1)
+        row_sp = sp.unsqueeze(1)
+        weights = torch.where(row_sp, targets, neg_targets)
+    row_loss = -torch.sum(
+        torch.log(torch.where(row_sp, logits, 1 - logits)) * weights, dim=1
+    )
+
+    # means over the positive and over the negative rows, 0 if there are none
+    sp = sp.float()
+    p_loss = torch.sum(row_loss * sp) / sp.sum().clamp(min=1)
+    n_loss = torch.sum(row_loss * (1 - sp)) / (1 - sp).sum().clamp(min=1)
     return p_loss + n_loss
 
 
@@ -531,16 +437,20 @@ def get_select_index(confidence, neg_thresh, prob_weighted=False):
     """
     assert neg_thresh <= 1
     candidate_size = int(len(confidence) * neg_thresh)
-    candidate_index = confidence.argsort()[:candidate_size]
+    if candidate_size == 0:
+        return torch.ones_like(confidence, dtype=torch.bool)
 
-    ones = torch.ones(confidence.shape).to(confidence.device)
+    # exactly the candidate_size least confident pairs, ties included, by
+    # selection rather than a sort
+    candidates = torch.zeros_like(confidence, dtype=torch.bool)
+    candidates[confidence.topk(candidate_size, largest=False).indices] = True
 
     if prob_weighted:
-        prob = torch.clamp(confidence[candidate_index] / confidence.max(), min=0, max=1)
+        prob = torch.clamp(confidence / confidence.max(), min=0, max=1)
     else:
-        prob = confidence[candidate_index]
-    sp = ones.scatter(0, candidate_index, prob)
-    return torch.bernoulli(sp).bool()
+        prob = confidence
+    # candidates are kept as positives with probability prob, the others always
+    return torch.bernoulli(torch.where(candidates, prob, 1.0)).bool()
 
 
 @torch.no_grad()
@@ -557,19 +467,3 @@ def sharpen(p, temp=0.5):
     ps = p ** (1 / temp)
     targets = ps / ps.sum(dim=1, keepdim=True)
     return targets
-
-
-@torch.no_grad()
-def concat_all_gather(tensor):
-    """
-    Performs all_gather operation on the provided tensors.
-    *** Warning ***: torch.distributed.all_gather has no gradient.
-    """
-    tensors_gather = [
-        torch.ones_like(tensor) for _ in range(torch.distributed.get_world_size())
-    ]
-    torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
-
-    output = torch.cat(tensors_gather, dim=0)
-    return output
-
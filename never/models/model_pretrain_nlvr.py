@@ -1,14 +1,12 @@
-from functools import partial
-
 import torch
 import torch.nn.functional as F
 from torch import nn
 
-from models.vit import VisionTransformer
-from models.xbert import BertConfig, BertModel
+from models.albef import ALBEFBase, create_bert_config, create_vit
+from models.xbert import BertModel
 
 
-class ALBEF(nn.Module):
+class ALBEF(ALBEFBase):
     def __init__(
         self, text_encoder=None, tokenizer=None, config=None,
     ):
@@ -18,19 +16,9 @@ class ALBEF(nn.Module):
         vision_width = config["vision_width"]
         embed_dim = config["embed_dim"]
 
-        self.visual_encoder = VisionTransformer(
-            img_size=config["image_res"],
-            patch_size=16,
-            embed_dim=768,
-            depth=12,
-            num_heads=12,
-            mlp_ratio=4,
-            qkv_bias=True,
-            norm_layer=partial(nn.LayerNorm, eps=1e-6),
-        )
+        self.visual_encoder = create_vit(config)
 
-        bert_config = BertConfig.from_json_file(config["bert_config"])
-        bert_config.num_hidden_layers = 18
+        bert_config = create_bert_config(config, num_hidden_layers=18)
         self.text_encoder = BertModel.from_pretrained(
             text_encoder, config=bert_config, add_pooling_layer=False
         )
@@ -46,13 +34,10 @@ class ALBEF(nn.Module):
 
     def forward(self, image, text):
         image_embeds = self.visual_encoder(image)
-        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-            image.device
-        )
         with torch.no_grad():
             image_feat = F.normalize(self.vision_proj(image_embeds[:, 0, :]), dim=-1)
             sim = image_feat @ image_feat.t() / 0.07
-            weights = F.softmax(sim, dim=1)
+            weights = F.softmax(sim.float(), dim=1)
             weights.fill_diagonal_(0)
 
         image_inputs = [[], []]
@@ -82,7 +67,6 @@ class ALBEF(nn.Module):
             text.input_ids,
             attention_mask=text.attention_mask,
             encoder_hidden_states=image_inputs,
-            encoder_attention_mask=[image_atts, image_atts],
             return_dict=True,
         )
 
@@ -90,20 +74,3 @@ class ALBEF(nn.Module):
         loss = F.cross_entropy(pred, labels)
 
         return loss
-
-    def share_cross_attention(self, model):
-
-        for i in range(6):
-            layer_num = 6 + i * 2
-            modules_0 = model.layer[layer_num].crossattention.self._modules
-            modules_1 = model.layer[layer_num + 1].crossattention.self._modules
-
-            for name in modules_0.keys():
-                if "key" in name or "value" in name:
-                    module_0 = modules_0[name]
-                    module_1 = modules_1[name]
-                    if hasattr(module_0, "weight"):
-                        module_0.weight = module_1.weight
-                        if hasattr(module_0, "bias"):
-                            module_0.bias = module_1.bias
-
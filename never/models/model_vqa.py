@@ -1,15 +1,11 @@
-from functools import partial
-
-import numpy as np
 import torch
 import torch.nn.functional as F
-from torch import nn
 
-from models.vit import VisionTransformer
-from models.xbert import BertConfig, BertLMHeadModel, BertModel
+from models.albef import ALBEFBase, create_bert_config, create_vit
+from models.xbert import BertLMHeadModel, BertModel
 
 
-class ALBEF(nn.Module):
+class ALBEF(ALBEFBase):
     def __init__(
         self, text_encoder=None, text_decoder=None, tokenizer=None, config=None,
     ):
@@ -18,62 +14,42 @@ class ALBEF(nn.Module):
         self.tokenizer = tokenizer
         self.distill = config["distill"]
 
-        self.visual_encoder = VisionTransformer(
-            img_size=config["image_res"],
-            patch_size=16,
-            embed_dim=768,
-            depth=12,
-            num_heads=12,
-            mlp_ratio=4,
-            qkv_bias=True,
-            norm_layer=partial(nn.LayerNorm, eps=1e-6),
-        )
+        self.visual_encoder = create_vit(config)
 
-        config_encoder = BertConfig.from_json_file(config["bert_config"])
+        config_encoder = create_bert_config(config)
         self.text_encoder = BertModel.from_pretrained(
             text_encoder, config=config_encoder, add_pooling_layer=False
         )
 
-        config_decoder = BertConfig.from_json_file(config["bert_config"])
-        config_decoder.fusion_layer = 0
-        config_decoder.num_hidden_layers = 6
+        config_decoder = create_bert_config(
+            config, fusion_layer=0, num_hidden_layers=6
+        )
         self.text_decoder = BertLMHeadModel.from_pretrained(
             text_decoder, config=config_decoder
         )
 
         if self.distill:
-            self.visual_encoder_m = VisionTransformer(
-                img_size=config["image_res"],
-                patch_size=16,
-                embed_dim=768,
-                depth=12,
-                num_heads=12,
-                mlp_ratio=4,
-                qkv_bias=True,
-                norm_layer=partial(nn.LayerNorm, eps=1e-6),
-            )
+            self.visual_encoder_m = create_vit(config, momentum=True)
             self.text_encoder_m = BertModel.from_pretrained(
                 text_encoder, config=config_encoder, add_pooling_layer=False
             )
             self.text_decoder_m = BertLMHeadModel.from_pretrained(
                 text_decoder, config=config_decoder
             )
-            self.model_pairs = [
-                [self.visual_encoder, self.visual_encoder_m],
-                [self.text_encoder, self.text_encoder_m],
-                [self.text_decoder, self.text_decoder_m],
-            ]
-            self.copy_params()
-            self.momentum = 0.995
+            self.init_momentum(
+                config,
+                [
+                    [self.visual_encoder, self.visual_encoder_m],
+                    [self.text_encoder, self.text_encoder_m],
+                    [self.text_decoder, self.text_decoder_m],
+                ],
+            )
 
     def forward(
         self, image, quesiton, answer=None, alpha=0, k=None, weights=None, train=True
     ):
 
         image_embeds = self.visual_encoder(image)
-        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-            image.device
-        )
 
         if train:
             """
@@ -88,7 +64,6 @@ class ALBEF(nn.Module):
                 quesiton.input_ids,
                 attention_mask=quesiton.attention_mask,
                 encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
                 return_dict=True,
             )
 
@@ -101,14 +76,13 @@ class ALBEF(nn.Module):
             question_atts = torch.stack(question_atts, 0)
 
             if self.distill:
-                with torch.no_grad():
+                with torch.no_grad(), self.momentum_updater.autocast(image.device):
                     self._momentum_update()
                     image_embeds_m = self.visual_encoder_m(image)
                     question_output_m = self.text_encoder_m(
                         quesiton.input_ids,
                         attention_mask=quesiton.attention_mask,
                         encoder_hidden_states=image_embeds_m,
-                        encoder_attention_mask=image_atts,
                         return_dict=True,
                     )
 
@@ -134,7 +108,7 @@ class ALBEF(nn.Module):
                     encoder_attention_mask=question_atts,
                     labels=answer_targets,
                     return_dict=True,
-                    soft_labels=F.softmax(logits_m, dim=-1),
+                    soft_labels=F.softmax(logits_m.float(), dim=-1),
                     reduction="none",
                 )
             else:
@@ -157,7 +131,6 @@ class ALBEF(nn.Module):
                 quesiton.input_ids,
                 attention_mask=quesiton.attention_mask,
                 encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
                 return_dict=True,
             )
             topk_ids, topk_probs = self.rank_answer(
@@ -169,25 +142,6 @@ class ALBEF(nn.Module):
             )
             return topk_ids, topk_probs
 
-    @torch.no_grad()
-    def copy_params(self):
-        for model_pair in self.model_pairs:
-            for param, param_m in zip(
-                model_pair[0].parameters(), model_pair[1].parameters()
-            ):
-                param_m.data.copy_(param.data)  # initialize
-                param_m.requires_grad = False  # not update by gradient
-
-    @torch.no_grad()
-    def _momentum_update(self):
-        for model_pair in self.model_pairs:
-            for param, param_m in zip(
-                model_pair[0].parameters(), model_pair[1].parameters()
-            ):
-                param_m.data = param_m.data * self.momentum + param.data * (
-                    1.0 - self.momentum
-                )
-
     def rank_answer(self, question_states, question_atts, answer_ids, answer_atts, k):
 
         num_ques = question_states.size(0)
@@ -199,6 +153,7 @@ class ALBEF(nn.Module):
             encoder_attention_mask=question_atts,
             return_dict=True,
             reduction="none",
+            use_cache=True,
         )
         logits = start_output.logits[:, 0, :]  # first token's logit
 
@@ -210,42 +165,63 @@ class ALBEF(nn.Module):
         )
         topk_probs, topk_ids = prob_first_token.topk(k, dim=1)
 
-        # answer input: [num_question*k, answer_len]
-        input_ids = []
-        input_atts = []
-        for b, topk_id in enumerate(topk_ids):
-            input_ids.append(answer_ids.index_select(dim=0, index=topk_id))
-            input_atts.append(answer_atts.index_select(dim=0, index=topk_id))
-        input_ids = torch.cat(input_ids, dim=0)
-        input_atts = torch.cat(input_atts, dim=0)
-
-        targets_ids = input_ids.masked_fill(
-            input_ids == self.tokenizer.pad_token_id, -100
-        )
+        # score the k candidates of every question by walking the answer trie, so
+        # that a prefix shared by several candidates is decoded only once
+        trie = self.get_answer_trie(answer_ids, answer_atts)
+        cand_ids = topk_ids.view(-1)
+        cand_ques = torch.arange(num_ques, device=cand_ids.device).repeat_interleave(k)
+        cand_lens = trie.lengths[cand_ids]
 
-        # repeat encoder's output for top-k answers
-        question_states = tile(question_states, 0, k)
-        question_atts = tile(question_atts, 0, k)
+        # topk_prob: first token probability
+        log_probs_sum = topk_probs.view(-1).log()
+
+        # decoder row (unique trie node) each candidate currently sits on
+        cand_rows = cand_ques
+        row_ques = torch.arange(num_ques, device=cand_ids.device)
+        past_key_values = start_output.past_key_values
+        step_log_probs = F.log_softmax(logits, dim=-1)
+
+        for t in range(1, trie.max_length):
+            # re-calculate log probabilities for the answer sequences using chain rule
+            tokens = trie.answer_ids[cand_ids, t]
+            alive = t < cand_lens
+            log_probs = step_log_probs[cand_rows, tokens]
+            log_probs_sum = log_probs_sum + log_probs.masked_fill(~alive, 0)
+
+            # candidates whose next token still has to be scored
+            active = (t + 1) < cand_lens
+            if not active.any():
+                break
+
+            nodes = cand_ques * trie.num_nodes + trie.node_ids[cand_ids, t]
+            nodes, inverse = torch.unique(nodes[active], return_inverse=True)
+            num_rows = nodes.size(0)
+            parent_rows = cand_rows.new_empty(num_rows).scatter_(
+                0, inverse, cand_rows[active]
+            )
+            input_ids = tokens.new_empty(num_rows).scatter_(0, inverse, tokens[active])
 
-        output = self.text_decoder(
-            input_ids,
-            attention_mask=input_atts,
-            encoder_hidden_states=question_states,
-            encoder_attention_mask=question_atts,
-            labels=targets_ids,
-            return_dict=True,
-            reduction="none",
-        )
+            past_key_values = tuple(
+                tuple(past_state.index_select(0, parent_rows) for past_state in layer)
+                for layer in past_key_values
+            )
+            row_ques = row_ques.index_select(0, parent_rows)
 
-        answer_loss = output.loss
-        answer_loss = answer_loss.view(input_ids.size(0), -1)
+            output = self.text_decoder(
+                input_ids.unsqueeze(1),
+                encoder_hidden_states=question_states.index_select(0, row_ques),
+                encoder_attention_mask=question_atts.index_select(0, row_ques),
+                past_key_values=past_key_values,
+                return_dict=True,
+                reduction="none",
+                use_cache=True,
+            )
+            past_key_values = output.past_key_values
+            step_log_probs = F.log_softmax(output.logits[:, -1, :], dim=-1)
 
-        # topk_prob: first token probability
-        topk_probs = topk_probs.view(-1, 1)
-        log_probs = torch.cat([topk_probs.log(), -answer_loss], dim=1)
+            cand_rows = torch.zeros_like(cand_rows)
+            cand_rows[active] = inverse
 
-        # re-calculate log probabilities for the answer sequences using chain rule
-        log_probs_sum = log_probs.sum(1)
         log_probs_sum = log_probs_sum.view(num_ques, k)
 
         topk_probs = F.softmax(log_probs_sum, dim=-1)
@@ -255,14 +231,31 @@ class ALBEF(nn.Module):
 
         return topk_ids, topk_probs
 
-
-def tile(x, dim, n_tile):
-    init_dim = x.size(dim)
-    repeat_idx = [1] * x.dim()
-    repeat_idx[dim] = n_tile
-    x = x.repeat(*(repeat_idx))
-    order_index = torch.LongTensor(
-        np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])
-    )
-    return torch.index_select(x, dim, order_index.to(x.device))
-
+    def get_answer_trie(self, answer_ids, answer_atts):
+        # the answer list is tokenized once per evaluation, so compile it only once
+        key = (answer_ids.data_ptr(), tuple(answer_ids.shape), answer_ids.device)
+        if getattr(self, "_answer_trie_key", None) != key:
+            self._answer_trie = AnswerTrie(answer_ids, answer_atts)
+            self._answer_trie_key = key
+        return self._answer_trie
+
+
+class AnswerTrie(object):
+    """Token trie over a padded answer list.
+
+    ``node_ids[a, t]`` identifies the prefix ``answer_ids[a, : t + 1]`` among all
+    prefixes of length ``t + 1``, so two answers share a decoder state at step ``t``
+    iff their node ids at ``t`` are equal.
+    """
+
+    def __init__(self, answer_ids, answer_atts):
+        self.answer_ids = answer_ids
+        self.lengths = answer_atts.sum(1)
+        self.max_length = int(self.lengths.max())
+
+        node_ids = torch.zeros_like(answer_ids)
+        for t in range(1, answer_ids.size(1)):
+            prefix = torch.stack([node_ids[:, t - 1], answer_ids[:, t]], dim=1)
+            _, node_ids[:, t] = torch.unique(prefix, dim=0, return_inverse=True)
+        self.node_ids = node_ids
+        self.num_nodes = int(node_ids.max()) + 1
@@ -0,0 +1,152 @@
+import torch
+from transformers.modeling_utils import prune_linear_layer
+
+from models.vit import Attention, Mlp
+from models.xbert import BertAttention, BertLayer
+
+
+@torch.no_grad()
+def accumulate_importance(model, importance=None):
+    """Add the first order Taylor importance |w * dL/dw| of the current gradients.
+
+    Called after the backward of every calibration batch. The gradients are
+    then cleared, so the importance sums |w * dL/dw| over the batches and the
+    gradients of opposite signs of different batches do not cancel out.
+
+    Args:
+        model (nn.Module): the model the calibration loss was back-propagated through
+        importance (dict, optional): {parameter: importance} of the previous batches
+
+    Returns:
+        dict: {parameter: importance}, importance updated in place if given
+    """
+    importance = {} if importance is None else importance
+    for param in model.parameters():
+        if param.grad is None:
+            continue
+        score = (param * param.grad).abs()
+        if param in importance:
+            importance[param] += score
+        else:
+            importance[param] = score
+        param.grad = None
+    return importance
+
+
+def _taylor(param, importance):
+    if param is None:
+        return 0
+    return importance.get(param, 0)
+
+
+def _rows(linear, importance):
+    # importance of every output feature of a Linear
+    return _taylor(linear.weight, importance).sum(1) + _taylor(linear.bias, importance)
+
+
+def _mlp_linears(module):
+    if isinstance(module, Mlp):
+        return module.fc1, module.fc2
+    return module.intermediate.dense, module.output.dense
+
+
+def head_importance(module, importance):
+    """(num_heads,) importance of the heads of a ViT Attention or a BertAttention."""
+    if isinstance(module, Attention):
+        num_heads, head_dim = module.num_heads, module.head_dim
+        scores = _rows(module.qkv, importance).view(3, num_heads, head_dim).sum((0, 2))
+        proj = module.proj
+    else:
+        num_heads = module.self.num_attention_heads
+        head_dim = module.self.attention_head_size
+        scores = sum(
+            _rows(linear, importance).view(num_heads, head_dim).sum(1)
+            for linear in (module.self.query, module.self.key, module.self.value)
+        )
+        proj = module.output.dense
+    proj_scores = _taylor(proj.weight, importance).sum(0)
+    return scores + proj_scores.view(num_heads, head_dim).sum(1)
+
+
+def mlp_importance(module, importance):
+    """(hidden,) importance of the hidden channels of a ViT Mlp or a BertLayer."""
+    fc_in, fc_out = _mlp_linears(module)
+    return _rows(fc_in, importance) + _taylor(fc_out.weight, importance).sum(0)
+
+
+def prunable_modules(model):
+    """Attention and MLP blocks of the online encoders, keyed by module name.
+
+    Covers the ViT blocks and every BertLayer, both self- and cross-attention.
+    Momentum encoders are skipped, prune_model mirrors their online twin.
+    """
+    heads, mlps = {}, {}
+    for name, module in model.named_modules():
+        if name.split(".")[0].endswith("_m"):
+            continue
+        if isinstance(module, (Attention, BertAttention)):
+            heads[name] = module
+        elif isinstance(module, (Mlp, BertLayer)):
+            mlps[name] = module
+    return heads, mlps
+
+
+def compute_pruning(model, importance, head_ratio, mlp_ratio):
+    """Pruning spec that drops the least important heads and MLP channels.
+
+    importance is accumulated by accumulate_importance over a calibration set,
+    after the backward of the task loss of every batch. Every attention block
+    loses round(head_ratio * num_heads) heads (but keeps at least one), every
+    MLP round(mlp_ratio * hidden) channels.
+    """
+    heads, mlps = prunable_modules(model)
+    pruning = {"heads": {}, "mlp": {}}
+    for name, module in heads.items():
+        scores = head_importance(module, importance)
+        num_prune = min(round(head_ratio * len(scores)), len(scores) - 1)
+        if num_prune > 0:
+            pruned = scores.topk(num_prune, largest=False).indices
+            pruning["heads"][name] = sorted(pruned.tolist())
+    for name, module in mlps.items():
+        scores = mlp_importance(module, importance)
+        num_keep = max(len(scores) - round(mlp_ratio * len(scores)), 1)
+        if num_keep < len(scores):
+            kept = scores.topk(num_keep).indices
+            pruning["mlp"][name] = sorted(kept.tolist())
+    return pruning
+
+
+def prune_model(model, pruning):
+    """Physically remove heads and MLP channels, in place.
+
+    Args:
+        model (nn.Module): an ALBEF model of any task, freshly built or trained
+        pruning (dict): {"heads": {module: [pruned heads]}, "mlp": {module: [kept channels]}},
+            as returned by compute_pruning and stored in the "pruning" entry of
+            pruned checkpoints. The momentum copies of the listed modules, if
+            any, are pruned the same way.
+    """
+    modules = dict(model.named_modules())
+
+    def with_momentum(name):
+        encoder, _, rest = name.partition(".")
+        return [modules[n] for n in (name, encoder + "_m." + rest) if n in modules]
+
+    for name, heads in pruning["heads"].items():
+        for module in with_momentum(name):
+            requires_grad = next(module.parameters()).requires_grad
+            module.prune_heads(heads)
+            module.requires_grad_(requires_grad)
+    for name, kept in pruning["mlp"].items():
+        for module in with_momentum(name):
+            requires_grad = next(module.parameters()).requires_grad
+            fc_in, fc_out = _mlp_linears(module)
+            index = torch.tensor(kept, dtype=torch.long, device=fc_in.weight.device)
+            fc_in = prune_linear_layer(fc_in, index)
+            fc_out = prune_linear_layer(fc_out, index, dim=1)
+            if isinstance(module, Mlp):
+                module.fc1, module.fc2 = fc_in, fc_out
+            else:
+                module.intermediate.dense, module.output.dense = fc_in, fc_out
+            module.requires_grad_(requires_grad)
+    return model
@@ -0,0 +1,64 @@
+import fnmatch
+
+import torch
+import torch.nn as nn
+
+from models.pruning import prune_model
+
+# modules kept in fp32 by default: the heads are tiny and the retrieval ranking
+# is sensitive to the rounding of the projected embeddings
+DEFAULT_SKIP = ["itm_head", "vision_proj", "text_proj"]
+
+
+def strip_momentum(model):
+    """Drop the momentum encoders and queues, which are only used for training."""
+    for name, _ in list(model.named_children()):
+        if name.endswith("_m"):
+            delattr(model, name)
+    for name, _ in list(model.named_buffers(recurse=False)):
+        if "queue" in name:
+            delattr(model, name)
+    if hasattr(model, "model_pairs"):
+        model.model_pairs = []
+    return model
+
+
+def quantizable_linears(model, skip=DEFAULT_SKIP):
+    """Names of the nn.Linear modules that are not matched by any pattern in skip.
+
+    A pattern matches a module when it matches its full dotted name or one of its
+    parents, so "text_encoder.encoder.layer.1[01].*" keeps the last two layers in fp32.
+    """
+    names = []
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        parents = [
+            ".".join(name.split(".")[: i + 1]) for i in range(name.count(".") + 1)
+        ]
+        if any(fnmatch.fnmatch(p, pattern) for p in parents for pattern in skip):
+            continue
+        names.append(name)
+    return names
+
+
+def quantize_dynamic(model, skip=DEFAULT_SKIP, dtype=torch.qint8):
+    """Dynamic int8 quantization of the Linear layers of the ViT and BERT towers.
+
+    Weights are stored in int8 and activations are quantized on the fly, so no
+    calibration data is needed. LayerNorms and embeddings always stay in fp32,
+    dynamic quantization has no kernels for them.
+    """
+    return torch.quantization.quantize_dynamic(
+        model, set(quantizable_linears(model, skip)), dtype=dtype
+    )
+
+
+def load_quantized(model, checkpoint_path):
+    """Rebuild a model saved by Quantize.py from a freshly created fp32 ALBEF."""
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    if checkpoint.get("pruning"):
+        prune_model(model, checkpoint["pruning"])
+    model = quantize_dynamic(strip_momentum(model), skip=checkpoint["skip"])
+    model.load_state_dict(checkpoint["model"])
+    return model
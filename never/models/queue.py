@@ -0,0 +1,37 @@
+import torch
+import torch.distributed as dist
+
+
+@torch.no_grad()
+def enqueue(queues, queue_ptr, keys):
+    """Write keys into ring-buffer queues, wrapping around their end.
+
+    The momentum features are enqueued before the contrastive losses, which then
+    use the queues themselves as key banks instead of a [batch, queue] copy. The
+    keys of the current batch are part of the bank, their columns are returned to
+    locate the positives. The bank thus holds queue_size keys, the batch included,
+    rather than batch_size + queue_size. The batch size only has to fit in the
+    queue.
+
+    Args:
+        queues (list of tensor): (dim, queue_size) buffers
+        queue_ptr (tensor): (1,) next column to write, advanced in place
+        keys (list of tensor): (batch_size, dim) keys gathered from all ranks in
+            rank order, one per queue
+
+    Returns:
+        tensor: (batch_size / world_size,) columns holding the keys of this rank
+    """
+    queue_size = queues[0].size(1)
+    batch_size = keys[0].size(0)
+    assert batch_size <= queue_size, "the global batch does not fit in the queue"
+
+    # the pointer stays on the device, there is no sync with the host
+    cols = (queue_ptr + torch.arange(batch_size, device=queue_ptr.device)) % queue_size
+    for queue, key in zip(queues, keys):
+        queue.index_copy_(1, cols, key.t().to(queue.dtype))
+    queue_ptr.copy_((queue_ptr + batch_size) % queue_size)
+
+    if dist.is_available() and dist.is_initialized():
+        cols = cols.view(dist.get_world_size(), -1)[dist.get_rank()]
+    return cols
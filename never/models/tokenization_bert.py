@@ -17,10 +17,13 @@
 
 import collections
 import os
+import re
 import unicodedata
 from typing import List, Optional, Tuple
 
+import torch
 from transformers.tokenization_utils import (
+    BatchEncoding,
     PreTrainedTokenizer,
     _is_control,
     _is_punctuation,
@@ -110,6 +113,16 @@ def load_vocab(vocab_file):
     return vocab
 
 
+# _clean_text and _run_split_on_punc restricted to ASCII, where they reduce to a
+# translate table and a regex
+ASCII_CLEAN_TABLE = {cp: None for cp in list(range(32)) + [127]}
+ASCII_CLEAN_TABLE.update({ord(c): " " for c in "\t\n\r"})
+ASCII_PUNC_RE = re.compile(r"[!-/:-@\[-`{-~]|[^!-/:-@\[-`{-~]+")
+
+# __call__ arguments handled by the batched fast path, see BertTokenizer.__call__
+FAST_CALL_KWARGS = {"padding", "truncation", "max_length", "return_tensors"}
+
+
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a piece of text."""
     text = text.strip()
@@ -156,6 +169,8 @@ class BertTokenizer(PreTrainedTokenizer):
         strip_accents: (:obj:`bool`, `optional`):
             Whether or not to strip all accents. If this option is not specified, then it will be determined by the
             value for :obj:`lowercase` (as in the original BERT).
+        word_cache_size (:obj:`int`, `optional`, defaults to 65536):
+            Number of words whose ids are kept in the LRU cache of the batched :obj:`__call__`.
     """
 
     vocab_files_names = VOCAB_FILES_NAMES
@@ -176,6 +191,7 @@ class BertTokenizer(PreTrainedTokenizer):
         mask_token="[MASK]",
         tokenize_chinese_chars=True,
         strip_accents=None,
+        word_cache_size=65536,
         **kwargs
     ):
         super().__init__(
@@ -189,6 +205,7 @@ class BertTokenizer(PreTrainedTokenizer):
             mask_token=mask_token,
             tokenize_chinese_chars=tokenize_chinese_chars,
             strip_accents=strip_accents,
+            word_cache_size=word_cache_size,
             **kwargs,
         )
 
@@ -214,6 +231,8 @@ class BertTokenizer(PreTrainedTokenizer):
         self.wordpiece_tokenizer = WordpieceTokenizer(
             vocab=self.vocab, unk_token=self.unk_token
         )
+        self.word_cache_size = word_cache_size
+        self.word_cache = collections.OrderedDict()
 
     @property
     def do_lower_case(self):
@@ -242,6 +261,104 @@ class BertTokenizer(PreTrainedTokenizer):
             split_tokens = self.wordpiece_tokenizer.tokenize(text)
         return split_tokens
 
+    def __call__(self, text=None, *args, **kwargs):
+        """
+        Batched fast path for the way the training and evaluation scripts call the tokenizer, e.g.
+        ``tokenizer(captions, padding="longest", truncation=True, max_length=30, return_tensors="pt")``.
+        Captions are encoded word by word through :meth:`_word_ids` and padded straight into tensors, the
+        outputs are the same as the ones of :class:`~transformers.PreTrainedTokenizer`. Any other argument
+        falls back to the generic implementation.
+        """
+        texts = [text] if isinstance(text, str) else text
+        padding = kwargs.get("padding", False)
+        truncation = kwargs.get("truncation")
+        max_length = kwargs.get("max_length")
+        if (
+            args
+            or not set(kwargs) <= FAST_CALL_KWARGS
+            or kwargs.get("return_tensors") != "pt"
+            or not isinstance(texts, (list, tuple))
+            or not texts
+            or not all(isinstance(t, str) for t in texts)
+            or padding not in (True, "longest", "max_length")
+            or (padding == "max_length" and max_length is None)
+            or truncation not in (None, False, True, "longest_first", "only_first")
+            or (truncation and max_length is None)
+            or self.padding_side != "right"
+            or getattr(self, "truncation_side", "right") != "right"
+        ):
+            return super().__call__(text, *args, **kwargs)
+
+        num_special = self.num_special_tokens_to_add()
+        if truncation and max_length <= num_special:
+            return super().__call__(text, *args, **kwargs)
+
+        # words spelling a special or added token go through the generic tokenize()
+        no_split = set(self.all_special_tokens) | set(self.added_tokens_encoder)
+        if self.do_basic_tokenize:
+            no_split |= self.basic_tokenizer.never_split
+
+        input_ids, token_type_ids = [], []
+        for text in texts:
+            ids = self._encode_fast(text, no_split)
+            if ids is None:
+                ids = self.convert_tokens_to_ids(self.tokenize(text))
+            if truncation:
+                ids = ids[: max_length - num_special]
+            input_ids.append(self.build_inputs_with_special_tokens(ids))
+            token_type_ids.append(self.create_token_type_ids_from_sequences(ids))
+
+        length = max(len(ids) for ids in input_ids)
+        if padding == "max_length":
+            length = max(length, max_length)
+        attention_mask = [[1] * len(ids) + [0] * (length - len(ids)) for ids in input_ids]
+        # like PreTrainedTokenizer, token_type_ids are padded by the same amount as input_ids
+        token_type_ids = [
+            types + [self.pad_token_type_id] * (length - len(ids))
+            for ids, types in zip(input_ids, token_type_ids)
+        ]
+        input_ids = [ids + [self.pad_token_id] * (length - len(ids)) for ids in input_ids]
+
+        encoding = {"input_ids": torch.tensor(input_ids)}
+        if "token_type_ids" in self.model_input_names:
+            encoding["token_type_ids"] = torch.tensor(token_type_ids)
+        encoding["attention_mask"] = torch.tensor(attention_mask)
+        return BatchEncoding(encoding)
+
+    def _encode_fast(self, text, no_split):
+        """
+        Ids of an ASCII text, without special tokens, the same as ``convert_tokens_to_ids(tokenize(text))``.
+        Returns :obj:`None` for the texts the fast path does not cover: non-ASCII characters, special tokens or
+        basic tokenization turned off.
+        """
+        if not self.do_basic_tokenize or not text.isascii():
+            return None
+        if any(token in text for token in no_split):
+            return None
+        if self.do_lower_case:
+            text = text.lower()
+            if any(token in text for token in no_split):
+                return None
+        ids = []
+        for word in text.translate(ASCII_CLEAN_TABLE).split():
+            ids += self._word_ids(word)
+        return ids
+
+    def _word_ids(self, word):
+        """Punctuation splitting and WordPiece of a cleaned ASCII word, memoized in an LRU cache."""
+        ids = self.word_cache.get(word)
+        if ids is not None:
+            self.word_cache.move_to_end(word)
+            return ids
+        tokens = []
+        for piece in ASCII_PUNC_RE.findall(word):
+            tokens += self.wordpiece_tokenizer.tokenize(piece)
+        ids = self.convert_tokens_to_ids(tokens)
+        self.word_cache[word] = ids
+        if len(self.word_cache) > self.word_cache_size:
+            self.word_cache.popitem(last=False)
+        return ids
+
     def _convert_token_to_id(self, token):
         """ Converts a token (str) in an id using the vocab. """
         return self.vocab.get(token, self.vocab.get(self.unk_token))
@@ -531,6 +648,34 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # character tries of the vocab, for the first piece of a word and for the "##" pieces
+        self.trie = self._build_trie(vocab)
+        self.suffix_trie = self._build_trie(
+            token[2:] for token in vocab if token.startswith("##")
+        )
+
+    @staticmethod
+    def _build_trie(tokens):
+        """Nested dicts char -> node, the None key of a node holds the token ending there."""
+        root = {}
+        for token in tokens:
+            node = root
+            for char in token:
+                node = node.setdefault(char, {})
+            node[None] = token
+        return root
+
+    def _longest_match(self, token, start):
+        """End of the longest vocab piece starting at token[start], 0 if there is none."""
+        node = self.trie if start == 0 else self.suffix_trie
+        end = 0
+        for i in range(start, len(token)):
+            node = node.get(token[i])
+            if node is None:
+                break
+            if None in node:
+                end = i + 1
+        return end
 
     def tokenize(self, text):
         """
@@ -555,20 +700,12 @@ class WordpieceTokenizer(object):
             start = 0
             sub_tokens = []
             while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
+                end = self._longest_match(token, start)
+                if end == 0:
                     is_bad = True
                     break
-                sub_tokens.append(cur_substr)
+                substr = token[start:end]
+                sub_tokens.append("##" + substr if start > 0 else substr)
                 start = end
 
             if is_bad:
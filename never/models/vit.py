@@ -1,11 +1,16 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from functools import partial
 
 from timm.models.vision_transformer import _cfg, PatchEmbed
 from timm.models.registry import register_model
 from timm.models.layers import trunc_normal_, DropPath
+from transformers.modeling_utils import (
+    find_pruneable_heads_and_indices,
+    prune_linear_layer,
+)
 
 
 class Mlp(nn.Module):
@@ -50,6 +55,7 @@ class Attention(nn.Module):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
+        self.head_dim = head_dim
         # NOTE scale factor was wrong in my original version, can set manually to be compat with prev weights
         self.scale = qk_scale or head_dim ** -0.5
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
@@ -58,6 +64,23 @@ class Attention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.attn_gradients = None
         self.attention_map = None
+        self.pruned_heads = set()
+
+    def prune_heads(self, heads):
+        """Remove heads (indices in the unpruned numbering), as BertAttention.prune_heads."""
+        if len(heads) == 0:
+            return
+        heads, index = find_pruneable_heads_and_indices(
+            heads, self.num_heads, self.head_dim, self.pruned_heads
+        )
+        # qkv rows are laid out as (3, num_heads, head_dim)
+        all_head_size = self.num_heads * self.head_dim
+        qkv_index = torch.cat([index + i * all_head_size for i in range(3)])
+        self.qkv = prune_linear_layer(self.qkv, qkv_index)
+        self.proj = prune_linear_layer(self.proj, index, dim=1)
+
+        self.num_heads = self.num_heads - len(heads)
+        self.pruned_heads = self.pruned_heads.union(heads)
 
     def save_attn_gradients(self, attn_gradients):
         self.attn_gradients = attn_gradients
@@ -75,7 +98,7 @@ class Attention(nn.Module):
         B, N, C = x.shape
         qkv = (
             self.qkv(x)
-            .reshape(B, N, 3, self.num_heads, C // self.num_heads)
+            .reshape(B, N, 3, self.num_heads, self.head_dim)
             .permute(2, 0, 3, 1, 4)
         )
         q, k, v = (
@@ -92,7 +115,7 @@ class Attention(nn.Module):
             self.save_attention_map(attn)
             attn.register_hook(self.save_attn_gradients)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -162,6 +185,9 @@ class VisionTransformer(nn.Module):
         attn_drop_rate=0.0,
         drop_path_rate=0.0,
         norm_layer=None,
+        gradient_checkpointing=False,
+        checkpoint_every=1,
+        patch_keep_ratio=1.0,
     ):
         """
         Args:
@@ -180,6 +206,9 @@ class VisionTransformer(nn.Module):
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
             norm_layer: (nn.Module): normalization layer
+            gradient_checkpointing (bool): recompute block activations in backward instead of storing them
+            checkpoint_every (int): checkpoint one out of every N blocks when gradient_checkpointing is set
+            patch_keep_ratio (float): fraction of patch tokens randomly kept in training (FLIP), CLS is always kept
         """
         super().__init__()
         self.num_features = (
@@ -220,6 +249,12 @@ class VisionTransformer(nn.Module):
         )
         self.norm = norm_layer(embed_dim)
 
+        self.gradient_checkpointing = gradient_checkpointing
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.patch_keep_ratio = patch_keep_ratio
+        # interpolated pos_embed tables for the grid sizes seen at inference
+        self._pos_embed_cache = {}
+
         trunc_normal_(self.pos_embed, std=0.02)
         trunc_normal_(self.cls_token, std=0.02)
         self.apply(self._init_weights)
@@ -237,28 +272,118 @@ class VisionTransformer(nn.Module):
     def no_weight_decay(self):
         return {"pos_embed", "cls_token"}
 
-    def forward(self, x, register_blk=-1):
+    def random_masking(self, x):
+        """Randomly keep ``patch_keep_ratio`` of the patch tokens of each sample.
+
+        Returns the kept tokens and their patch indices, sorted to preserve the
+        spatial order of the grid.
+        """
+        B, L, D = x.shape
+        len_keep = max(1, int(L * self.patch_keep_ratio))
+        noise = torch.rand(B, L, device=x.device)
+        ids_keep = noise.argsort(dim=1)[:, :len_keep].sort(dim=1)[0]
+        x = torch.gather(x, 1, ids_keep.unsqueeze(-1).expand(-1, -1, D))
+        return x, ids_keep
+
+    def embed_patches(self, x):
+        """Patch-embed images of any size divisible by the patch size.
+
+        Unlike ``self.patch_embed(x)`` this does not require the input size the
+        model was built with, and also returns the (height, width) patch grid.
+        """
+        x = self.patch_embed.proj(x)
+        grid_size = tuple(x.shape[-2:])
+        x = x.flatten(2).transpose(1, 2)
+        norm = getattr(self.patch_embed, "norm", None)
+        if norm is not None:
+            x = norm(x)
+        return x, grid_size
+
+    def get_pos_embed(self, grid_size):
+        """Positional embeddings for a (height, width) patch grid.
+
+        The learned table is bicubically resized when the grid differs from the
+        one it was trained for. At inference the resized tables are cached per
+        grid size, so one loaded model can serve several resolutions.
+        """
+        size = int(self.patch_embed.num_patches ** 0.5)
+        if grid_size == (size, size):
+            return self.pos_embed
+        if self.training or torch.is_grad_enabled():
+            return resize_pos_embed(self.pos_embed, 1, (size, size), grid_size)
+
+        key = (
+            grid_size,
+            self.pos_embed.data_ptr(),
+            self.pos_embed._version,
+            self.pos_embed.dtype,
+        )
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            # drop the tables of older parameter versions (e.g. after loading)
+            self._pos_embed_cache = {
+                k: v for k, v in self._pos_embed_cache.items() if k[1:] == key[1:]
+            }
+            pos_embed = resize_pos_embed(self.pos_embed, 1, (size, size), grid_size)
+            self._pos_embed_cache[key] = pos_embed
+        return pos_embed
+
+    def forward(self, x, register_blk=-1, return_keep_ids=False):
         B = x.shape[0]
-        x = self.patch_embed(x)
+        x, grid_size = self.embed_patches(x)
+        pos_embed = self.get_pos_embed(grid_size)
 
-        cls_tokens = self.cls_token.expand(
+        # add the positional embeddings before dropping, so kept patches keep theirs
+        x = x + pos_embed[:, 1:, :]
+        ids_keep = None
+        if self.training and self.patch_keep_ratio < 1:
+            x, ids_keep = self.random_masking(x)
+
+        cls_tokens = (self.cls_token + pos_embed[:, :1, :]).expand(
             B, -1, -1
         )  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-
-        x = x + self.pos_embed[:, : x.size(1), :]
         x = self.pos_drop(x)
 
+        use_checkpoint = (
+            self.gradient_checkpointing and self.training and torch.is_grad_enabled()
+        )
         for i, blk in enumerate(self.blocks):
-            x = blk(x, register_blk == i)
+            if use_checkpoint and i % self.checkpoint_every == 0:
+                x = torch.utils.checkpoint.checkpoint(blk, x, register_blk == i)
+            else:
+                x = blk(x, register_blk == i)
         x = self.norm(x)
 
+        if return_keep_ids:
+            return x, ids_keep
         return x
 
 
+def resize_pos_embed(pos_embed, num_extra_tokens, orig_size, new_size):
+    """Bicubically resize the patch part of a positional embedding table.
+
+    Args:
+        pos_embed (tensor): (1, num_extra_tokens + H * W, dim) embedding table
+        num_extra_tokens (int): leading tokens (class / dist tokens) kept unchanged
+        orig_size (tuple): (H, W) patch grid of ``pos_embed``
+        new_size (tuple): (H, W) patch grid to resize to
+    """
+    embedding_size = pos_embed.shape[-1]
+    # class_token and dist_token are kept unchanged
+    extra_tokens = pos_embed[:, :num_extra_tokens]
+    # only the position tokens are interpolated
+    pos_tokens = pos_embed[:, num_extra_tokens:]
+    pos_tokens = pos_tokens.reshape(-1, *orig_size, embedding_size).permute(0, 3, 1, 2)
+    pos_tokens = torch.nn.functional.interpolate(
+        pos_tokens, size=tuple(new_size), mode="bicubic", align_corners=False
+    )
+    pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
+    return torch.cat((extra_tokens, pos_tokens), dim=1)
+
+
 def interpolate_pos_embed(pos_embed_checkpoint, visual_encoder):
     # interpolate position embedding
-    embedding_size = pos_embed_checkpoint.shape[-1]
     num_patches = visual_encoder.patch_embed.num_patches
     num_extra_tokens = visual_encoder.pos_embed.shape[-2] - num_patches
     # height (== width) for the checkpoint position embedding
@@ -267,18 +392,12 @@ def interpolate_pos_embed(pos_embed_checkpoint, visual_encoder):
     new_size = int(num_patches ** 0.5)
 
     if orig_size != new_size:
-        # class_token and dist_token are kept unchanged
-        extra_tokens = pos_embed_checkpoint[:, :num_extra_tokens]
-        # only the position tokens are interpolated
-        pos_tokens = pos_embed_checkpoint[:, num_extra_tokens:]
-        pos_tokens = pos_tokens.reshape(
-            -1, orig_size, orig_size, embedding_size
-        ).permute(0, 3, 1, 2)
-        pos_tokens = torch.nn.functional.interpolate(
-            pos_tokens, size=(new_size, new_size), mode="bicubic", align_corners=False
+        new_pos_embed = resize_pos_embed(
+            pos_embed_checkpoint,
+            num_extra_tokens,
+            (orig_size, orig_size),
+            (new_size, new_size),
         )
-        pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
-        new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
         print(
             "reshape position embedding from %d to %d" % (orig_size ** 2, new_size ** 2)
         )
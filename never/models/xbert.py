@@ -565,7 +565,9 @@ class BertLayer(nn.Module):
                     encoder_attention_mask[
                         (self.layer_num - self.config.fusion_layer)
                         % len(encoder_hidden_states)
-                    ],
+                    ]
+                    if encoder_attention_mask is not None
+                    else None,
                     output_attentions=output_attentions,
                 )
                 attention_output = cross_attention_outputs[0]
@@ -652,7 +654,11 @@ class BertEncoder(nn.Module):
             layer_head_mask = head_mask[i] if head_mask is not None else None
             past_key_value = past_key_values[i] if past_key_values is not None else None
 
-            if getattr(self.config, "gradient_checkpointing", False) and self.training:
+            if (
+                getattr(self.config, "gradient_checkpointing", False)
+                and self.training
+                and torch.is_grad_enabled()
+            ):
 
                 if use_cache:
                     logger.warn(
@@ -1028,13 +1034,16 @@ class BertModel(BertPreTrainedModel):
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
-        # positions we want to attend and -10000.0 for masked positions.
-        # Since we are adding it to the raw scores before the softmax, this is
-        # effectively the same as removing these entirely.
+        # positions we want to attend and the lowest value of the dtype for masked
+        # positions. Since we are adding it to the raw scores before the softmax,
+        # this is effectively the same as removing these entirely, whatever the
+        # range of the scores under reduced precision.
         extended_attention_mask = extended_attention_mask.to(
             dtype=self.dtype
         )  # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        extended_attention_mask = (1.0 - extended_attention_mask) * torch.finfo(
+            self.dtype
+        ).min
         return extended_attention_mask
 
     def forward(
@@ -1065,6 +1074,8 @@ class BertModel(BertPreTrainedModel):
             the cross-attention if the model is configured as a decoder. Mask values selected in ``[0, 1]``:
             - 1 for tokens that are **not masked**,
             - 0 for tokens that are **masked**.
+            Leave it as ``None`` when the encoder input has no padding (e.g. image patches), the cross-attention
+            then skips building and adding the mask altogether.
         past_key_values (:obj:`tuple(tuple(torch.FloatTensor))` of length :obj:`config.n_layers` with each tuple having 4 tensors of shape :obj:`(batch_size, num_heads, sequence_length - 1, embed_size_per_head)`):
             Contains precomputed key and value hidden states of the attention blocks. Can be used to speed up decoding.
             If :obj:`past_key_values` are used, the user can optionally input only the last :obj:`decoder_input_ids`
@@ -1134,28 +1145,15 @@ class BertModel(BertPreTrainedModel):
 
         # If a 2D or 3D attention mask is provided for the cross-attention
         # we need to make broadcastable to [batch_size, num_heads, seq_length, seq_length]
+        # No mask means no padding: every score would get +0, so the add is skipped
         if encoder_hidden_states is not None:
-            if type(encoder_hidden_states) == list:
-                encoder_batch_size, encoder_sequence_length, _ = encoder_hidden_states[
-                    0
-                ].size()
-            else:
-                (
-                    encoder_batch_size,
-                    encoder_sequence_length,
-                    _,
-                ) = encoder_hidden_states.size()
-            encoder_hidden_shape = (encoder_batch_size, encoder_sequence_length)
-
             if type(encoder_attention_mask) == list:
                 encoder_extended_attention_mask = [
-                    self.invert_attention_mask(mask) for mask in encoder_attention_mask
+                    self.invert_attention_mask(mask) if mask is not None else None
+                    for mask in encoder_attention_mask
                 ]
             elif encoder_attention_mask is None:
-                encoder_attention_mask = torch.ones(encoder_hidden_shape, device=device)
-                encoder_extended_attention_mask = self.invert_attention_mask(
-                    encoder_attention_mask
-                )
+                encoder_extended_attention_mask = None
             else:
                 encoder_extended_attention_mask = self.invert_attention_mask(
                     encoder_attention_mask
@@ -1443,14 +1441,16 @@ class BertLMHeadModel(BertPreTrainedModel):
             labels = labels[:, 1:].contiguous()
             loss_fct = CrossEntropyLoss(reduction=reduction)
             lm_loss = loss_fct(
-                shifted_prediction_scores.view(-1, self.config.vocab_size),
+                shifted_prediction_scores.view(-1, self.config.vocab_size).float(),
                 labels.view(-1),
             )
             lm_loss = lm_loss.view(prediction_scores.size(0), -1).sum(1)
 
         if soft_labels is not None:
             loss_distill = -torch.sum(
-                F.log_softmax(shifted_prediction_scores, dim=1) * soft_labels, dim=-1
+                F.log_softmax(shifted_prediction_scores.float(), dim=1)
+                * soft_labels.float(),
+                dim=-1,
             )
             loss_distill = (loss_distill * (labels != -100)).sum(1)
             lm_loss = (1 - alpha) * lm_loss + alpha * loss_distill
@@ -1590,12 +1590,14 @@ class BertForMaskedLM(BertPreTrainedModel):
         if labels is not None:
             loss_fct = CrossEntropyLoss()  # -100 index = padding token
             masked_lm_loss = loss_fct(
-                prediction_scores.view(-1, self.config.vocab_size), labels.view(-1)
+                prediction_scores.view(-1, self.config.vocab_size).float(),
+                labels.view(-1),
             )
 
         if soft_labels is not None:
             loss_distill = -torch.sum(
-                F.log_softmax(prediction_scores, dim=-1) * soft_labels, dim=-1
+                F.log_softmax(prediction_scores.float(), dim=-1) * soft_labels.float(),
+                dim=-1,
             )
             loss_distill = loss_distill[labels != -100].mean()
             masked_lm_loss = (1 - alpha) * masked_lm_loss + alpha * loss_distill
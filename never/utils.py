@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import os
 import random
@@ -78,7 +79,9 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        # the NCCL backend only reduces CUDA tensors, gloo any
+        device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -285,6 +288,19 @@ def get_rank():
     return dist.get_rank()
 
 
+def barrier():
+    """dist.barrier(), a no-op in single-process runs."""
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+
+
+def ddp_device_ids(args):
+    """device_ids of DistributedDataParallel, the local GPU or None on CPU."""
+    if torch.device(args.device).type == "cuda":
+        return [args.gpu]
+    return None
+
+
 def is_main_process():
     return get_rank() == 0
 
@@ -301,7 +317,7 @@ def init_distributed_mode(args):
         args.gpu = int(os.environ["LOCAL_RANK"])
     elif "SLURM_PROCID" in os.environ:
         args.rank = int(os.environ["SLURM_PROCID"])
-        args.gpu = args.rank % torch.cuda.device_count()
+        args.gpu = args.rank % max(torch.cuda.device_count(), 1)
     else:
         print("Not using distributed mode")
         args.distributed = False
@@ -309,8 +325,12 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = "nccl"
+    # NCCL for training on GPUs, gloo on CPUs
+    if getattr(args, "dist_backend", None) is None:
+        on_cuda = torch.device(args.device).type == "cuda"
+        args.dist_backend = "nccl" if on_cuda else "gloo"
+    if args.dist_backend == "nccl":
+        torch.cuda.set_device(args.gpu)
     print(
         "| distributed init (rank {}): {}".format(args.rank, args.dist_url), flush=True
     )
@@ -351,6 +371,64 @@ def _get_rank() -> int:
 rank_zero_only.rank = getattr(rank_zero_only, "rank", _get_rank())
 
 
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def get_autocast(precision, device):
+    """autocast context for the given --precision, a no-op for fp32.
+
+    Args:
+        precision (str): one of "fp32", "bf16", "fp16"
+        device (torch.device or str): device the model runs on
+    """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(
+        device_type=torch.device(device).type, dtype=PRECISIONS[precision]
+    )
+
+
+def create_grad_scaler(precision, device):
+    """Loss scaler for fp16 training, disabled (a pass-through) otherwise.
+
+    bf16 shares the fp32 exponent range, so only fp16 needs loss scaling.
+
+    Args:
+        precision (str): one of "fp32", "bf16", "fp16"
+        device (torch.device or str): device the model runs on
+    """
+    return torch.amp.GradScaler(torch.device(device).type, enabled=precision == "fp16")
+
+
+COMPILED_MODULES = ("visual_encoder", "text_encoder", "text_decoder")
+COMPILED_LOSSES = ("contrastive_loss", "in_batch_g2l_loss")
+
+
+def compile_model(model, **kwargs):
+    """torch.compile the encoders and loss blocks of an ALBEF model, in place.
+
+    The encoders (and their momentum copies) are compiled with nn.Module.compile,
+    so the state_dict keys, checkpoints and DDP wrapping are unchanged. The
+    sampling, queue and momentum code between them stays in eager mode, each
+    compiled block is a single graph.
+
+    Args:
+        model (nn.Module): one of the task models
+        kwargs: forwarded to torch.compile, e.g. mode="max-autotune"
+    """
+    for name, module in model.named_children():
+        if name not in COMPILED_MODULES and name[:-2] not in COMPILED_MODULES:
+            continue
+        module.compile(**kwargs)
+        # pretrain calls the BertModel inside BertForMaskedLM directly
+        if hasattr(module, "bert"):
+            module.bert.compile(**kwargs)
+    for name in COMPILED_LOSSES:
+        if hasattr(model, name):
+            setattr(model, name, torch.compile(getattr(model, name), **kwargs))
+    return model
+
+
 def set_seed(main_seed):
     seed = main_seed + get_rank()
     torch.manual_seed(seed)